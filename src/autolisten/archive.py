@@ -0,0 +1,345 @@
+import collections
+import datetime
+import functools
+import io
+import os
+import pathlib
+import threading
+import urllib.parse
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, NamedTuple
+
+import numpy as np
+import soundfile as sf
+
+import src.autolisten.tools as tools
+from src.autolisten.reader import SegmentError, SegmentReader
+from src.autolisten.tools import ARCHIVE_PORT, FORMATS, FS, format_date
+
+# This module serves the recordings of a location over HTTP.
+# Files are served whole or by byte range straight from the page cache, and `/clip` stitches the audio
+# of any time range out of the segments that cover it, so a few seconds can be heard without copying a file.
+
+# Bytes of decoded audio kept for repeated clip requests.
+CACHE_BYTES = 256 * 1024 * 1024
+# Seconds of audio decoded and cached at a time.
+CACHE_SECONDS = 5
+# Longest clip that can be requested, in seconds.
+MAX_CLIP_SECONDS = 600
+# Length of a clip when none is given, in seconds.
+CLIP_SECONDS = 10
+# Bytes handed to the kernel per sendfile call.
+SENDFILE_CHUNK = 8 * 1024 * 1024
+# Content types of clips and of the files a location holds.
+CONTENT_TYPES = {
+    ".ogg": "audio/ogg",
+    ".flac": "audio/flac",
+    ".wav": "audio/wav",
+    ".rf64": "audio/wav",
+    ".raw": "application/octet-stream",
+    ".seek": "application/octet-stream",
+    ".f32": "application/octet-stream",
+    ".json": "application/json",
+    ".jsonl": "application/json",
+}
+
+
+class ArchiveError(Exception):
+    """Raised when a request cannot be answered from the recordings."""
+
+
+class Segment(NamedTuple):
+    """A recording and the wall clock time of its first frame."""
+
+    filename: pathlib.Path
+    start: float
+
+
+def find_segments(location: pathlib.Path, start: float, end: float) -> List[Segment]:
+    """Returns the segments of `location` that may hold audio between the times `start` and `end`, in order.
+    Files of tees and other files whose names are not segment names are left out."""
+    first = datetime.date.fromtimestamp(start) - datetime.timedelta(days=1)
+    last = datetime.date.fromtimestamp(end)
+    segments = []
+    while first <= last:
+        directory = pathlib.Path(location) / format_date(first)
+        if directory.is_dir():
+            for path in directory.iterdir():
+                if tools.is_segment(path):
+                    segments.append(Segment(path, tools.segment_start(path)))
+        first += datetime.timedelta(days=1)
+    segments.sort(key=lambda segment: segment.start)
+    # The last segment to start before the range may still be running when it begins.
+    before = [segment for segment in segments if segment.start <= start]
+    return before[-1:] + [
+        segment for segment in segments if start < segment.start < end
+    ]
+
+
+class BlockCache:
+    """Least recently used cache of decoded audio, `CACHE_SECONDS` of a segment per entry.
+    Entries are keyed by the modification time of the file, so a segment still being written is read again.
+    """
+
+    def __init__(self, max_bytes: int = CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.blocks = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def block(self, reader: SegmentReader, index: int) -> np.ndarray:
+        """Returns block `index` of the segment open in `reader` as int32."""
+        key = (str(reader.filename), reader.filename.stat().st_mtime_ns, index)
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+                self.hits += 1
+                return block
+            self.misses += 1
+        length = CACHE_SECONDS * reader.samplerate
+        # Memory mapped segments return views, which are copied so the cache does not keep the file mapped.
+        block = np.array(reader.read(index * length, length), dtype=np.int32)
+        with self.lock:
+            if key not in self.blocks:
+                self.blocks[key] = block
+                self.bytes += block.nbytes
+            while self.bytes > self.max_bytes and len(self.blocks) > 1:
+                _, evicted = self.blocks.popitem(last=False)
+                self.bytes -= evicted.nbytes
+        return block
+
+    def read(self, reader: SegmentReader, start: int, frames: int) -> np.ndarray:
+        """Returns `frames` frames of the segment open in `reader` beginning at frame `start`."""
+        length = CACHE_SECONDS * reader.samplerate
+        end = min(start + frames, reader.frames)
+        pieces = []
+        for index in range(start // length, max(start, end - 1) // length + 1):
+            block = self.block(reader, index)
+            offset = index * length
+            pieces.append(block[max(0, start - offset) : max(0, end - offset)])
+        return np.concatenate(pieces)
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "blocks": len(self.blocks),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def clip(
+    location: pathlib.Path, start: float, duration: float, cache: BlockCache
+) -> np.ndarray:
+    """Returns the audio recorded from the time `start` for `duration` seconds as int32 at `FS`.
+    It is stitched from every segment covering the range. Time no segment covers is silent.
+    """
+    if not 0 < duration <= MAX_CLIP_SECONDS:
+        raise ArchiveError(
+            f"The duration must be between 0 and {MAX_CLIP_SECONDS} seconds"
+        )
+    length = round(duration * FS)
+    audio = None
+    covered = False
+    for segment in find_segments(location, start, start + duration):
+        try:
+            reader = SegmentReader(segment.filename)
+        except (SegmentError, RuntimeError) as e:
+            raise ArchiveError(f"{segment.filename.name} cannot be read: {e}")
+        with reader:
+            if reader.samplerate != FS:
+                continue
+            if audio is None:
+                audio = np.zeros((length, reader.channels), dtype=np.int32)
+            elif reader.channels != audio.shape[1]:
+                raise ArchiveError(
+                    f"{segment.filename.name} has {reader.channels} channels instead of {audio.shape[1]}"
+                )
+            offset = round((segment.start - start) * FS)
+            first = max(0, -offset)
+            frames = min(reader.frames - first, length - max(0, offset))
+            if frames <= 0:
+                continue
+            audio[max(0, offset) : max(0, offset) + frames] = cache.read(
+                reader, first, frames
+            )
+            covered = True
+    if not covered:
+        raise ArchiveError("No recording covers the requested time")
+    return audio
+
+
+def parse_time(value: str) -> float:
+    """Parses a UNIX time or a local ISO 8601 date and time such as `2024-05-01T12:00:05`."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def parse_range(header: str, size: int):
+    """Returns the first and last byte of a `Range` header for a file of `size` bytes.
+    Returns None when the whole file should be sent, as for several ranges, and raises ArchiveError when
+    the range lies outside the file."""
+    unit, _, ranges = header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+    first, _, last = ranges.strip().partition("-")
+    try:
+        if first:
+            first, last = int(first), int(last) if last else size - 1
+        else:
+            first, last = size - int(last), size - 1
+    except ValueError:
+        return None
+    first, last = max(0, first), min(last, size - 1)
+    if first > last:
+        raise ArchiveError(f"The range {header} is outside the file")
+    return first, last
+
+
+class ArchiveHandler(SimpleHTTPRequestHandler):
+    """Serves the files and day directories of a location, byte ranges of files and clips."""
+
+    extensions_map = {**SimpleHTTPRequestHandler.extensions_map, **CONTENT_TYPES}
+
+    def do_GET(self):
+        self.__respond(body=True)
+
+    def do_HEAD(self):
+        self.__respond(body=False)
+
+    def __respond(self, body: bool):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/clip":
+            self.__send_clip(urllib.parse.parse_qs(url.query), body)
+            return
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            # Directories are listed, and anything else is answered with an error.
+            if body:
+                super().do_GET()
+            else:
+                super().do_HEAD()
+            return
+        self.__send_file(path, body)
+
+    def __send_file(self, path: str, body: bool):
+        """Sends a file, or the byte range asked for, with sendfile."""
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            first, last = 0, stat.st_size - 1
+            status = HTTPStatus.OK
+            if "Range" in self.headers:
+                try:
+                    requested = parse_range(self.headers["Range"], stat.st_size)
+                except ArchiveError:
+                    self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.send_header("Content-Range", f"bytes */{stat.st_size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if requested is not None:
+                    first, last = requested
+                    status = HTTPStatus.PARTIAL_CONTENT
+            self.send_response(status)
+            self.send_header("Content-Type", self.guess_type(path))
+            self.send_header("Content-Length", str(last - first + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Last-Modified", self.date_time_string(int(stat.st_mtime)))
+            if status == HTTPStatus.PARTIAL_CONTENT:
+                self.send_header(
+                    "Content-Range", f"bytes {first}-{last}/{stat.st_size}"
+                )
+            self.end_headers()
+            if body:
+                self.__sendfile(f, first, last - first + 1)
+
+    def __sendfile(self, f, offset: int, count: int):
+        """Copies `count` bytes of `f` from `offset` to the client without passing them through Python."""
+        if not hasattr(os, "sendfile"):
+            f.seek(offset)
+            while count > 0:
+                data = f.read(min(count, SENDFILE_CHUNK))
+                if not data:
+                    return
+                self.wfile.write(data)
+                count -= len(data)
+            return
+        while count > 0:
+            sent = os.sendfile(
+                self.connection.fileno(),
+                f.fileno(),
+                offset,
+                min(count, SENDFILE_CHUNK),
+            )
+            if sent == 0:
+                return
+            offset += sent
+            count -= sent
+
+    def __send_clip(self, query: dict, body: bool):
+        """Sends the audio of `start` for `duration` seconds, encoded in `format`, WAV by default."""
+        try:
+            start = parse_time(query["start"][0])
+            duration = float(query.get("duration", [CLIP_SECONDS])[0])
+            file_format = query.get("format", ["WAV"])[0].upper()
+            if file_format not in FORMATS or file_format == "RAW":
+                raise ArchiveError(f"Clips cannot be encoded as {file_format}")
+            audio = clip(self.server.location, start, duration, self.server.cache)
+        except ArchiveError as e:
+            self.send_error(HTTPStatus.NOT_FOUND, str(e))
+            return
+        except (KeyError, ValueError) as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, f"Invalid clip request: {e}")
+            return
+        extension, subtype = FORMATS[file_format]
+        encoded = io.BytesIO()
+        sf.write(encoded, audio, FS, subtype, format=file_format)
+        name = datetime.datetime.fromtimestamp(start).strftime("%Y-%m-%d--%H-%M-%S")
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", CONTENT_TYPES[extension])
+        self.send_header("Content-Length", str(encoded.tell()))
+        self.send_header("Content-Disposition", f'inline; filename="{name}{extension}"')
+        self.end_headers()
+        if body:
+            self.wfile.write(encoded.getbuffer())
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ArchiveServer(ThreadingHTTPServer):
+    """HTTP server for the recordings of a location."""
+
+    def __init__(
+        self,
+        location: pathlib.Path,
+        address=("localhost", ARCHIVE_PORT),
+        cache_bytes: int = CACHE_BYTES,
+        verbose: bool = False,
+    ):
+        """Serves `location` on `address`, keeping up to `cache_bytes` of decoded audio for clips."""
+        assert os.path.isdir(location), "You have not specified a valid path."
+        self.location = pathlib.Path(location)
+        self.cache = BlockCache(cache_bytes)
+        self.verbose = verbose
+        super().__init__(
+            address, functools.partial(ArchiveHandler, directory=str(self.location))
+        )
+
+    def start(self) -> "ArchiveServer":
+        """Serves the archive from a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
@@ -0,0 +1,427 @@
+import asyncio
+import datetime
+import json
+import os
+import pathlib
+import signal
+import sys
+from concurrent.futures.thread import ThreadPoolExecutor
+
+import numpy as np
+import sounddevice as sd
+
+import src.autolisten.tools as tools
+from src.autolisten.daemon import claim_socket, dispatch
+from src.autolisten.devices import REGISTRY
+from src.autolisten.features import FeatureExtractor
+from src.autolisten.scheduler import default_workers
+from src.autolisten.segment import SegmentFile
+from src.autolisten.shipper import Shipper, cleanup_shipped
+from src.autolisten.tap import TapServer
+from src.autolisten.timing import SampleClock
+from src.autolisten.tools import (
+    FS,
+    MINUTE,
+    BLOCKSIZE,
+    HOUR,
+    FORMATS,
+    SHUTDOWN_TIMEOUT,
+    MAX_QUALITY,
+    MAX_COMPLEXITY,
+)
+
+# This module records with a single input stream driven by an asyncio event loop.
+
+# Seconds between two checks for a new day directory and old recordings to delete.
+RETENTION_INTERVAL = 60
+# Seconds between two status reports in verbose mode.
+METRICS_INTERVAL = 60
+
+
+class AsyncSegment(SegmentFile):
+    """A file written by the `AsyncRecorder`. Blocks are queued on the event loop and written in an executor."""
+
+    def __init__(
+        self,
+        filename: pathlib.Path,
+        channels: int,
+        file_format: str,
+        stages: list,
+        encoder: dict = None,
+    ):
+        super().__init__(filename, channels, file_format, stages, encoder)
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+
+class AsyncRecorder:
+    """
+    ### Recorder built on asyncio.
+    A single input stream is kept open for the whole recording. Its callback hands blocks to the event loop,
+    which splits them into files of exactly `filelen` seconds. Encoding runs in a thread pool while rotation,
+    retention, metrics and the control socket are coroutines on one event loop.
+    """
+
+    def __init__(
+        self,
+        location: str,
+        timeout: int,
+        deletion: int = -1,
+        filelen: int = 1800,
+        verbose=False,
+        channels: int = 2,
+        background=False,
+        long_recording: bool = False,
+        sound_device: int = -1,
+        delay: int = 0,
+        closest: int = 0,
+        features: bool = False,
+        file_format: str = "OGG",
+        control: pathlib.Path = None,
+        shutdown_timeout: int = SHUTDOWN_TIMEOUT,
+        max_writers: int = None,
+        shipper: Shipper = None,
+        quality: float = None,
+        complexity: int = None,
+        tap: TapServer = None,
+    ):
+        """Takes the same arguments as `Recorder`.
+        - control - specify the path of a UNIX socket to serve control commands on.
+        """
+        assert os.path.exists(location), "You have not specified a valid path."
+        assert timeout > 0, "The timeout must be greater than zero. "
+        assert filelen > 0 or delay > 0, "The file length must be greater than 0"
+        assert channels > 0, "The channels must be greater than zero"
+        assert file_format in FORMATS, "The file format is not supported."
+        assert (
+            quality is None or 0 <= quality <= MAX_QUALITY
+        ), f"The quality must be between 0 and {MAX_QUALITY}"
+        assert (
+            complexity is None or 0 <= complexity <= MAX_COMPLEXITY
+        ), f"The complexity must be between 0 and {MAX_COMPLEXITY}"
+        if deletion != -1:
+            assert isinstance(deletion, int), "Deletion must be an integer"
+            assert deletion > 0, "Deletion must be greater than 0"
+
+        tools.setup_logs(background)
+        self.location = pathlib.Path(location)
+        self.timeout = timeout
+        self.deletion = deletion
+        self.filelen = filelen
+        self.verbose = verbose
+        self.channels = channels
+        self.device = None if sound_device == -1 else sound_device
+        self.delay = closest if closest else delay
+        self.features = features
+        self.file_format = file_format
+        self.encoder = tools.encoder_options(file_format, quality, complexity)
+        self.control = control
+        self.shutdown_timeout = shutdown_timeout
+        self.max_writers = max_writers if max_writers else default_workers()
+        self.shipper = shipper
+        self.tap = tap
+
+        if delay:
+            self.filelen = delay
+            long_recording = True
+        if long_recording:
+            self.filelen *= MINUTE
+            self.timeout *= HOUR
+
+        self.files = 0
+        self.saved_frames = 0
+        self.captured_frames = 0
+        self.streamed_frames = 0
+        self.clock = SampleClock()
+        self.paused = False
+        self.writers = set()
+        self.loop = None
+        self.blocks = None
+        self.stopped = None
+
+    def record(self):
+        """Runs the recording on a new event loop until the timeout passes or it is stopped."""
+        asyncio.run(self.run())
+
+    async def run(self):
+        """Coroutine running the recording."""
+        self.loop = asyncio.get_running_loop()
+        self.blocks = asyncio.Queue()
+        self.stopped = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_writers)
+        device = REGISTRY.check(self.device, self.channels)
+        if self.verbose:
+            sys.stdout.write(f"Recording from {device.name} ({device.hostapi}).\n")
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signum, self.stop)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Signals can only be handled on the main thread of a POSIX system.
+                pass
+
+        server = None
+        if self.control is not None:
+            server = await asyncio.start_unix_server(
+                self.__handle_control, path=str(claim_socket(self.control))
+            )
+
+        try:
+            if self.delay:
+                wait_time = tools.get_wait_time(self.delay)
+                sys.stdout.write(
+                    f"The correct start time has not occured yet. Sleeping for {wait_time} seconds.\n"
+                )
+                await self.__sleep(wait_time)
+
+            tools.create_directory(self.location)
+            sys.stdout.write(
+                f"Starting recordings at {self.location}. Will continue for {self.timeout:g} minute{'' if self.timeout == 1 else 's'}.\n"
+            )
+            background = [
+                asyncio.ensure_future(self.__retention()),
+                asyncio.ensure_future(self.__metrics()),
+            ]
+            capture = asyncio.ensure_future(self.__capture())
+
+            try:
+                stream = REGISTRY.open_stream(
+                    device.index,
+                    samplerate=FS,
+                    blocksize=BLOCKSIZE,
+                    channels=self.channels,
+                    dtype=np.int32,
+                    callback=self.__callback,
+                )
+            except sd.PortAudioError:
+                # The device may have been unplugged, so it is looked up again next time.
+                REGISTRY.invalidate(reinitialize=True)
+                raise
+            with stream:
+                await self.__sleep(self.timeout * MINUTE)
+
+            # Queued after the blocks the callback handed over before the stream closed, so none is dropped.
+            self.loop.call_soon(self.blocks.put_nowait, None)
+            await capture
+            for task in background:
+                task.cancel()
+            await self.__drain()
+        finally:
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+                pathlib.Path(self.control).unlink(missing_ok=True)
+            self.executor.shutdown(wait=False)
+
+        sys.stdout.write(
+            f"Saved {self.saved_frames / FS:.1f} seconds of audio in {self.files} files. You can now visit your files at {self.location} !\n"
+        )
+
+    async def __sleep(self, seconds: float):
+        """Sleeps for `seconds` or until the recording is stopped."""
+        try:
+            await asyncio.wait_for(self.stopped.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def __callback(self, indata: np.ndarray, frames: int, time_info, status):
+        """Streaming callback. Timestamps the block and hands a copy of it to the event loop."""
+        dropped = self.clock.update(
+            self.streamed_frames, frames, time_info, status.input_overflow
+        )
+        if dropped:
+            # Silence keeps one second of file equal to one second of time. Only its length is handed
+            # over, so the callback never allocates it.
+            self.loop.call_soon_threadsafe(self.blocks.put_nowait, dropped)
+        self.streamed_frames += dropped + frames
+        if status:
+            sys.stderr.write("%s\n" % status)
+        block = indata.copy()
+        self.loop.call_soon_threadsafe(self.blocks.put_nowait, block)
+        if self.tap is not None:
+            self.tap.publish(block)
+
+    async def __capture(self):
+        """Splits the captured blocks into files of exactly `filelen` seconds."""
+        segment = None
+        while True:
+            block = await self.blocks.get()
+            if block is None:
+                break
+            if isinstance(block, int):
+                block = np.zeros((block, self.channels), dtype=np.int32)
+            position = self.captured_frames
+            self.captured_frames += len(block)
+            if self.paused:
+                # Blocks captured while paused are dropped.
+                if segment is not None:
+                    self.__finish(segment)
+                    segment = None
+                continue
+
+            while len(block):
+                if segment is None:
+                    segment = self.__start()
+                    segment.start = position
+                # The file length may have been shortened below what is already written.
+                take = min(len(block), max(0, int(self.filelen * FS) - segment.frames))
+                if take:
+                    segment.queue.put_nowait(block[:take])
+                    segment.frames += take
+                    block = block[take:]
+                    position += take
+                if segment.frames >= int(self.filelen * FS):
+                    self.__finish(segment)
+                    segment = None
+
+        if segment is not None:
+            self.__finish(segment)
+
+    def __start(self) -> AsyncSegment:
+        """Starts a new file and the coroutine writing it."""
+        filename = tools.get_filename(
+            self.filelen, self.location, FORMATS[self.file_format][0]
+        )
+        stages = []
+        if self.features:
+            stages.append(
+                FeatureExtractor(
+                    filename.parent, self.channels, datetime.datetime.now().timestamp()
+                )
+            )
+        segment = AsyncSegment(
+            filename, self.channels, self.file_format, stages, self.encoder
+        )
+        task = asyncio.ensure_future(self.__write(segment))
+        self.writers.add(task)
+        task.add_done_callback(self.writers.discard)
+        if self.verbose:
+            sys.stdout.write(
+                f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Starting {filename.name}\n"
+            )
+        return segment
+
+    def __finish(self, segment: AsyncSegment):
+        """Ends a file. Its writer finishes it once the queued blocks are written."""
+        segment.queue.put_nowait(None)
+        self.files += 1
+
+    async def __write(self, segment: AsyncSegment):
+        """Writes the blocks queued for a file in the executor, batching whatever has accumulated."""
+        try:
+            await self.loop.run_in_executor(self.executor, segment.open)
+            done = False
+            while not done:
+                blocks = [await segment.queue.get()]
+                while not segment.queue.empty():
+                    blocks.append(segment.queue.get_nowait())
+                done = blocks[-1] is None
+                blocks = [block for block in blocks if block is not None]
+                if blocks:
+                    await self.loop.run_in_executor(
+                        self.executor, segment.write, blocks
+                    )
+            # Only frames that reached the file count as saved.
+            self.saved_frames += segment.frames
+        except Exception as e:
+            sys.stderr.write(f"ERROR: {e}\n")
+        finally:
+            await self.loop.run_in_executor(
+                self.executor,
+                segment.close,
+                self.clock.segment(segment.start, segment.frames),
+            )
+            if self.shipper is not None and segment.sound_file is not None:
+                self.shipper.submit(segment.filename)
+
+    async def __drain(self):
+        """Waits at most `shutdown_timeout` seconds for the files still being written."""
+        if not self.writers:
+            return
+        _, pending = await asyncio.wait(
+            list(self.writers), timeout=self.shutdown_timeout
+        )
+        if pending:
+            sys.stderr.write(
+                f"ERROR: {len(pending)} file{'' if len(pending) == 1 else 's'} could not be finished within {self.shutdown_timeout} seconds.\n"
+            )
+            for task in pending:
+                task.cancel()
+
+    async def __retention(self):
+        """Creates the directory of each new day and deletes old recordings."""
+        curr_date = tools.format_date_now()
+        while True:
+            await asyncio.sleep(RETENTION_INTERVAL)
+            if curr_date != tools.format_date_now():
+                tools.create_directory(self.location)
+                if self.deletion != -1:
+                    await self.loop.run_in_executor(
+                        self.executor,
+                        cleanup_shipped,
+                        self.deletion,
+                        str(self.location),
+                    )
+                curr_date = tools.format_date_now()
+
+    async def __metrics(self):
+        """Reports the status of the recording in verbose mode."""
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            if self.verbose:
+                sys.stdout.write(f"{json.dumps(self.status())}\n")
+                sys.stdout.flush()
+
+    async def __handle_control(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """Answers control commands, one JSON object per line."""
+        try:
+            async for line in reader:
+                try:
+                    response = {"ok": True, "result": dispatch(self, json.loads(line))}
+                except Exception as e:
+                    response = {"ok": False, "error": str(e)}
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def status(self) -> dict:
+        """Returns a summary of the state of the recorder."""
+        if self.stopped is not None and self.stopped.is_set():
+            state = "stopping"
+        elif self.paused:
+            state = "paused"
+        else:
+            state = "recording"
+        status = {
+            "state": state,
+            "pid": os.getpid(),
+            "location": str(self.location),
+            "files": self.files,
+            "secs_passed": self.captured_frames / FS,
+            "timeout": self.timeout * MINUTE,
+            "filelen": self.filelen,
+            "writers": len(self.writers),
+            "max_writers": self.max_writers,
+            "format": self.file_format,
+        }
+        if self.tap is not None:
+            status.update(self.tap.status())
+        return status
+
+    def stop(self):
+        """Finalizes the current file and ends the recording."""
+        self.stopped.set()
+
+    def pause(self):
+        """Finalizes the current file and drops captured audio until `resume` is called."""
+        self.paused = True
+
+    def resume(self):
+        """Resumes recording after a call to `pause`."""
+        self.paused = False
+
+    def set_filelen(self, filelen: int):
+        """Changes the length of time in seconds of the current and following files."""
+        assert filelen > 0, "The file length must be greater than 0"
+        self.filelen = filelen
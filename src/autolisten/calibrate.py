@@ -0,0 +1,90 @@
+import io
+import time
+from typing import List
+
+import numpy as np
+import soundfile as sf
+
+from src.autolisten.tools import (
+    BLOCKSIZE,
+    CHANNELS,
+    FORMATS,
+    FS,
+    MAX_COMPLEXITY,
+    MAX_QUALITY,
+    encoder_options,
+)
+
+# This module measures how fast this host encodes each format and setting, to pick the cheapest that keeps up.
+
+# Seconds of synthetic audio encoded for every setting.
+CALIBRATION_SECONDS = 10
+# Settings measured for every format, from the cheapest to the most expensive.
+CALIBRATION_SETTINGS = {
+    "OGG": [{"quality": quality} for quality in range(0, MAX_QUALITY + 1, 2)],
+    "FLAC": [{"complexity": complexity} for complexity in (0, 2, 5, MAX_COMPLEXITY)],
+    "WAV": [{}],
+}
+
+
+def synthetic_audio(
+    seconds: float, channels: int = CHANNELS, samplerate: int = FS
+) -> np.ndarray:
+    """Returns tones in noise, harder to compress than silence and closer to a room than white noise."""
+    t = np.arange(int(seconds * samplerate)) / samplerate
+    rng = np.random.default_rng(0)
+    tones = sum(
+        np.sin(2 * np.pi * frequency * t) / 8 for frequency in (110, 440, 1760, 7040)
+    )
+    noise = rng.normal(0, 0.05, (len(t), channels))
+    return (tones[:, None] + noise).astype(np.float32)
+
+
+def measure(
+    file_format: str,
+    audio: np.ndarray,
+    quality: float = None,
+    complexity: int = None,
+    samplerate: int = FS,
+) -> dict:
+    """Encodes `audio` in memory block by block, like a writer does, and returns the encode realtime factor
+    and the bytes written per second of audio."""
+    buffer = io.BytesIO()
+    started = time.perf_counter()
+    with sf.SoundFile(
+        buffer,
+        "w",
+        samplerate,
+        audio.shape[1],
+        FORMATS[file_format][1],
+        format=file_format,
+        **encoder_options(file_format, quality, complexity),
+    ) as f:
+        for start in range(0, len(audio), BLOCKSIZE):
+            f.write(audio[start : start + BLOCKSIZE])
+    elapsed = time.perf_counter() - started
+    seconds = len(audio) / samplerate
+    return {
+        "format": file_format,
+        "quality": quality,
+        "complexity": complexity,
+        "realtime_factor": elapsed / seconds,
+        "bytes_per_second": len(buffer.getbuffer()) / seconds,
+    }
+
+
+def calibrate(
+    formats: List[str] = None,
+    channels: int = CHANNELS,
+    seconds: float = CALIBRATION_SECONDS,
+) -> List[dict]:
+    """Measures every setting of `CALIBRATION_SETTINGS` for `formats`, those listed there by default.
+    Formats without settings are measured with the defaults of their encoder."""
+    audio = synthetic_audio(seconds, channels)
+    results = []
+    for file_format in formats or CALIBRATION_SETTINGS:
+        # The first encode of a format pays for loading its codec, which would count against the cheapest setting.
+        measure(file_format, audio[:FS])
+        for settings in CALIBRATION_SETTINGS.get(file_format, [{}]):
+            results.append(measure(file_format, audio, **settings))
+    return results
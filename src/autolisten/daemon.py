@@ -0,0 +1,135 @@
+import json
+import os
+import pathlib
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+from typing import List
+
+from src.autolisten.tools import CONTROL_COMMANDS
+
+# This module runs a recorder as a daemon and controls it through a UNIX domain socket.
+
+# Name of the control socket created in the recording location when none is given.
+CONTROL_SOCKET = ".autolisten.sock"
+# Seconds a client waits for the daemon to answer.
+CONTROL_TIMEOUT = 5
+
+
+class ControlError(Exception):
+    """Raised when a control command cannot be delivered or is rejected by the daemon."""
+
+
+def control_path(location: pathlib.Path) -> pathlib.Path:
+    """Returns the control socket for a location. Directories map to the default socket inside them."""
+    location = pathlib.Path(location)
+    if location.is_dir():
+        return location / CONTROL_SOCKET
+    return location
+
+
+def claim_socket(path: pathlib.Path) -> pathlib.Path:
+    """Removes a stale socket left at `path` by a previous run. Raises ControlError if a recorder still uses it."""
+    path = pathlib.Path(path)
+    if path.is_socket():
+        try:
+            send_command(path, "status")
+        except ControlError:
+            path.unlink()
+        else:
+            raise ControlError(f"A recorder is already listening on {path}")
+    return path
+
+
+def dispatch(recorder, request: dict) -> dict:
+    """Applies a control command to a recorder and returns its status."""
+    command = request.get("command")
+    if command not in CONTROL_COMMANDS:
+        raise ControlError(f"Unknown command {command}")
+    if command == "stop":
+        recorder.stop()
+    elif command == "pause":
+        recorder.pause()
+    elif command == "resume":
+        recorder.resume()
+    elif command == "length":
+        recorder.set_filelen(int(request["value"]))
+    elif command == "profile":
+        if not hasattr(recorder, "toggle_profile"):
+            raise ControlError("profiling is not supported by this recorder")
+        recorder.toggle_profile(request.get("value"))
+    return recorder.status()
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """Handles one JSON command per line and answers with one JSON line."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                response = {"ok": True, "result": self.server.dispatch(request)}
+            except Exception as e:
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Control socket of a running `Recorder`."""
+
+    daemon_threads = True
+
+    def __init__(self, recorder, path: pathlib.Path):
+        """Binds the control socket at `path`, replacing a stale socket left by a previous run."""
+        self.recorder = recorder
+        self.path = claim_socket(path)
+        super().__init__(str(self.path), ControlHandler)
+
+    def dispatch(self, request: dict):
+        """Applies a command to the recorder and returns its status."""
+        return dispatch(self.recorder, request)
+
+    def start(self) -> "ControlServer":
+        """Serves the control socket from a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def server_close(self):
+        super().server_close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def send_command(path: pathlib.Path, command: str, value=None) -> dict:
+    """Sends a command to the recorder listening on `path` and returns its status."""
+    request = {"command": command}
+    if value is not None:
+        request["value"] = value
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CONTROL_TIMEOUT)
+            sock.connect(str(control_path(path)))
+            sock.sendall((json.dumps(request) + "\n").encode())
+            response = json.loads(sock.makefile().readline())
+    except (OSError, ValueError) as e:
+        raise ControlError(f"Could not reach a recorder at {path}: {e}") from e
+    if not response["ok"]:
+        raise ControlError(response["error"])
+    return response["result"]
+
+
+def spawn(argv: List[str]) -> subprocess.Popen:
+    """Starts `autolisten` with the given arguments as a detached process."""
+    return subprocess.Popen(
+        [sys.executable, "-m", "src.autolisten.main", *argv],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        close_fds=True,
+        start_new_session=True,
+        cwd=os.getcwd(),
+    )
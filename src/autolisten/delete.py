@@ -4,6 +4,9 @@ import pathlib
 from os import walk, path
 from typing import List
 
+from src.autolisten.shipper import unshipped
+from src.autolisten.tools import PACK_SUFFIX
+
 # This script will be responsible for the deletion portion of autolisten.
 
 
@@ -38,9 +41,27 @@ def delete_folders(location: pathlib.Path, days: int):
             continue
         else:
             if date_parsed > date:
+                pending = unshipped(path.join(location, directory))
+                if pending:
+                    print(
+                        "Keeping directory {} because {} recordings were not shipped yet".format(
+                            directory, len(pending)
+                        )
+                    )
+                    continue
                 print("Deleting directory {}".format(directory))
                 su.rmtree(path.join(location, directory))
 
+    for pack in get_packs(location):
+        try:
+            date = datetime.strptime(pack[: -len(PACK_SUFFIX)], "%Y-%m-%d")
+        except ValueError:
+            continue
+        if date_parsed > date:
+            # Only days without unshipped recordings are packed, so a pack can always go.
+            print("Deleting pack {}".format(pack))
+            pathlib.Path(location, pack).unlink()
+
 
 def get_dirs(location: pathlib.Path) -> List[str]:
     """Returns all the files in a directory.
@@ -59,5 +80,19 @@ def get_dirs(location: pathlib.Path) -> List[str]:
     return f
 
 
+def get_packs(location: pathlib.Path) -> List[str]:
+    """Returns the packed day directories in a directory.
+
+    Args:
+            location (pathlib.Path): location of the directory
+
+    Returns:
+            List[str]: The names of all the packs in the given location
+    """
+    for (_, _, filenames) in walk(location):
+        return [name for name in filenames if name.endswith(PACK_SUFFIX)]
+    return []
+
+
 if __name__ == "__main__":
     delete_folders("/User/Desktop", 7)
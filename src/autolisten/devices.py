@@ -0,0 +1,215 @@
+import difflib
+import threading
+import time
+import weakref
+from typing import Dict, List, NamedTuple, Tuple, Union
+
+import sounddevice as sd
+
+from src.autolisten.tools import FS
+
+# This module enumerates the audio devices once and resolves device names to PortAudio indices.
+
+# Sample rates checked for every resolved device.
+COMMON_RATES = (8000, 16000, 22050, 32000, 44100, 48000, 88200, 96000)
+# Seconds between two checks of the system sound cards for hot-plugged devices.
+HOTPLUG_INTERVAL = 5
+# Minimum similarity for a device name to be suggested when no name contains the requested one.
+FUZZY_CUTOFF = 0.6
+# File listing the sound cards on Linux. It changes whenever a card is plugged in or removed.
+ASOUND_CARDS = "/proc/asound/cards"
+
+
+class DeviceError(ValueError):
+    """Raised when a device cannot be resolved."""
+
+
+class DeviceInfo(NamedTuple):
+    """Input device resolved by the registry."""
+
+    index: int
+    name: str
+    hostapi: str
+    max_input_channels: int
+    default_samplerate: float
+
+
+def hotplug_signature() -> str:
+    """Returns a value that changes when sound cards are added or removed, or "" when it is unknown."""
+    try:
+        with open(ASOUND_CARDS) as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+class DeviceRegistry:
+    """Cache of the devices known to PortAudio.
+    Devices are enumerated once and names are resolved to indices, so opening a stream never has to
+    scan the host APIs again. The cache is dropped when a stream fails to open or a card is hot-plugged.
+    PortAudio only lists the devices present when it was initialized, so it is restarted as well, as soon
+    as none of the streams opened through the registry is open.
+    """
+
+    def __init__(self):
+        # Reentrant, so a stream is resolved and opened without PortAudio being restarted in between.
+        self.lock = threading.RLock()
+        self.devices: List[dict] = None
+        self.hostapis: List[dict] = None
+        self.resolved: Dict[Union[int, str, None], DeviceInfo] = {}
+        self.rates: Dict[Tuple[int, int], List[int]] = {}
+        self.streams = weakref.WeakSet()
+        self.restart = False
+        self.signature = hotplug_signature()
+        self.checked = time.monotonic()
+
+    def invalidate(self, reinitialize: bool = False) -> bool:
+        """Drops the cached devices. With `reinitialize` PortAudio is restarted to pick up new devices.
+        PortAudio can only be restarted while no stream is open, otherwise the restart waits until the
+        registry is next used with every stream closed. Returns whether PortAudio was restarted.
+        """
+        with self.lock:
+            self.__clear()
+            if reinitialize:
+                self.restart = True
+            return self.__restart()
+
+    def __clear(self):
+        self.devices = None
+        self.hostapis = None
+        self.resolved.clear()
+        self.rates.clear()
+
+    def __restart(self) -> bool:
+        """Restarts PortAudio if a restart is pending and no stream is open. Must hold the lock."""
+        if not self.restart or any(not stream.closed for stream in self.streams):
+            return False
+        sd._terminate()
+        sd._initialize()
+        self.restart = False
+        self.__clear()
+        return True
+
+    def __check_hotplug(self):
+        """Invalidates the cache and restarts PortAudio if the sound cards of the system changed since the last check."""
+        if time.monotonic() - self.checked < HOTPLUG_INTERVAL:
+            return
+        self.checked = time.monotonic()
+        signature = hotplug_signature()
+        if signature != self.signature:
+            self.signature = signature
+            self.invalidate(reinitialize=True)
+
+    def query(self) -> List[dict]:
+        """Returns every device known to PortAudio, enumerating them only when the cache is empty."""
+        self.__check_hotplug()
+        with self.lock:
+            self.__restart()
+            if self.devices is None:
+                self.devices = [dict(device) for device in sd.query_devices()]
+                self.hostapis = [dict(api) for api in sd.query_hostapis()]
+            return self.devices
+
+    def inputs(self) -> List[dict]:
+        """Returns the devices with at least one input channel."""
+        return [d for d in self.query() if d["max_input_channels"] > 0]
+
+    def resolve(self, device: Union[int, str, None] = None) -> DeviceInfo:
+        """Resolves a device index, a full or partial name, or None for the default input device."""
+        if device == -1:
+            device = None
+        self.query()
+        with self.lock:
+            if device in self.resolved:
+                return self.resolved[device]
+        info = self.__find(device)
+        with self.lock:
+            self.resolved[device] = info
+        return info
+
+    def __find(self, device) -> DeviceInfo:
+        devices = self.query()
+        if device is None:
+            index = sd.default.device[0]
+            if index is None or index < 0:
+                index = sd.query_devices(kind="input")["index"]
+            return self.__info(devices[index])
+        if isinstance(device, int):
+            if not 0 <= device < len(devices):
+                raise DeviceError(f"There is no device with index {device}.")
+            return self.__info(devices[device])
+
+        inputs = self.inputs()
+        wanted = device.strip().lower()
+        names = [d["name"].lower() for d in inputs]
+        for d, name in zip(inputs, names):
+            if name == wanted:
+                return self.__info(d)
+        # Devices listed first belong to the default host API, so they win ties.
+        for d, name in zip(inputs, names):
+            if wanted in name:
+                return self.__info(d)
+        # A similar name is only suggested. Recording from it would silently replace an unplugged device.
+        close = difflib.get_close_matches(wanted, names, n=1, cutoff=FUZZY_CUTOFF)
+        suggestion = (
+            f" Did you mean '{inputs[names.index(close[0])]['name']}'?" if close else ""
+        )
+        raise DeviceError(
+            f"No input device matches '{device}'.{suggestion} Use 'autolisten devices --all' to see the available devices."
+        )
+
+    def __info(self, device: dict) -> DeviceInfo:
+        if device["max_input_channels"] < 1:
+            raise DeviceError(f"{device['name']} has no input channels.")
+        return DeviceInfo(
+            device["index"],
+            device["name"],
+            self.hostapis[device["hostapi"]]["name"],
+            device["max_input_channels"],
+            device["default_samplerate"],
+        )
+
+    def supported_rates(
+        self, device: Union[int, str, None], channels: int
+    ) -> List[int]:
+        """Returns the sample rates in `COMMON_RATES` the device accepts for `channels` int32 channels."""
+        info = self.resolve(device)
+        key = (info.index, channels)
+        with self.lock:
+            if key in self.rates:
+                return self.rates[key]
+        rates = []
+        for rate in COMMON_RATES:
+            try:
+                sd.check_input_settings(
+                    device=info.index, channels=channels, dtype="int32", samplerate=rate
+                )
+            except Exception:
+                continue
+            rates.append(rate)
+        with self.lock:
+            self.rates[key] = rates
+        return rates
+
+    def open_stream(self, device: Union[int, str, None], **settings) -> sd.InputStream:
+        """Opens an input stream on a device with `settings`, keeping track of it so PortAudio is never
+        restarted under it."""
+        with self.lock:
+            stream = sd.InputStream(device=self.resolve(device).index, **settings)
+            self.streams.add(stream)
+            return stream
+
+    def check(self, device: Union[int, str, None], channels: int) -> DeviceInfo:
+        """Resolves a device and checks it can record `channels` channels at `FS`."""
+        info = self.resolve(device)
+        if channels > info.max_input_channels:
+            raise DeviceError(
+                f"{info.name} has {info.max_input_channels} input channels, {channels} were requested."
+            )
+        if FS not in self.supported_rates(device, channels):
+            raise DeviceError(f"{info.name} does not support recording at {FS} Hz.")
+        return info
+
+
+# Registry shared by every stream opened in the process.
+REGISTRY = DeviceRegistry()
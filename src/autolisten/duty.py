@@ -0,0 +1,107 @@
+import datetime
+import re
+from typing import List, NamedTuple, Tuple
+
+from src.autolisten.tools import MINUTE
+
+# This module describes when a duty cycled recorder records. Between its windows the recorder closes the
+# input stream and sleeps, so a battery powered board spends most of its time idle.
+
+# Minutes in a day. Duty cycles repeat every day, so their period must divide it.
+DAY_MINUTES = 1440
+# A duty cycle, as in `5/30` for 5 minutes every 30.
+CYCLE = re.compile(r"(\d+)/(\d+)")
+# A daily window, as in `06:00-08:30`.
+WINDOW = re.compile(r"(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})")
+
+
+def seconds_of_day(now: datetime.datetime) -> float:
+    """Returns the seconds passed since local midnight."""
+    return now.hour * 3600 + now.minute * MINUTE + now.second + now.microsecond / 1e6
+
+
+class DutyCycle(NamedTuple):
+    """Records `on` minutes out of every `every`. Windows start on the grid of delayed mode: at multiples of
+    `every` minutes since midnight, so a period dividing 60 starts on the same minutes as `delayed`.
+    """
+
+    on: int
+    every: int
+
+    def remaining(self, now: datetime.datetime) -> float:
+        """Returns the seconds left in the window `now` falls in, or 0 between windows."""
+        position = seconds_of_day(now) % (self.every * MINUTE)
+        return max(0.0, self.on * MINUTE - position)
+
+    def until_next(self, now: datetime.datetime) -> float:
+        """Returns the seconds until the next window starts."""
+        return self.every * MINUTE - seconds_of_day(now) % (self.every * MINUTE)
+
+
+class Windows(NamedTuple):
+    """Records in the same windows every day, each as its first and last minute since midnight.
+    A window ending before it starts runs past midnight."""
+
+    windows: List[Tuple[int, int]]
+
+    def remaining(self, now: datetime.datetime) -> float:
+        """Returns the seconds left in the window `now` falls in, or 0 between windows."""
+        second = seconds_of_day(now)
+        left = 0.0
+        for start, end in self.windows:
+            start, end = start * MINUTE, end * MINUTE
+            if end <= start:
+                end += DAY_MINUTES * MINUTE
+            # A window past midnight also covers the early hours of the day.
+            for offset in (0, DAY_MINUTES * MINUTE):
+                if start <= second + offset < end:
+                    left = max(left, end - second - offset)
+        return left
+
+    def until_next(self, now: datetime.datetime) -> float:
+        """Returns the seconds until the next window starts."""
+        second = seconds_of_day(now)
+        return min(
+            (start * MINUTE - second) % (DAY_MINUTES * MINUTE) or DAY_MINUTES * MINUTE
+            for start, _ in self.windows
+        )
+
+
+def parse_schedule(text: str):
+    """Parses a duty cycle such as `5/30`, or daily windows such as `06:00-08:00,18:30-20:00`.
+    Raises ValueError when the text is neither."""
+    match = CYCLE.fullmatch(text.strip())
+    if match is not None:
+        on, every = int(match.group(1)), int(match.group(2))
+        if not 0 < on < every:
+            raise ValueError(f"{text} must record for less than its period")
+        if DAY_MINUTES % every != 0:
+            raise ValueError(
+                f"The period of {text} must divide the {DAY_MINUTES} minutes of a day"
+            )
+        return DutyCycle(on, every)
+    windows = []
+    for part in text.split(","):
+        match = WINDOW.fullmatch(part.strip())
+        if match is None:
+            raise ValueError(
+                f"{part} is neither a duty cycle such as 5/30 nor a window such as 06:00-08:00"
+            )
+        hour, minute, end_hour, end_minute = (int(group) for group in match.groups())
+        if hour > 23 or end_hour > 24 or minute > 59 or end_minute > 59:
+            raise ValueError(f"{part} is not a time of day")
+        start, end = hour * 60 + minute, end_hour * 60 + end_minute
+        if start == end % DAY_MINUTES:
+            raise ValueError(f"{part} is empty")
+        windows.append((start, end % DAY_MINUTES))
+    return Windows(windows)
+
+
+def format_schedule(schedule) -> str:
+    """Returns the text `parse_schedule` parses into a `DutyCycle` or `Windows`."""
+    if isinstance(schedule, DutyCycle):
+        return f"{schedule.on}/{schedule.every}"
+    return ",".join(
+        f"{start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}"
+        for start, end in schedule.windows
+    )
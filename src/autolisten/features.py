@@ -0,0 +1,175 @@
+import json
+import pathlib
+import threading
+from typing import Dict, List
+
+import numpy as np
+
+from src.autolisten.tools import FS, BLOCKSIZE
+
+# This module computes spectral features from the capture blocks while they are still in memory.
+
+# specifies the number of samples in each analysis frame.
+FFT_SIZE = 2048
+# specifies the number of samples between the start of two analysis frames.
+HOP_SIZE = BLOCKSIZE
+# specifies the number of mel bands stored for every channel.
+MEL_BANDS = 40
+# specifies the number of analysis frames transformed in a single batch.
+BATCH_FRAMES = 64
+
+FEATURE_FILE = "features.f32"
+FEATURE_HEADER = "features.json"
+
+# Full scale of the int32 samples delivered by the input stream.
+INT32_SCALE = float(2**31)
+
+_FILE_LOCKS: Dict[str, threading.Lock] = {}
+_LOCKS_LOCK = threading.Lock()
+
+
+class FeatureError(Exception):
+    """Raised when a feature store does not match the layout of the features being appended."""
+
+
+def hz_to_mel(hz):
+    """Converts a frequency in Hertz to the mel scale."""
+    return 2595.0 * np.log10(1.0 + np.asarray(hz, dtype=np.float64) / 700.0)
+
+
+def mel_to_hz(mel):
+    """Converts a mel scale value to a frequency in Hertz."""
+    return 700.0 * (10.0 ** (np.asarray(mel, dtype=np.float64) / 2595.0) - 1.0)
+
+
+def mel_filterbank(
+    n_fft: int = FFT_SIZE, n_mels: int = MEL_BANDS, samplerate: int = FS
+) -> np.ndarray:
+    """Creates a triangular mel filterbank of shape `(n_mels, n_fft // 2 + 1)`."""
+    bins = np.linspace(0, samplerate / 2, n_fft // 2 + 1)
+    edges = mel_to_hz(np.linspace(0, hz_to_mel(samplerate / 2), n_mels + 2))
+    lower, centre, upper = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+    rising = (bins - lower) / (centre - lower)
+    falling = (upper - bins) / (upper - centre)
+    return np.maximum(0, np.minimum(rising, falling)).astype(np.float32)
+
+
+def to_float(block: np.ndarray) -> np.ndarray:
+    """Converts a block of int32 capture samples to float32 in the range [-1, 1)."""
+    if block.dtype.kind == "f":
+        return block.astype(np.float32, copy=False)
+    return block.astype(np.float32) / INT32_SCALE
+
+
+def feature_dtype(channels: int, n_mels: int = MEL_BANDS) -> np.dtype:
+    """Returns the record layout of a single row of the feature store."""
+    return np.dtype([("time", "<f8"), ("bands", "<f4", (channels, n_mels))])
+
+
+def _file_lock(path: pathlib.Path) -> threading.Lock:
+    """Returns the lock guarding appends to a given feature file."""
+    with _LOCKS_LOCK:
+        return _FILE_LOCKS.setdefault(str(path), threading.Lock())
+
+
+def _write_header(directory: pathlib.Path, channels: int):
+    """Writes the feature header of a day directory, or checks it matches when it already exists."""
+    header = {
+        "channels": channels,
+        "mel_bands": MEL_BANDS,
+        "fft_size": FFT_SIZE,
+        "hop_size": HOP_SIZE,
+        "samplerate": FS,
+        "dtype": feature_dtype(channels).descr,
+    }
+    path = directory / FEATURE_HEADER
+    try:
+        with open(path, "x") as f:
+            json.dump(header, f)
+    except FileExistsError:
+        with open(path) as f:
+            existing = json.load(f)
+        if existing["channels"] != channels or existing["mel_bands"] != MEL_BANDS:
+            raise FeatureError(
+                f"Feature store at {directory} holds {existing['channels']} channels and {existing['mel_bands']} bands."
+            )
+
+
+def load_features(directory: pathlib.Path) -> np.memmap:
+    """Opens the feature store of a day directory as a read only memory map."""
+    directory = pathlib.Path(directory)
+    with open(directory / FEATURE_HEADER) as f:
+        header = json.load(f)
+    dtype = feature_dtype(header["channels"], header["mel_bands"])
+    path = directory / FEATURE_FILE
+    if path.stat().st_size < dtype.itemsize:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+class FeatureExtractor:
+    """Pipeline stage computing log mel band energies per channel from capture blocks.
+    Rows are appended to the feature store of the day directory the segment is recorded in.
+    """
+
+    def __init__(self, directory: pathlib.Path, channels: int, start: float):
+        """Creates a feature extractor for a segment starting at the `start` unix timestamp."""
+        self.directory = pathlib.Path(directory)
+        self.channels = channels
+        self.start = start
+        self.path = self.directory / FEATURE_FILE
+        self.filterbank = mel_filterbank()
+        self.window = np.hanning(FFT_SIZE).astype(np.float32)
+        self.dtype = feature_dtype(channels)
+        self.frames = 0
+        self.pending: List[np.ndarray] = []
+        self.pending_len = 0
+        self.carry = np.zeros((0, channels), dtype=np.float32)
+        _write_header(self.directory, channels)
+
+    def process(self, block: np.ndarray):
+        """Buffers a capture block and computes features once a full batch of frames is available."""
+        self.pending.append(block)
+        self.pending_len += len(block)
+        if len(self.carry) + self.pending_len >= FFT_SIZE + HOP_SIZE * (
+            BATCH_FRAMES - 1
+        ):
+            self.__flush()
+
+    def close(self):
+        """Computes the features of any remaining complete frames."""
+        self.__flush()
+        self.pending = []
+        self.carry = self.carry[:0]
+
+    def __flush(self):
+        """Transforms all complete frames in the buffer and appends them to the feature store."""
+        if not self.pending:
+            return
+        samples = np.concatenate([self.carry] + [to_float(b) for b in self.pending])
+        self.pending = []
+        self.pending_len = 0
+
+        count = (
+            0 if len(samples) < FFT_SIZE else (len(samples) - FFT_SIZE) // HOP_SIZE + 1
+        )
+        if count == 0:
+            self.carry = samples
+            return
+
+        # (frames, channels, FFT_SIZE) view over the buffer without copying.
+        frames = np.lib.stride_tricks.sliding_window_view(samples, FFT_SIZE, axis=0)[
+            : count * HOP_SIZE : HOP_SIZE
+        ]
+        spectrum = np.abs(np.fft.rfft(frames * self.window, axis=-1)) ** 2
+        bands = np.log10(spectrum.astype(np.float32) @ self.filterbank.T + 1e-10)
+
+        rows = np.empty(count, dtype=self.dtype)
+        rows["time"] = self.start + (self.frames + np.arange(count)) * HOP_SIZE / FS
+        rows["bands"] = bands
+        with _file_lock(self.path):
+            with open(self.path, "ab") as f:
+                f.write(rows.tobytes())
+
+        self.frames += count
+        self.carry = samples[count * HOP_SIZE :]
@@ -0,0 +1,207 @@
+import json
+import math
+import pathlib
+import socket
+import socketserver
+import threading
+import time
+
+from src.autolisten.tools import FLEET_PORT
+
+# This module keeps the segments of recorders on many hosts on the same boundaries.
+# A coordinator hands out the segment schedule and its clock over TCP, and collects health and the segment catalog.
+
+# Seconds a node waits for the coordinator to answer.
+FLEET_TIMEOUT = 5
+# Number of round trips used to estimate the clock offset. The one with the shortest round trip is kept.
+SYNC_ROUNDS = 5
+# Seconds without a report after which a node counts as missing.
+NODE_TIMEOUT = 120
+# Name of the file the coordinator appends the segment catalog to.
+CATALOG_FILE = "catalog.jsonl"
+
+
+class FleetError(Exception):
+    """Raised when the coordinator cannot be reached or rejects a request."""
+
+
+def parse_address(address: str, default_port: int = FLEET_PORT):
+    """Parses `host:port`, `host` or `:port` into a (host, port) tuple."""
+    host, _, port = address.rpartition(":") if ":" in address else (address, "", "")
+    return host or "localhost", int(port) if port else default_port
+
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    """Handles one JSON request per line and answers with one JSON line."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = {
+                    "ok": True,
+                    "result": self.server.dispatch(json.loads(line)),
+                }
+            except Exception as e:
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+
+
+class Coordinator(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Fleet coordinator.
+    Segments start every `period` seconds counted from `epoch` on the clock of the coordinator.
+    Nodes measure their offset to that clock, report their health and publish every finished segment.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self,
+        address=("", FLEET_PORT),
+        period: int = 1800,
+        epoch: float = 0.0,
+        location: pathlib.Path = None,
+    ):
+        """Listens on `address`. The catalog is appended to `location` when it is given."""
+        assert period > 0, "The period must be greater than 0"
+        self.period = period
+        self.epoch = epoch
+        self.nodes = {}
+        self.catalog = []
+        self.catalog_file = (
+            pathlib.Path(location) / CATALOG_FILE if location is not None else None
+        )
+        self.lock = threading.Lock()
+        super().__init__(address, CoordinatorHandler)
+
+    def dispatch(self, request: dict):
+        """Answers a request from a node."""
+        command = request.get("command")
+        if command == "time":
+            return {"time": time.time()}
+        if command == "schedule":
+            return {"period": self.period, "epoch": self.epoch}
+        if command == "health":
+            with self.lock:
+                self.nodes[request["node"]] = {
+                    **request["status"],
+                    "seen": time.time(),
+                }
+            return {"period": self.period, "epoch": self.epoch}
+        if command == "segment":
+            entry = {**request["segment"], "node": request["node"]}
+            with self.lock:
+                self.catalog.append(entry)
+                if self.catalog_file is not None:
+                    with open(self.catalog_file, "a") as f:
+                        f.write(json.dumps(entry) + "\n")
+            return {"segments": len(self.catalog)}
+        if command == "nodes":
+            now = time.time()
+            with self.lock:
+                return {
+                    node: {**health, "missing": now - health["seen"] > NODE_TIMEOUT}
+                    for node, health in self.nodes.items()
+                }
+        if command == "catalog":
+            with self.lock:
+                return self.catalog[request.get("since", 0) :]
+        raise FleetError(f"Unknown command {command}")
+
+    def start(self) -> "Coordinator":
+        """Serves the coordinator from a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class FleetClient:
+    """Connection of a recorder to the coordinator."""
+
+    def __init__(self, address: str, node: str = None):
+        """Connects to the coordinator at `host:port` as `node`, which defaults to the host name."""
+        self.address = parse_address(address)
+        self.node = node if node else socket.gethostname()
+        self.offset = 0.0
+        self.period = None
+        self.epoch = 0.0
+        self.lock = threading.Lock()
+        self.sock = None
+        self.file = None
+
+    def request(self, command: str, **fields) -> dict:
+        """Sends a request to the coordinator and returns its answer. Reconnects once if the connection dropped."""
+        data = (json.dumps({"command": command, **fields}) + "\n").encode()
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.sock = socket.create_connection(
+                            self.address, timeout=FLEET_TIMEOUT
+                        )
+                        self.file = self.sock.makefile("rb")
+                    self.sock.sendall(data)
+                    line = self.file.readline()
+                    if not line:
+                        raise ConnectionError("The coordinator closed the connection")
+                    response = json.loads(line)
+                    break
+                except (OSError, ValueError) as e:
+                    self.close()
+                    if attempt:
+                        raise FleetError(
+                            f"Could not reach the coordinator at {self.address[0]}:{self.address[1]}: {e}"
+                        ) from e
+        if not response["ok"]:
+            raise FleetError(response["error"])
+        return response["result"]
+
+    def sync(self) -> float:
+        """Fetches the schedule and measures the offset of the coordinator clock. Returns the offset in seconds."""
+        best = None
+        for _ in range(SYNC_ROUNDS):
+            sent = time.time()
+            remote = self.request("time")["time"]
+            received = time.time()
+            if best is None or received - sent < best[0]:
+                # The coordinator read its clock halfway through the round trip.
+                best = (received - sent, remote - (sent + received) / 2)
+        schedule = self.request("schedule")
+        self.offset = best[1]
+        self.period = schedule["period"]
+        self.epoch = schedule["epoch"]
+        return self.offset
+
+    def now(self) -> float:
+        """Returns the time on the coordinator clock."""
+        return time.time() + self.offset
+
+    def until_boundary(self, minimum: float = 0.0) -> float:
+        """Returns the seconds until the next segment boundary of the schedule at least `minimum` seconds away."""
+        now = self.now()
+        boundary = (
+            self.epoch + math.floor((now - self.epoch) / self.period + 1) * self.period
+        )
+        while boundary - now < minimum:
+            boundary += self.period
+        return boundary - now
+
+    def report(self, status: dict):
+        """Sends the health of the recorder to the coordinator and picks up a changed schedule."""
+        schedule = self.request(
+            "health",
+            node=self.node,
+            status={**status, "clock_offset": self.offset},
+        )
+        self.period = schedule["period"]
+        self.epoch = schedule["epoch"]
+
+    def publish(self, segment: dict):
+        """Adds a finished segment to the catalog of the coordinator."""
+        self.request("segment", node=self.node, segment=segment)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.file.close()
+        self.sock = None
+        self.file = None
@@ -1,11 +1,20 @@
 import argparse
+import os
 import pathlib
 
 import sys
-import subprocess
-import sounddevice as sd
 
-from .recorder import Recorder
+# Heavy dependencies (PortAudio, libsndfile and NumPy) are imported by the commands that need them.
+from .tools import (
+    FORMATS,
+    CONTROL_COMMANDS,
+    SHUTDOWN_TIMEOUT,
+    FLEET_PORT,
+    TAP_PORT,
+    ARCHIVE_PORT,
+    MAX_QUALITY,
+    MAX_COMPLEXITY,
+)
 
 
 class MyParser(argparse.ArgumentParser):
@@ -28,19 +37,36 @@ def main():
     run_parsers(main_parser)
     test_parsers(main_parser)
     delete_parser(main_parser)
+    control_parser(main_parser)
+    coordinator_parser(main_parser)
+    ship_parser(main_parser)
+    verify_parser(main_parser)
+    calibrate_parser(main_parser)
+    serve_parser(main_parser)
+    replay_parser(main_parser)
+    merge_parser(main_parser)
+    pack_parser(main_parser)
+    plan_parser(main_parser)
 
     args = parser.parse_args()
 
     if args.command == "devices":
+        import sounddevice as sd
+
         if args.all:
             print(sd.query_devices())
         elif args.input:
             print(sd.query_devices(kind="input"))
         elif args.output:
             print(sd.query_devices(kind="output"))
-        elif args.device != "":
-            print(args.device)
-            print(sd.query_devices(args.device))
+        elif args.device:
+            from .devices import REGISTRY
+
+            device = int(args.device) if args.device.isdigit() else args.device
+            info = REGISTRY.resolve(device)
+            print(sd.query_devices(info.index))
+            rates = REGISTRY.supported_rates(info.index, 1)
+            print("Supported sample rates:", ", ".join(str(rate) for rate in rates))
         else:
             device_parser.print_help()
 
@@ -67,31 +93,208 @@ def main():
         else:
             device = None
 
+        if args.processes and (args.background or args.control is not None):
+            # A background recording could only be stopped with a signal.
+            sys.stderr.write(
+                "error: -mp has no control socket, so it cannot run with -b or -cs\n"
+            )
+            sys.exit(1)
+        if args.tee:
+            from .sinks import clashing
+
+            if clashing(args.tee):
+                sys.stderr.write(
+                    "error: two tees write the same file, give them different names\n"
+                )
+                sys.exit(1)
+        if args.processes and args.fallback_device is not None:
+            sys.stderr.write(
+                "WARNING: -mp does not recover from device failures and will ignore the fallback device.\n"
+            )
+
+        if args.plan_check:
+            from .planner import CHECK_SECONDS, plan
+
+            result = plan(
+                args.location,
+                args.channels,
+                args.format,
+                filelen=delay * 60 if delay else length * 60 if long_record else length,
+                retention=args.delete,
+                quality=args.quality,
+                complexity=args.complexity,
+                max_writers=args.writers,
+                seconds=CHECK_SECONDS,
+            )
+            print_plan(result)
+            if result["problems"]:
+                sys.exit(1)
+
         if args.background:
-            p = subprocess.Popen(
-                f"{sys.executable} -c \"from src.autolisten.recorder import Recorder; Recorder(r'{args.location}', {args.timeout}, {args.delete}, {length}, {args.verbose}, {args.channels}, {args.background}, {long_record}, {device}, {delay}, {closest}).record()\"",
-                shell=True,
-                close_fds=True,
+            from .daemon import spawn
+
+            # The detached child runs the same command in the foreground with a control socket.
+            # The check already ran, so the child skips it.
+            argv = command_line(
+                main_parser.choices[args.command], args, ("background", "plan_check")
             )
+            p = spawn([args.command] + argv + ["--daemon"])
             print(
                 "AutoListen is now runnning as a background process with process id:",
                 p.pid,
             )
         else:
 
-            rec = Recorder(
-                args.location,
-                args.timeout,
-                args.delete,
-                length,
-                args.verbose,
-                args.channels,
-                long_recording=long_record,
-                sound_device=device,
-                delay=delay,
-                closest=closest,
-            )
-            rec.record()
+            control = args.control
+            if control is None and args.daemon:
+                from .daemon import control_path
+
+                control = control_path(args.location)
+
+            shipper = None
+            if args.ship is not None:
+                shipper = make_shipper(args)
+                # Recordings left over by an earlier run are shipped first.
+                shipper.scan()
+                shipper.start()
+
+            tap = None
+            if args.tap is not None:
+                from .fleet import parse_address
+                from .tap import TapServer
+
+                tap = TapServer(
+                    parse_address(args.tap, TAP_PORT), args.channels
+                ).start()
+
+            if args.tee and (args.async_core or args.processes):
+                sys.stderr.write(
+                    "WARNING: Tees are only written by the default recorder and will be ignored.\n"
+                )
+            if args.schedule and (args.async_core or args.processes):
+                sys.stderr.write(
+                    "WARNING: Schedules are only followed by the default recorder and will be ignored.\n"
+                )
+            if args.profile and (args.async_core or args.processes):
+                sys.stderr.write(
+                    "WARNING: Only the default recorder can be profiled. The profile will be ignored.\n"
+                )
+
+            if args.async_core:
+                from .asyncrecorder import AsyncRecorder
+
+                rec = AsyncRecorder(
+                    args.location,
+                    args.timeout,
+                    args.delete,
+                    length,
+                    args.verbose,
+                    args.channels,
+                    background=args.daemon,
+                    long_recording=long_record,
+                    sound_device=device,
+                    delay=delay,
+                    closest=closest,
+                    features=args.features,
+                    file_format=args.format,
+                    control=control,
+                    shutdown_timeout=args.shutdown_timeout,
+                    max_writers=args.writers,
+                    shipper=shipper,
+                    quality=args.quality,
+                    complexity=args.complexity,
+                    tap=tap,
+                )
+                try:
+                    rec.record()
+                finally:
+                    if shipper is not None:
+                        shipper.stop()
+                    if tap is not None:
+                        tap.shutdown()
+                        tap.server_close()
+            elif args.processes:
+                from .processrecorder import ProcessRecorder
+
+                rec = ProcessRecorder(
+                    args.location,
+                    args.timeout,
+                    args.delete,
+                    length,
+                    args.verbose,
+                    args.channels,
+                    background=args.daemon,
+                    long_recording=long_record,
+                    sound_device=device,
+                    delay=delay,
+                    closest=closest,
+                    features=args.features,
+                    file_format=args.format,
+                    shutdown_timeout=args.shutdown_timeout,
+                    shipper=shipper,
+                    quality=args.quality,
+                    complexity=args.complexity,
+                    tap=tap,
+                )
+                try:
+                    rec.record()
+                finally:
+                    if shipper is not None:
+                        shipper.stop()
+                    if tap is not None:
+                        tap.shutdown()
+                        tap.server_close()
+            else:
+                from .recorder import Recorder, ThreadExit
+
+                rec = Recorder(
+                    args.location,
+                    args.timeout,
+                    args.delete,
+                    length,
+                    args.verbose,
+                    args.channels,
+                    background=args.daemon,
+                    long_recording=long_record,
+                    sound_device=device,
+                    delay=delay,
+                    closest=closest,
+                    features=args.features,
+                    file_format=args.format,
+                    seek_table=args.seek_table,
+                    shutdown_timeout=args.shutdown_timeout,
+                    max_writers=args.writers,
+                    degrade=not args.keep_format,
+                    fallback_device=args.fallback_device,
+                    coordinator=args.coordinator,
+                    node=args.node,
+                    shipper=shipper,
+                    quality=args.quality,
+                    complexity=args.complexity,
+                    tees=args.tee,
+                    tap=tap,
+                    schedule=args.schedule,
+                    profile=args.profile,
+                )
+                server = None
+                if control is not None:
+                    from .daemon import ControlServer
+
+                    server = ControlServer(rec, control).start()
+                try:
+                    rec.record()
+                except ThreadExit as e:
+                    # Writer threads that missed the deadline would otherwise keep the process alive.
+                    os._exit(e.code)
+                finally:
+                    if server is not None:
+                        server.shutdown()
+                        server.server_close()
+                    if shipper is not None:
+                        shipper.stop()
+                    if tap is not None:
+                        tap.shutdown()
+                        tap.server_close()
 
     elif args.command == "delete":
         import src.autolisten.delete as delete
@@ -112,18 +315,217 @@ def main():
             suite = unittest.TestLoader().loadTestsFromTestCase(tests.TestDelayTimer)
         elif args.deletion:
             suite = unittest.TestLoader().loadTestsFromTestCase(tests.TestDeletion)
+        elif args.startup:
+            suite = unittest.TestLoader().loadTestsFromTestCase(tests.TestStartup)
         else:
             suite = unittest.TestLoader().loadTestsFromModule(tests)
 
         runner = unittest.TextTestRunner(verbosity=2)
         runner.run(suite)
 
-    elif args.command == None:
-        parser.print_help()
+    elif args.command == "control":
+        import json
+        from .daemon import send_command, ControlError
 
+        try:
+            print(json.dumps(send_command(args.socket, args.action, args.value)))
+        except ControlError as e:
+            sys.stderr.write("error: %s\n" % e)
+            sys.exit(1)
 
-if __name__ == "__main__":
-    main()
+    elif args.command == "coordinator":
+        import json
+        from .fleet import Coordinator, FleetClient, FleetError
+
+        if args.query:
+            try:
+                client = FleetClient(f"{args.host}:{args.port}")
+                print(json.dumps(client.request(args.query)))
+            except FleetError as e:
+                sys.stderr.write("error: %s\n" % e)
+                sys.exit(1)
+        else:
+            server = Coordinator(
+                (args.host, args.port), args.length, args.epoch, args.location
+            )
+            print(
+                f"Coordinating segments of {args.length} seconds on port {args.port}."
+            )
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+
+    elif args.command == "ship":
+        import json
+        import time
+
+        shipper = make_shipper(args)
+        try:
+            while True:
+                queued = shipper.scan()
+                print(f"Shipping {queued} files from {args.location} to {args.ship}.")
+                # The marker ends the run once the queued files are shipped.
+                shipper.queue.put(None)
+                shipper.run()
+                if not args.watch:
+                    break
+                time.sleep(args.watch)
+        except KeyboardInterrupt:
+            pass
+        print(json.dumps(shipper.status()))
+
+    elif args.command == "verify":
+        from .manifest import verify_tree
+
+        result = verify_tree(args.location, args.workers)
+        for path in result["unlisted"]:
+            sys.stderr.write(f"WARNING: {path} has no checksum in its manifest.\n")
+        for path, problem in result["problems"].items():
+            sys.stderr.write(f"ERROR: {path}: {problem}.\n")
+        print(
+            f"Checked {result['checked']} files ({result['bytes'] / 1e9:.1f} GB), {len(result['problems'])} failed."
+        )
+        if result["problems"]:
+            sys.exit(1)
+
+    elif args.command == "serve":
+        from .archive import ArchiveServer
+
+        server = ArchiveServer(
+            args.location,
+            (args.host, args.port),
+            args.cache * 1024 * 1024,
+            args.verbose,
+        )
+        print(
+            f"Serving {args.location} at http://{args.host}:{args.port}/. Clips are at /clip?start=<time>&duration=<seconds>."
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    elif args.command == "replay":
+        from .replay import replay
+
+        def report(result: dict):
+            if result.get("skipped"):
+                print(f"{result['day']}: already processed, skipped.")
+                return
+            for name, error in result["errors"].items():
+                sys.stderr.write(f"ERROR: {name}: {error}\n")
+            print(
+                f"{result['day']}: replayed {result['files']} files, {result['seconds'] / 3600:.1f} hours."
+            )
+
+        try:
+            total = replay(
+                args.location,
+                args.stages,
+                args.days,
+                args.workers,
+                args.overwrite,
+                report,
+            )
+        except AssertionError as e:
+            sys.stderr.write("error: %s\n" % e)
+            sys.exit(1)
+        print(
+            f"Replayed {total['files']} files of {total['days'] - total['skipped']} days in {total['elapsed']:.0f} seconds, {total['speed']:.0f} times faster than realtime."
+        )
+        if total["errors"]:
+            sys.exit(1)
+
+    elif args.command == "merge":
+        from .merge import merge
+
+        result = merge(
+            args.location,
+            args.days,
+            args.per,
+            args.output,
+            args.format,
+            args.tolerance,
+            lambda filename: print(f"Merged {filename}"),
+            args.chain,
+        )
+        for before, after, gap in result["gaps"]:
+            sys.stderr.write(
+                f"WARNING: {after} starts {gap:.1f} seconds {'after the end of' if gap > 0 else 'before the end of'} {before}.\n"
+            )
+        for name, error in result["errors"].items():
+            sys.stderr.write(f"ERROR: {name}: {error}.\n")
+        print(f"Merged {result['segments']} segments into {result['files']} files.")
+        if result["errors"]:
+            sys.exit(1)
+
+    elif args.command == "pack":
+        from .pack import PACK_SUFFIX, PackError, PackFile, pack_old, unpack_day
+
+        try:
+            if args.extract is None:
+                for pack in pack_old(args.location, args.older_than):
+                    print(f"Packed {pack}")
+            elif args.member:
+                packed = PackFile(args.location / (args.extract + PACK_SUFFIX))
+                for name in args.member:
+                    print(f"Extracted {packed.extract(name, args.output)}")
+            else:
+                directory = unpack_day(args.location / (args.extract + PACK_SUFFIX))
+                print(f"Unpacked {directory}")
+        except (PackError, OSError) as e:
+            sys.stderr.write("error: %s\n" % e)
+            sys.exit(1)
+
+    elif args.command == "plan":
+        from .planner import plan
+
+        try:
+            result = plan(
+                args.location,
+                args.channels,
+                args.format,
+                args.samplerate,
+                args.length,
+                args.delete,
+                args.quality,
+                args.complexity,
+                args.writers,
+                args.seconds,
+            )
+        except AssertionError as e:
+            sys.stderr.write("error: %s\n" % e)
+            sys.exit(1)
+        print_plan(result)
+        if result["problems"]:
+            sys.exit(1)
+
+    elif args.command == "calibrate":
+        from .calibrate import calibrate
+        from .scheduler import HEADROOM
+
+        print(f"{'Format':<8}{'Setting':<16}{'Realtime factor':>16}{'kB/s':>10}")
+        for result in calibrate(args.format, args.channels, args.seconds):
+            if result["quality"] is not None:
+                setting = f"quality {result['quality']:g}"
+            elif result["complexity"] is not None:
+                setting = f"complexity {result['complexity']}"
+            else:
+                setting = "default"
+            print(
+                f"{result['format']:<8}{setting:<16}{result['realtime_factor']:>16.4f}{result['bytes_per_second'] / 1000:>10.1f}"
+            )
+        print(
+            f"A setting keeps up while its realtime factor stays below {HEADROOM} for every writer thread but one."
+        )
+
+    elif args.command == None:
+        parser.print_help()
 
 def delete_parser(parser: argparse._SubParsersAction):
     """Parses the delete programs arguments"""
@@ -145,6 +547,78 @@ def delete_parser(parser: argparse._SubParsersAction):
     )
 
 
+def command_line(
+    parser: argparse.ArgumentParser, args: argparse.Namespace, skip=()
+) -> list:
+    """Returns the arguments `parser` parses into `args`, leaving out the destinations in `skip`.
+    Options are given by their long names with the value attached, so values starting with a dash stay values.
+    """
+
+    def text(action: argparse.Action, value) -> str:
+        if action.type is sink_type:
+            from .sinks import format_sink
+
+            return format_sink(value)
+        if action.type is schedule_type:
+            from .duty import format_schedule
+
+            return format_schedule(value)
+        return str(value)
+
+    positionals = []
+    options = []
+    for action in parser._actions:
+        if action.dest in skip or isinstance(action, argparse._HelpAction):
+            continue
+        value = getattr(args, action.dest)
+        if not action.option_strings:
+            positionals.append(text(action, value))
+        elif value != action.default:
+            flag = action.option_strings[-1]
+            if action.nargs == 0:
+                options.append(flag)
+            elif isinstance(action, argparse._AppendAction):
+                options.extend(f"{flag}={text(action, item)}" for item in value)
+            else:
+                options.append(f"{flag}={text(action, value)}")
+    return positionals + options
+
+
+def sink_type(text: str):
+    """Parses the value of `--tee` into a `Sink`."""
+    from .sinks import parse_sink
+
+    try:
+        return parse_sink(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def schedule_type(text: str):
+    """Parses the value of `--schedule` into a `DutyCycle` or `Windows`."""
+    from .duty import parse_schedule
+
+    try:
+        return parse_schedule(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def profile_type(text: str) -> float:
+    """Parses the value of `--profile` into the seconds to profile."""
+    from .profiler import MAX_PROFILE_SECONDS
+
+    try:
+        seconds = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{text} is not a number of seconds")
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise argparse.ArgumentTypeError(
+            f"The profile must last between 0 and {MAX_PROFILE_SECONDS} seconds"
+        )
+    return seconds
+
+
 def run_parsers(parser: argparse._SubParsersAction):
     """Parses main programs arguments"""
 
@@ -230,6 +704,122 @@ def run_parsers(parser: argparse._SubParsersAction):
             default=2,
         )
 
+        _parser.add_argument(
+            "-f",
+            "--features",
+            help="Specify to compute mel band energies during capture and store them in each day directory.",
+            action="store_true",
+        )
+
+        _parser.add_argument(
+            "-fm",
+            "--format",
+            help="Specify the output format of the recordings. Default is OGG.",
+            metavar="",
+            choices=list(FORMATS),
+            default="OGG",
+        )
+        _parser.add_argument(
+            "-qu",
+            "--quality",
+            help=f"Specify the Vorbis quality of OGG recordings from 0 to {MAX_QUALITY}. Lower quality is cheaper to encode.",
+            type=float,
+            metavar="",
+        )
+        _parser.add_argument(
+            "-cx",
+            "--complexity",
+            help=f"Specify the compression level of FLAC recordings from 0 to {MAX_COMPLEXITY}. Lower levels are cheaper to encode.",
+            type=int,
+            metavar="",
+        )
+        _parser.add_argument(
+            "-te",
+            "--tee",
+            help="Specify a further file to encode from the same capture as FORMAT[:name=,rate=,channels=,quality=,complexity=], such as OGG:name=preview,rate=22050,channels=0. Can be repeated.",
+            type=sink_type,
+            action="append",
+            metavar="",
+        )
+        _parser.add_argument(
+            "-st",
+            "--seek_table",
+            help="Specify to write a seek table next to each OGG recording for fast random access.",
+            action="store_true",
+        )
+
+        _parser.add_argument(
+            "-w",
+            "--writers",
+            help="Specify the number of threads writing files. Defaults to one per core plus one.",
+            type=int,
+            metavar="",
+        )
+        _parser.add_argument(
+            "-kf",
+            "--keep_format",
+            help="Specify to keep the chosen format even when writing files falls behind instead of switching to a cheaper one.",
+            action="store_true",
+        )
+        _parser.add_argument(
+            "-ac",
+            "--async_core",
+            help="Specify to record with a single input stream driven by asyncio instead of one stream per file.",
+            action="store_true",
+        )
+        _parser.add_argument(
+            "-mp",
+            "--processes",
+            help="Specify to capture in a process of its own that shares the audio with encoder and analysis processes through shared memory.",
+            action="store_true",
+        )
+        _parser.add_argument(
+            "-pc",
+            "--plan_check",
+            help="Specify to measure this computer before recording and refuse to start when it cannot keep up with the format, channels and retention given, like 'autolisten plan'.",
+            action="store_true",
+        )
+        _parser.add_argument(
+            "-pf",
+            "--profile",
+            help="Specify to profile every thread for this many seconds once recording starts, 60 if no value is given. Collapsed stacks for flamegraphs and pstats files are written to a profile directory next to auto.log. 'autolisten control ... profile' starts or stops a profile at runtime.",
+            type=profile_type,
+            nargs="?",
+            const=60,
+            metavar="",
+        )
+        _parser.add_argument(
+            "-sc",
+            "--schedule",
+            help="Specify to record only in windows, either a duty cycle such as 5/30 for 5 minutes every 30 starting on the same grid as delayed mode, or daily windows such as 06:00-08:00,18:00-20:00. Between windows the input stream is closed and the recorder sleeps.",
+            type=schedule_type,
+            metavar="",
+        )
+        _parser.add_argument(
+            "-tp",
+            "--tap",
+            help=f"Specify to stream the live capture over TCP on host:port, :port or host. Defaults to localhost:{TAP_PORT}. Listeners that fall behind lose blocks instead of slowing the recording.",
+            nargs="?",
+            const="localhost",
+            metavar="",
+        )
+        _parser.add_argument(
+            "-cs",
+            "--control",
+            help="Specify the path of a UNIX socket to control the recording with 'autolisten control'. Background recordings default to a socket in the location.",
+            type=pathlib.Path,
+            metavar="",
+        )
+        _parser.add_argument("--daemon", help=argparse.SUPPRESS, action="store_true")
+        _parser.add_argument(
+            "-sd",
+            "--shutdown_timeout",
+            help=f"Specify how many seconds to wait for the current files to be finished when stopped. Default is {SHUTDOWN_TIMEOUT}.",
+            type=int,
+            metavar="",
+            default=SHUTDOWN_TIMEOUT,
+        )
+
         if _parser == no_delay_parser:
             _parser.add_argument(
                 "-lr",
@@ -254,6 +844,32 @@ def run_parsers(parser: argparse._SubParsersAction):
             type=str,
             metavar="",
         )
+        _parser.add_argument(
+            "-fd",
+            "--fallback_device",
+            help="Specify the device index or name to record from when the chosen device keeps failing.",
+            type=lambda device: int(device) if device.isdigit() else device,
+            metavar="",
+        )
+        _parser.add_argument(
+            "-co",
+            "--coordinator",
+            help="Specify the host:port of a fleet coordinator to take the segment schedule and clock from.",
+            metavar="",
+        )
+        _parser.add_argument(
+            "-nn",
+            "--node",
+            help="Specify the name reported to the fleet coordinator. Defaults to the host name.",
+            metavar="",
+        )
+        _parser.add_argument(
+            "-sh",
+            "--ship",
+            help="Specify a directory or s3://bucket/prefix to copy every finished file to.",
+            metavar="",
+        )
+        ship_arguments(_parser)
 
     return _parser
 
@@ -286,7 +902,7 @@ def device_parsers(main_parser: argparse._SubParsersAction):
     device_parser.add_argument(
         "-d",
         "--device",
-        help="Specify the device name with a substring/string.",
+        help="Specify the device index, its name or a close match of its name.",
         type=str,
         metavar="",
     )
@@ -324,4 +940,494 @@ def test_parsers(main_parser: argparse._SubParsersAction):
         help="Run the deletion test suite",
         action="store_true",
     )
+    test_parser.add_argument(
+        "-su",
+        "--startup",
+        help="Run the startup time test suite",
+        action="store_true",
+    )
     return test_parser
+
+
+def control_parser(main_parser: argparse._SubParsersAction):
+    """Parses control socket arguments"""
+    control = main_parser.add_parser(
+        "control", help="Controls a recording running in the background."
+    )
+    control.add_argument(
+        "socket",
+        type=pathlib.Path,
+        help="The control socket of the recording, or the location it records to.",
+    )
+    control.add_argument(
+        "action",
+        choices=CONTROL_COMMANDS,
+        help="status, stop (finishes the current file), pause, resume, length to change the file length, or profile to start or stop profiling every thread.",
+    )
+    control.add_argument(
+        "value",
+        type=int,
+        nargs="?",
+        help="The new file length in seconds when using length, or the seconds to profile when using profile.",
+    )
+    return control
+
+
+def print_plan(result: dict):
+    """Prints the predictions of `planner.plan`, then its warnings and problems."""
+    print(
+        f"Encoding {result['channels']} channels at {result['samplerate']} Hz as {result['format']} takes {result['realtime_factor']:.4f} seconds per second of audio, {result['cpu_load'] * 100:.1f}% of {result['cores']} core{'' if result['cores'] == 1 else 's'}."
+    )
+    print(
+        f"{result['writers']} writers sustain a realtime factor up to {result['capacity']:.2f}."
+    )
+    print(
+        f"Recordings take {result['bytes_per_second'] / 1000:.1f} kB/s of the {result['disk_bytes_per_second'] / 1e6:.1f} MB/s the disk writes, {result['bytes_per_day'] / 1e9:.2f} GB per day."
+    )
+    if "retained_bytes" in result:
+        print(
+            f"Retention keeps {result['retained_bytes'] / 1e9:.2f} GB of the {result['free_bytes'] / 1e9:.2f} GB free."
+        )
+    else:
+        print(
+            f"The {result['free_bytes'] / 1e9:.2f} GB free last {result['days_until_full']:.1f} days."
+        )
+    print(
+        f"Memory peaks at about {result['peak_memory'] / 1e6:.0f} MB, {result['writers_in_flight']} writers holding a {result['segment_bytes'] / 1e6:.0f} MB file each."
+    )
+    for warning in result["warnings"]:
+        sys.stderr.write(f"WARNING: {warning}.\n")
+    for problem in result["problems"]:
+        sys.stderr.write(f"ERROR: {problem}.\n")
+
+
+def make_shipper(args: argparse.Namespace):
+    """Creates the shipper configured by the shipping arguments."""
+    from .shipper import Shipper, open_backend
+
+    return Shipper(
+        args.location,
+        open_backend(args.ship, args.endpoint),
+        args.transfers,
+        args.bandwidth * 1024 if args.bandwidth else None,
+        args.delete_after_ship,
+    )
+
+
+def ship_arguments(parser: argparse.ArgumentParser):
+    """Adds the arguments shared by recordings that ship their files and the ship command."""
+    parser.add_argument(
+        "-sx",
+        "--transfers",
+        help="Specify the number of parts of a file sent at the same time. Default is 4.",
+        type=int,
+        default=4,
+        metavar="",
+    )
+    parser.add_argument(
+        "-sb",
+        "--bandwidth",
+        help="Specify the most kilobytes per second used for shipping files.",
+        type=int,
+        metavar="",
+    )
+    parser.add_argument(
+        "-da",
+        "--delete_after_ship",
+        help="Specify to delete files once their shipped copy is verified.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-ep",
+        "--endpoint",
+        help="Specify the endpoint URL of an S3 compatible service.",
+        metavar="",
+    )
+
+
+def ship_parser(main_parser: argparse._SubParsersAction):
+    """Parses the ship command arguments"""
+    ship = main_parser.add_parser(
+        "ship",
+        help="Copies the finished recordings of a location to a directory or bucket.",
+    )
+    ship.add_argument("location", type=pathlib.Path, help="The recordings location.")
+    ship.add_argument(
+        "ship", help="The directory or s3://bucket/prefix to copy the files to."
+    )
+    ship.add_argument(
+        "-wt",
+        "--watch",
+        help="Specify to keep shipping new files, looking for them every given number of seconds.",
+        type=int,
+        metavar="",
+    )
+    ship_arguments(ship)
+    return ship
+
+
+def verify_parser(main_parser: argparse._SubParsersAction):
+    """Parses the verify command arguments"""
+    verify = main_parser.add_parser(
+        "verify",
+        help="Checks the recordings of a location against the checksums in their manifests.",
+    )
+    verify.add_argument(
+        "location", type=pathlib.Path, help="The recordings location to check."
+    )
+    verify.add_argument(
+        "-w",
+        "--workers",
+        help="Specify the number of files checked at the same time. Default is 4.",
+        type=int,
+        default=4,
+        metavar="",
+    )
+    return verify
+
+
+def calibrate_parser(main_parser: argparse._SubParsersAction):
+    """Parses the calibrate command arguments"""
+    calibrate = main_parser.add_parser(
+        "calibrate",
+        help="Measures how fast this computer encodes each format and setting with synthetic audio.",
+    )
+    calibrate.add_argument(
+        "-fm",
+        "--format",
+        help="Specify the formats to measure. Default is OGG, FLAC and WAV.",
+        nargs="+",
+        metavar="",
+        choices=list(FORMATS),
+    )
+    calibrate.add_argument(
+        "-c",
+        "--channels",
+        help="Specify the number of channels of the synthetic audio. Default is 2",
+        type=int,
+        metavar="",
+        default=2,
+    )
+    calibrate.add_argument(
+        "-s",
+        "--seconds",
+        help="Specify the seconds of audio encoded for every setting. Default is 10.",
+        type=float,
+        metavar="",
+        default=10,
+    )
+    return calibrate
+
+
+def merge_parser(main_parser: argparse._SubParsersAction):
+    """Parses merge arguments"""
+    merge = main_parser.add_parser(
+        "merge",
+        help="Merges the consecutive segments of each day into one file per day or per hour.",
+    )
+    merge.add_argument(
+        "location", type=pathlib.Path, help="The recordings location to merge."
+    )
+    merge.add_argument(
+        "-dy",
+        "--days",
+        help="Specify the day directories to merge, such as 2024-05-01. Default is every day.",
+        nargs="+",
+        metavar="",
+    )
+    merge.add_argument(
+        "-pr",
+        "--per",
+        help="Specify whether to merge into one file per day or per hour. Default is day.",
+        choices=("day", "hour"),
+        default="day",
+        metavar="",
+    )
+    merge.add_argument(
+        "-o",
+        "--output",
+        help="Specify the directory to write the merged files to, in a directory per day. Default is a merged directory inside each day.",
+        type=pathlib.Path,
+        metavar="",
+    )
+    merge.add_argument(
+        "-fm",
+        "--format",
+        help="Specify the format of the merged files. Defaults to the format of the segments. FLAC merges OGG segments without further loss.",
+        choices=list(FORMATS),
+        metavar="",
+    )
+    merge.add_argument(
+        "-tl",
+        "--tolerance",
+        help="Specify the seconds two segments may be apart and still be merged. Default is 1.",
+        type=float,
+        default=1.0,
+        metavar="",
+    )
+    merge.add_argument(
+        "-ch",
+        "--chain",
+        help="Specify to join OGG segments into a chained stream instead of encoding them again. Most readers, libsndfile included, only decode its first segment.",
+        action="store_true",
+    )
+    return merge
+
+
+def plan_parser(main_parser: argparse._SubParsersAction):
+    """Parses plan arguments"""
+    plan = main_parser.add_parser(
+        "plan",
+        help="Measures this computer and predicts the load, disk usage and memory of a recording configuration.",
+    )
+    plan.add_argument(
+        "location", type=pathlib.Path, help="The recordings location to plan for."
+    )
+    plan.add_argument(
+        "-c",
+        "--channels",
+        help="Specify the number of channels to record. Default is 2.",
+        type=int,
+        default=2,
+        metavar="",
+    )
+    plan.add_argument(
+        "-fm",
+        "--format",
+        help="Specify the format of the recordings. Default is OGG.",
+        choices=list(FORMATS),
+        default="OGG",
+        metavar="",
+    )
+    plan.add_argument(
+        "-sr",
+        "--samplerate",
+        help="Specify the sample rate of the recordings. Default is 44100.",
+        type=int,
+        default=44100,
+        metavar="",
+    )
+    plan.add_argument(
+        "-l",
+        "--length",
+        help="Specify the length of each file in seconds. Default is 1800.",
+        type=int,
+        default=1800,
+        metavar="",
+    )
+    plan.add_argument(
+        "-d",
+        "--delete",
+        help="Specify the days recordings are kept. Default is forever.",
+        type=int,
+        default=-1,
+        metavar="",
+    )
+    plan.add_argument(
+        "-qu",
+        "--quality",
+        help=f"Specify the Vorbis quality of OGG recordings from 0 to {MAX_QUALITY}.",
+        type=float,
+        metavar="",
+    )
+    plan.add_argument(
+        "-cx",
+        "--complexity",
+        help=f"Specify the compression level of FLAC recordings from 0 to {MAX_COMPLEXITY}.",
+        type=int,
+        metavar="",
+    )
+    plan.add_argument(
+        "-w",
+        "--writers",
+        help="Specify the number of threads writing files. Defaults to one per core plus one.",
+        type=int,
+        metavar="",
+    )
+    plan.add_argument(
+        "-s",
+        "--seconds",
+        help="Specify the seconds of audio encoded to measure the encoder. Default is 10.",
+        type=float,
+        default=10,
+        metavar="",
+    )
+    return plan
+
+
+def pack_parser(main_parser: argparse._SubParsersAction):
+    """Parses pack arguments"""
+    pack = main_parser.add_parser(
+        "pack",
+        help="Packs old day directories into a single file each, or extracts them again.",
+    )
+    pack.add_argument(
+        "location", type=pathlib.Path, help="The recordings location to pack."
+    )
+    pack.add_argument(
+        "-od",
+        "--older_than",
+        help="Specify how many days old a day directory must be to be packed. Default is 30.",
+        type=int,
+        default=30,
+        metavar="",
+    )
+    pack.add_argument(
+        "-x",
+        "--extract",
+        help="Specify a packed day, such as 2024-05-01, to restore as a directory instead of packing.",
+        metavar="",
+    )
+    pack.add_argument(
+        "-m",
+        "--member",
+        help="Specify files of the day given with --extract to copy out, leaving the day packed.",
+        nargs="+",
+        metavar="",
+    )
+    pack.add_argument(
+        "-o",
+        "--output",
+        help="Specify the directory to copy the files given with --member to. Default is the current directory.",
+        type=pathlib.Path,
+        default=pathlib.Path("."),
+        metavar="",
+    )
+    return pack
+
+
+def replay_parser(main_parser: argparse._SubParsersAction):
+    """Parses replay arguments"""
+    replay = main_parser.add_parser(
+        "replay",
+        help="Replays recorded segments through pipeline stages to backfill them, as fast as they decode.",
+    )
+    replay.add_argument(
+        "location", type=pathlib.Path, help="The recordings location to replay."
+    )
+    replay.add_argument(
+        "-sg",
+        "--stages",
+        help="Specify the stages to run. Default is features.",
+        nargs="+",
+        default=["features"],
+        metavar="",
+    )
+    replay.add_argument(
+        "-dy",
+        "--days",
+        help="Specify the day directories to replay, such as 2024-05-01. Default is every day.",
+        nargs="+",
+        metavar="",
+    )
+    replay.add_argument(
+        "-w",
+        "--workers",
+        help="Specify the number of days replayed at once. Defaults to one per core.",
+        type=int,
+        metavar="",
+    )
+    replay.add_argument(
+        "-ow",
+        "--overwrite",
+        help="Specify to replace the output of the stages in days that already have it instead of skipping them.",
+        action="store_true",
+    )
+    return replay
+
+
+def serve_parser(main_parser: argparse._SubParsersAction):
+    """Parses archive server arguments"""
+    serve = main_parser.add_parser(
+        "serve",
+        help="Serves the recordings over HTTP, with byte ranges of files and clips of any time range.",
+    )
+    serve.add_argument(
+        "location", type=pathlib.Path, help="The recordings location to serve."
+    )
+    serve.add_argument(
+        "-H",
+        "--host",
+        help="Specify the address to listen on. Default is localhost.",
+        default="localhost",
+        metavar="",
+    )
+    serve.add_argument(
+        "-p",
+        "--port",
+        help=f"Specify the port to listen on. Default is {ARCHIVE_PORT}.",
+        type=int,
+        default=ARCHIVE_PORT,
+        metavar="",
+    )
+    serve.add_argument(
+        "-cm",
+        "--cache",
+        help="Specify the megabytes of decoded audio kept for clips. Default is 256.",
+        type=int,
+        default=256,
+        metavar="",
+    )
+    serve.add_argument(
+        "-v",
+        "--verbose",
+        help="Specify to log every request.",
+        action="store_true",
+    )
+    return serve
+
+
+def coordinator_parser(main_parser: argparse._SubParsersAction):
+    """Parses fleet coordinator arguments"""
+    coordinator = main_parser.add_parser(
+        "coordinator",
+        help="Runs the coordinator keeping the recordings of many hosts on the same segment boundaries.",
+    )
+    coordinator.add_argument(
+        "location",
+        nargs="?",
+        type=pathlib.Path,
+        help="The directory to append the catalog of segments to. Not saved when omitted.",
+    )
+    coordinator.add_argument(
+        "-l",
+        "--length",
+        help="Specify the length of time in seconds of each segment. Default is 1800.",
+        type=int,
+        default=1800,
+        metavar="",
+    )
+    coordinator.add_argument(
+        "-e",
+        "--epoch",
+        help="Specify the UNIX time segments are counted from. Default is 0, which starts segments on multiples of the length.",
+        type=float,
+        default=0.0,
+        metavar="",
+    )
+    coordinator.add_argument(
+        "-H",
+        "--host",
+        help="Specify the address to listen on, or of the coordinator to query.",
+        default="",
+        metavar="",
+    )
+    coordinator.add_argument(
+        "-p",
+        "--port",
+        help="Specify the port to listen on, or of the coordinator to query.",
+        type=int,
+        default=FLEET_PORT,
+        metavar="",
+    )
+    coordinator.add_argument(
+        "-q",
+        "--query",
+        help="Specify to print the health of the nodes or the catalog of a running coordinator instead.",
+        choices=("nodes", "catalog"),
+    )
+    return coordinator
+
+
+if __name__ == "__main__":
+    main()
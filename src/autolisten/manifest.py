@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+import pathlib
+import threading
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Dict, List
+
+from src.autolisten.shipper import EXTENSIONS, read_state
+from src.autolisten.tools import MANIFEST_FILE
+
+# This module keeps a manifest of checksums in every day directory, computed while the segments are written.
+# A checksum is the SHA-256 of the SHA-256 digests of the consecutive chunks of a file. Encoders seek back
+# to patch their headers once a file is finished, and chunks let those patches be hashed without reading
+# the file again.
+# Entries store it as `chunk_tree_sha256` next to the `chunk_size` it was computed with. It is not the
+# SHA-256 of the file, which the shipper keeps as `sha256` in its state, so the two are never compared.
+
+# Bytes in each hashed chunk. The first chunk is kept in memory until the file is closed.
+CHUNK_SIZE = 1024 * 1024
+# Number of files checked at the same time by `verify_tree`.
+VERIFY_WORKERS = 4
+# Field of a manifest entry holding the checksum. Manifests written before it was named held it as `sha256`.
+CHECKSUM_FIELD = "chunk_tree_sha256"
+
+MANIFEST_LOCK = threading.Lock()
+
+
+def manifest_path(directory: pathlib.Path) -> pathlib.Path:
+    return pathlib.Path(directory) / MANIFEST_FILE
+
+
+def combine(digests: List[bytes]) -> str:
+    """Returns the checksum of a file from the digests of its chunks."""
+    return hashlib.sha256(b"".join(digests)).hexdigest()
+
+
+def file_checksum(filename: pathlib.Path, chunk_size: int = CHUNK_SIZE) -> str:
+    """Reads a file and returns its checksum."""
+    digests = []
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digests.append(hashlib.sha256(chunk).digest())
+            if hasattr(os, "posix_fadvise"):
+                # Verifying reads every file once, so it should not fill the page cache.
+                os.posix_fadvise(f.fileno(), 0, f.tell(), os.POSIX_FADV_DONTNEED)
+    return combine(digests)
+
+
+class HashingFile:
+    """File wrapper handed to libsndfile in place of the segment file.
+    Computes the checksum of the segment from the bytes passing through `write`. Chunks that are written
+    again after they were hashed, apart from the first, are read back once the file is closed.
+    """
+
+    def __init__(self, file, chunk_size: int = CHUNK_SIZE):
+        """Wraps a binary file opened for reading and writing."""
+        self.file = file
+        self.chunk_size = chunk_size
+        self.head = bytearray()
+        self.current = 0
+        self.chunk = hashlib.sha256()
+        self.chunk_length = 0
+        self.digests: Dict[int, bytes] = {}
+        self.stale = set()
+        self.size = None
+        self.checksum = None
+        self.reread = 0
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast("B")
+        self.__absorb(self.file.tell(), view)
+        self.file.write(view)
+        return len(view)
+
+    def __absorb(self, position: int, view: memoryview):
+        """Hashes the bytes written at `position`."""
+        while len(view):
+            number, offset = divmod(position, self.chunk_size)
+            step = min(len(view), self.chunk_size - offset)
+            if number == 0:
+                if len(self.head) < offset:
+                    self.head.extend(bytes(offset - len(self.head)))
+                self.head[offset : offset + step] = view[:step]
+            else:
+                if number > self.current:
+                    self.__finish_chunk()
+                    self.current = number
+                    self.chunk = hashlib.sha256()
+                    self.chunk_length = 0
+                if number == self.current and offset == self.chunk_length:
+                    self.chunk.update(view[:step])
+                    self.chunk_length += step
+                else:
+                    self.stale.add(number)
+            position += step
+            view = view[step:]
+
+    def __finish_chunk(self, length: int = None):
+        """Keeps the digest of the current chunk if all of its `length` bytes were hashed in order."""
+        length = self.chunk_size if length is None else length
+        if self.current and self.chunk_length == length:
+            self.digests[self.current] = self.chunk.digest()
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def read(self, size: int = -1) -> bytes:
+        return self.file.read(size)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        """Closes the file and computes its checksum and size."""
+        if self.file.closed:
+            return
+        size = self.file.seek(0, os.SEEK_END)
+        self.__finish_chunk(size - self.current * self.chunk_size)
+        digests = []
+        for number in range(-(-size // self.chunk_size)):
+            length = min(self.chunk_size, size - number * self.chunk_size)
+            if number == 0 and len(self.head) == length:
+                digests.append(hashlib.sha256(self.head).digest())
+            elif number in self.digests and number not in self.stale:
+                digests.append(self.digests[number])
+            else:
+                self.reread += 1
+                self.file.seek(number * self.chunk_size)
+                digests.append(hashlib.sha256(self.file.read(length)).digest())
+        self.size = size
+        self.checksum = combine(digests)
+        self.file.close()
+
+
+def add_entry(filename: pathlib.Path, size: int, checksum: str, chunk_size: int):
+    """Appends the checksum of a finished segment to the manifest of its directory."""
+    filename = pathlib.Path(filename)
+    entry = {
+        "name": filename.name,
+        "size": size,
+        CHECKSUM_FIELD: checksum,
+        "chunk_size": chunk_size,
+    }
+    with MANIFEST_LOCK, open(manifest_path(filename.parent), "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def read_manifest(directory: pathlib.Path) -> Dict[str, dict]:
+    """Returns the latest entry of every segment in the manifest of a directory."""
+    entries = {}
+    try:
+        with open(manifest_path(directory)) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entries[entry["name"]] = entry
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def verify_file(filename: pathlib.Path, entry: dict) -> str:
+    """Checks a segment against its manifest entry. Returns None when it matches, or what is wrong."""
+    try:
+        size = os.path.getsize(filename)
+    except FileNotFoundError:
+        return "missing"
+    if size != entry["size"]:
+        return f"size is {size} bytes instead of {entry['size']}"
+    expected = entry[CHECKSUM_FIELD] if CHECKSUM_FIELD in entry else entry["sha256"]
+    if file_checksum(filename, entry["chunk_size"]) != expected:
+        return "checksum does not match"
+    return None
+
+
+def verify_tree(location: pathlib.Path, workers: int = VERIFY_WORKERS) -> dict:
+    """Checks every segment listed in the manifests under `location` with a pool of `workers` threads.
+    Returns the number of files checked, the problems found by path and the segments missing from the manifests.
+    Segments deleted after they were shipped and verified are not checked.
+    """
+    location = pathlib.Path(location)
+    checks = []
+    unlisted = []
+    for manifest in sorted(location.rglob(MANIFEST_FILE)):
+        directory = manifest.parent
+        entries = read_manifest(directory)
+        shipped = read_state(directory)
+        checks.extend(
+            (directory / name, entry)
+            for name, entry in entries.items()
+            if (directory / name).exists() or not shipped.get(name, {}).get("verified")
+        )
+        unlisted.extend(
+            path
+            for path in sorted(directory.iterdir())
+            if path.suffix.lower() in EXTENSIONS and path.name not in entries
+        )
+    with ThreadPoolExecutor(workers) as pool:
+        results = pool.map(lambda check: verify_file(*check), checks)
+        problems = {
+            str(filename): problem
+            for (filename, _), problem in zip(checks, results)
+            if problem is not None
+        }
+    return {
+        "checked": len(checks),
+        "bytes": sum(entry["size"] for _, entry in checks),
+        "problems": problems,
+        "unlisted": [str(path) for path in unlisted],
+    }
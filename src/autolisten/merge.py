@@ -0,0 +1,248 @@
+import datetime
+import pathlib
+from typing import List, NamedTuple
+
+import soundfile as sf
+
+import src.autolisten.tools as tools
+from src.autolisten.manifest import CHUNK_SIZE, HashingFile, add_entry
+from src.autolisten.reader import SegmentError, SegmentReader
+from src.autolisten.replay import SegmentSource
+from src.autolisten.seektable import OGG_CAPTURE
+from src.autolisten.tools import FORMATS
+
+# This module merges the consecutive segments of a day directory into one file per day or per hour.
+# Raw segments are joined byte for byte without decoding. WAV, RF64 and FLAC are copied frame by frame,
+# which is lossless, a block at a time so memory stays bounded however long the day. OGG segments are
+# encoded again into a single stream the same way, or joined byte for byte into a chained stream on request.
+
+# Name of the directory inside each day directory that merged files are written to.
+MERGE_DIRECTORY = "merged"
+# Seconds two segments may be apart, or overlap, and still count as consecutive.
+# Segment names only hold whole seconds, so segments without timing in their sidecar need a second.
+MERGE_TOLERANCE = 1.0
+# Formats of the start time of a segment that group segments into one merged file.
+GROUPINGS = {"day": "%Y-%m-%d", "hour": "%Y-%m-%d %H"}
+# Largest WAV file. Longer merges of WAV segments are written as RF64.
+WAV_LIMIT = 2**32 - 1
+
+
+class MergeError(Exception):
+    """Raised when segments cannot be merged into one file."""
+
+
+class Part(NamedTuple):
+    """A segment to merge and what must match for it to follow the previous one."""
+
+    filename: pathlib.Path
+    file_format: str
+    start: float
+    frames: int
+    samplerate: int
+    channels: int
+
+    @property
+    def end(self) -> float:
+        return self.start + self.frames / self.samplerate
+
+
+def describe(filename: pathlib.Path) -> Part:
+    """Returns the format, start time, length and layout of a segment."""
+    with SegmentReader(filename) as reader:
+        return Part(
+            pathlib.Path(filename),
+            reader.format,
+            tools.segment_start(filename),
+            reader.frames,
+            reader.samplerate,
+            reader.channels,
+        )
+
+
+def plan(directory: pathlib.Path, per: str = "day", tolerance: float = MERGE_TOLERANCE):
+    """Splits the segments of a day directory into runs to merge, each grouped by `per` and continuous.
+    A run ends where the time between two segments, from their sidecars or their names, exceeds `tolerance`
+    seconds, or where the format, sample rate or channels change.
+    Returns the runs and the gaps found, each gap as the segment before it, the one after and the seconds between them.
+    """
+    parts = sorted(
+        (
+            describe(path)
+            for path in pathlib.Path(directory).iterdir()
+            if tools.is_segment(path)
+        ),
+        key=lambda part: part.start,
+    )
+    runs = []
+    gaps = []
+    for part in parts:
+        if runs:
+            previous = runs[-1][-1]
+            gap = part.start - previous.end
+            if abs(gap) > tolerance:
+                gaps.append((previous.filename.name, part.filename.name, gap))
+            group = GROUPINGS[per]
+            if (
+                abs(gap) <= tolerance
+                and datetime.datetime.fromtimestamp(part.start).strftime(group)
+                == datetime.datetime.fromtimestamp(previous.start).strftime(group)
+                and (part.file_format, part.samplerate, part.channels)
+                == (previous.file_format, previous.samplerate, previous.channels)
+            ):
+                runs[-1].append(part)
+                continue
+        runs.append([part])
+    return runs, gaps
+
+
+def ogg_serial(filename: pathlib.Path) -> bytes:
+    """Returns the serial number of the first logical stream of an Ogg file."""
+    with open(filename, "rb") as f:
+        header = f.read(18)
+    if header[:4] != OGG_CAPTURE:
+        raise MergeError(f"{filename.name} is not an Ogg stream")
+    return header[14:18]
+
+
+def join_bytes(parts: List[Part], target: HashingFile):
+    """Appends the bytes of every segment to `target`.
+    Joined OGG segments form a chained stream, one logical stream per segment, which needs distinct serial numbers.
+    """
+    if parts[0].file_format == "OGG":
+        serials = [ogg_serial(part.filename) for part in parts]
+        if len(set(serials)) < len(serials):
+            raise MergeError(
+                "Two segments share an Ogg serial number. Merge them with --format"
+            )
+    for part in parts:
+        with open(part.filename, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                target.write(chunk)
+
+
+def copy_frames(parts: List[Part], target: HashingFile, file_format: str):
+    """Writes the frames of every segment to `target` in `file_format`, one chunk of blocks at a time."""
+    first = parts[0]
+    with sf.SoundFile(
+        target,
+        "w",
+        first.samplerate,
+        first.channels,
+        FORMATS[file_format][1],
+        format=file_format,
+    ) as f:
+        for part in parts:
+            for block in SegmentSource(part.filename).blocks():
+                f.write(block)
+
+
+def merge_run(
+    parts: List[Part],
+    directory: pathlib.Path,
+    file_format: str = None,
+    chain: bool = False,
+) -> pathlib.Path:
+    """Merges a run of consecutive segments into a new file in `directory` and returns its name.
+    The file is named like a segment, from the start of the first part to the end of the last. It is kept
+    in the format of the parts unless `file_format` is given, and is added to the manifest of `directory`.
+    With `chain` OGG parts are joined into a chained stream without being encoded again. libsndfile, and so
+    every reader here, only decodes the first segment of a chained stream.
+    """
+    first = parts[0]
+    file_format = file_format or first.file_format
+    frames = sum(part.frames for part in parts)
+    if file_format == "WAV" and frames * first.channels * 4 > WAV_LIMIT:
+        file_format = "RF64"
+    start = datetime.datetime.fromtimestamp(first.start)
+    end = datetime.datetime.fromtimestamp(parts[-1].end)
+    filename = pathlib.Path(directory) / (
+        f"{start:%Y-%m-%d--%H-%M-%S}--{end:%H-%M-%S}{FORMATS[file_format][0]}"
+    )
+    hashed = HashingFile(open(filename, "x+b"))
+    try:
+        if file_format == first.file_format and (
+            file_format == "RAW" or (file_format == "OGG" and chain)
+        ):
+            join_bytes(parts, hashed)
+        else:
+            copy_frames(parts, hashed, file_format)
+    except Exception:
+        hashed.close()
+        filename.unlink()
+        raise
+    hashed.close()
+    add_entry(filename, hashed.size, hashed.checksum, hashed.chunk_size)
+
+    info = {
+        "samplerate": first.samplerate,
+        "frames": frames,
+        "start_time": first.start,
+        "merged": [part.filename.name for part in parts],
+        "dropped_frames": 0,
+        "dropouts": [],
+    }
+    if file_format == "RAW":
+        info.update(channels=first.channels, subtype=FORMATS["RAW"][1])
+    if file_format == "OGG" and chain:
+        info["chained"] = True
+    offset = 0
+    for part in parts:
+        timing = tools.read_sidecar(part.filename)
+        info["dropped_frames"] += timing.get("dropped_frames", 0)
+        info["dropouts"].extend(
+            {**dropout, "frame": dropout["frame"] + offset}
+            for dropout in timing.get("dropouts", [])
+        )
+        offset += part.frames
+    tools.write_sidecar(filename, info)
+    return filename
+
+
+def merge(
+    location: pathlib.Path,
+    days: List[str] = None,
+    per: str = "day",
+    output: pathlib.Path = None,
+    file_format: str = None,
+    tolerance: float = MERGE_TOLERANCE,
+    on_file=None,
+    chain: bool = False,
+) -> dict:
+    """Merges the segments of every day directory of `location`, or only `days`, into one file per `per`
+    and per continuous run. Files go to a `MERGE_DIRECTORY` inside each day directory, or to a directory
+    named after the day inside `output`. Runs merged before are skipped. `on_file` is called with the name
+    of every merged file. `chain` joins OGG segments into chained streams, as in `merge_run`.
+    Returns the files written, the segments they hold, the gaps found and any errors.
+    """
+    assert per in GROUPINGS, f"Segments can only be merged per {' or '.join(GROUPINGS)}"
+    result = {"files": 0, "segments": 0, "gaps": [], "errors": {}}
+    for directory in sorted(pathlib.Path(location).iterdir()):
+        if not directory.is_dir() or (days is not None and directory.name not in days):
+            continue
+        try:
+            runs, gaps = plan(directory, per, tolerance)
+        except (SegmentError, RuntimeError) as e:
+            result["errors"][directory.name] = str(e)
+            continue
+        result["gaps"].extend(gaps)
+        if not runs:
+            continue
+        target = (
+            pathlib.Path(output) / directory.name
+            if output is not None
+            else directory / MERGE_DIRECTORY
+        )
+        target.mkdir(parents=True, exist_ok=True)
+        for run in runs:
+            try:
+                filename = merge_run(run, target, file_format, chain)
+            except FileExistsError:
+                continue
+            except (MergeError, RuntimeError) as e:
+                result["errors"][run[0].filename.name] = str(e)
+                continue
+            result["files"] += 1
+            result["segments"] += len(run)
+            if on_file is not None:
+                on_file(filename)
+    return result
@@ -0,0 +1,215 @@
+import datetime
+import io
+import json
+import os
+import pathlib
+import shutil
+import struct
+from typing import Dict, List
+
+import src.autolisten.tools as tools
+from src.autolisten.shipper import unshipped
+from src.autolisten.tools import PACK_SUFFIX, format_date
+
+# This module packs old day directories into a single file each, so months of recordings take a few
+# inodes instead of hundreds of thousands and a day is deleted with one unlink.
+# A pack holds the files of the day one after another, followed by a JSON index of their offsets and a
+# trailer pointing at the index. Any file can be read in place by seeking to its offset.
+
+# Identifies a pack at its start and at its end.
+PACK_MAGIC = b"ALPACK01"
+# Length of the index followed by the magic.
+PACK_TRAILER = struct.Struct("<Q8s")
+# Files start on multiples of this many bytes, the page size, so they can be memory mapped in place.
+PACK_ALIGN = 4096
+
+
+class PackError(Exception):
+    """Raised when a pack is damaged or does not hold the requested file."""
+
+
+def pack_path(directory: pathlib.Path) -> pathlib.Path:
+    """Returns the pack a day directory is packed into."""
+    directory = pathlib.Path(directory)
+    return directory.with_name(directory.name + PACK_SUFFIX)
+
+
+def copy_range(source, target, size: int):
+    """Copies `size` bytes from the position of `source` to the end of `target`, inside the kernel where it can."""
+    while size > 0:
+        try:
+            copied = os.copy_file_range(source.fileno(), target.fileno(), size)
+        except (AttributeError, OSError):
+            # Not every platform or file system can copy between files in the kernel.
+            copied = target.write(source.read(min(size, 1024 * 1024)))
+        if copied == 0:
+            raise PackError(f"{source.name} became shorter while it was packed")
+        size -= copied
+
+
+def pack_day(directory: pathlib.Path) -> pathlib.Path:
+    """Packs every file of a day directory into its pack and removes the directory.
+    Days holding recordings not shipped yet are left alone. Returns the pack, or None when the day was kept.
+    """
+    directory = pathlib.Path(directory)
+    if unshipped(directory):
+        return None
+    target = pack_path(directory)
+    partial = target.with_name(target.name + ".partial")
+    members = sorted(path for path in directory.rglob("*") if path.is_file())
+    index = {}
+    with open(partial, "wb", buffering=0) as out:
+        out.write(PACK_MAGIC)
+        for path in members:
+            out.write(b"\0" * (-out.tell() % PACK_ALIGN))
+            stat = path.stat()
+            index[path.relative_to(directory).as_posix()] = {
+                "offset": out.tell(),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+            }
+            with open(path, "rb", buffering=0) as source:
+                copy_range(source, out, stat.st_size)
+            # The copy may have bypassed the file position kept by Python.
+            out.seek(0, io.SEEK_END)
+        data = json.dumps(index).encode()
+        out.write(data + PACK_TRAILER.pack(len(data), PACK_MAGIC))
+        os.fsync(out.fileno())
+    os.replace(partial, target)
+    shutil.rmtree(directory)
+    return target
+
+
+def pack_old(location: pathlib.Path, days: int) -> List[pathlib.Path]:
+    """Packs the day directories of `location` older than `days` days. Returns the packs written."""
+    oldest = format_date(datetime.datetime.now() - datetime.timedelta(days=days))
+    packs = []
+    for directory in sorted(pathlib.Path(location).iterdir()):
+        try:
+            datetime.datetime.strptime(directory.name, "%Y-%m-%d")
+        except ValueError:
+            continue
+        if directory.is_dir() and directory.name < oldest:
+            pack = pack_day(directory)
+            if pack is not None:
+                packs.append(pack)
+    return packs
+
+
+class PackMember(io.RawIOBase):
+    """Read only view of one file of a pack, seekable like the file itself. Can be handed to libsndfile."""
+
+    def __init__(self, path: pathlib.Path, name: str, offset: int, size: int):
+        self.file = open(path, "rb")
+        self.name = name
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, min(offset, self.size))
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        count = min(len(buffer), self.size - self.position)
+        if count <= 0:
+            return 0
+        self.file.seek(self.offset + self.position)
+        count = self.file.readinto(memoryview(buffer)[:count])
+        self.position += count
+        return count
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+class PackFile:
+    """Reads the files of a pack without unpacking it."""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = pathlib.Path(path)
+        with open(self.path, "rb") as f:
+            if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                raise PackError(f"{self.path} is not a pack")
+            f.seek(-PACK_TRAILER.size, io.SEEK_END)
+            length, magic = PACK_TRAILER.unpack(f.read(PACK_TRAILER.size))
+            if magic != PACK_MAGIC:
+                raise PackError(f"{self.path} is incomplete")
+            f.seek(-PACK_TRAILER.size - length, io.SEEK_END)
+            self.index: Dict[str, dict] = json.loads(f.read(length))
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def names(self) -> List[str]:
+        """Returns the names of the files in the pack, relative to their day directory."""
+        return list(self.index)
+
+    def open(self, name: str) -> PackMember:
+        """Opens a file of the pack for reading."""
+        if name not in self.index:
+            raise PackError(f"{self.path.name} holds no file named {name}")
+        entry = self.index[name]
+        return PackMember(self.path, name, entry["offset"], entry["size"])
+
+    def read(self, name: str) -> bytes:
+        """Returns the contents of a file of the pack."""
+        with self.open(name) as member:
+            return member.read()
+
+    def sound_file(self, name: str):
+        """Opens a recording of the pack with libsndfile. Raw recordings are described by their packed sidecar."""
+        import soundfile as sf
+
+        member = self.open(name)
+        if tools.get_format(name) != "RAW":
+            return sf.SoundFile(member)
+        info = json.loads(self.read(name + tools.SIDECAR_SUFFIX))
+        return sf.SoundFile(
+            member,
+            samplerate=info["samplerate"],
+            channels=info["channels"],
+            subtype=info["subtype"],
+            format="RAW",
+        )
+
+    def extract(self, name: str, directory: pathlib.Path) -> pathlib.Path:
+        """Writes a file of the pack into `directory` and returns its path."""
+        entry = self.index.get(name)
+        if entry is None:
+            raise PackError(f"{self.path.name} holds no file named {name}")
+        target = pathlib.Path(directory) / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "rb", buffering=0) as source, open(
+            target, "xb", buffering=0
+        ) as out:
+            source.seek(entry["offset"])
+            copy_range(source, out, entry["size"])
+        os.utime(target, (entry["mtime"], entry["mtime"]))
+        return target
+
+
+def unpack_day(pack: pathlib.Path) -> pathlib.Path:
+    """Restores the day directory of a pack and removes the pack. Returns the directory."""
+    pack = pathlib.Path(pack)
+    packed = PackFile(pack)
+    directory = pack.with_name(pack.name[: -len(PACK_SUFFIX)])
+    directory.mkdir(exist_ok=True)
+    for name in packed.names():
+        packed.extract(name, directory)
+    pack.unlink()
+    return directory
@@ -0,0 +1,159 @@
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from src.autolisten.calibrate import measure, synthetic_audio
+from src.autolisten.scheduler import HEADROOM, default_workers
+from src.autolisten.tools import CHANNELS, FORMATS, FS
+
+# This module predicts whether a configuration can run on this host before it is deployed.
+# It encodes synthetic audio and writes to the disk of the location, then works out the load, the disk
+# usage and the memory of a recording with those measurements.
+
+# Seconds of synthetic audio encoded to measure the encoder.
+PLAN_SECONDS = 10
+# Seconds of synthetic audio encoded by the check before a recording starts.
+CHECK_SECONDS = 3
+# Bytes written to measure the disk, enough to get past the write cache of most drives.
+DISK_TEST_BYTES = 64 * 1024 * 1024
+# Bytes written at a time when measuring the disk.
+DISK_TEST_CHUNK = 1024 * 1024
+# Seconds in a day.
+DAY_SECONDS = 86400
+# File listing the memory of the system on Linux.
+MEMINFO = "/proc/meminfo"
+
+
+def measure_disk(location: str, size: int = DISK_TEST_BYTES) -> float:
+    """Writes `size` bytes to a temporary file in `location`, synced to the disk, and returns the bytes written per second."""
+    chunk = os.urandom(DISK_TEST_CHUNK)
+    with tempfile.NamedTemporaryFile(dir=location, prefix=".plan-") as f:
+        started = time.perf_counter()
+        for _ in range(0, size, DISK_TEST_CHUNK):
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+        elapsed = time.perf_counter() - started
+    return size / elapsed
+
+
+def peak_memory() -> int:
+    """Returns the peak resident memory of this process in bytes, or 0 where it cannot be known."""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux counts kilobytes and macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def available_memory() -> int:
+    """Returns the bytes of memory available to new processes, or 0 where it cannot be known."""
+    try:
+        with open(MEMINFO) as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def plan(
+    location: str,
+    channels: int = CHANNELS,
+    file_format: str = "OGG",
+    samplerate: int = FS,
+    filelen: int = 1800,
+    retention: int = -1,
+    quality: float = None,
+    complexity: int = None,
+    max_writers: int = None,
+    seconds: float = PLAN_SECONDS,
+    disk_bytes: int = DISK_TEST_BYTES,
+) -> dict:
+    """Measures this host and predicts the load of recording `channels` channels at `samplerate` in
+    `file_format`, in files of `filelen` seconds kept for `retention` days, or forever when it is -1.
+    Returns the measurements and predictions, with `problems` listing what would keep the recording from
+    keeping up and `warnings` what would need attention later."""
+    assert os.path.isdir(location), "You have not specified a valid path."
+    assert file_format in FORMATS, "The file format is not supported."
+    writers = max_writers if max_writers else default_workers()
+    cores = os.cpu_count() or 1
+    # The first encode of a format pays for loading its codec.
+    measure(
+        file_format, synthetic_audio(1, channels, samplerate), samplerate=samplerate
+    )
+    encoded = measure(
+        file_format,
+        synthetic_audio(seconds, channels, samplerate),
+        quality,
+        complexity,
+        samplerate,
+    )
+    factor = encoded["realtime_factor"]
+    disk_rate = measure_disk(location, disk_bytes)
+    per_day = encoded["bytes_per_second"] * DAY_SECONDS
+    free = shutil.disk_usage(location).free
+    # A writer keeps the captured audio of its whole file as int32 until the file ends and only then
+    # encodes it. The writer recording the next file fills up while the earlier ones are still encoding,
+    # each for `factor` times the length of a file, so up to all writers hold a full file at once.
+    segment = filelen * samplerate * channels * 4
+    in_flight = min(writers, 1 + max(1, math.ceil(factor)))
+    available = available_memory()
+    result = {
+        "format": file_format,
+        "channels": channels,
+        "samplerate": samplerate,
+        "writers": writers,
+        "cores": cores,
+        "realtime_factor": factor,
+        "capacity": min(writers - 1, cores) * HEADROOM,
+        "cpu_load": factor / cores,
+        "bytes_per_second": encoded["bytes_per_second"],
+        "disk_bytes_per_second": disk_rate,
+        "bytes_per_day": per_day,
+        "free_bytes": free,
+        "days_until_full": free / per_day if per_day else float("inf"),
+        "segment_bytes": segment,
+        "writers_in_flight": in_flight,
+        "peak_memory": peak_memory() + in_flight * segment,
+        "available_memory": available,
+        "problems": [],
+        "warnings": [],
+    }
+    if factor > result["capacity"]:
+        result["problems"].append(
+            f"Encoding takes {factor:.2f} seconds per second of audio, more than the {result['capacity']:.2f} {writers} writers on {cores} cores can sustain"
+        )
+    elif factor > HEADROOM:
+        result["warnings"].append(
+            f"Encoding takes {factor:.2f} seconds per second of audio, so every file finishes well after it ends"
+        )
+    if encoded["bytes_per_second"] > disk_rate * HEADROOM:
+        result["problems"].append(
+            f"The disk writes {disk_rate / 1e6:.1f} MB/s, too little for {encoded['bytes_per_second'] / 1e6:.1f} MB/s of recordings"
+        )
+    if available and result["peak_memory"] > available:
+        result["problems"].append(
+            f"{in_flight} writers holding {segment / 1e6:.0f} MB files each need {result['peak_memory'] / 1e6:.0f} MB but only {available / 1e6:.0f} MB of memory are available"
+        )
+    if retention != -1:
+        # The current day is written while `retention` full days are kept.
+        result["retained_bytes"] = per_day * (retention + 1)
+        if result["retained_bytes"] > free:
+            result["problems"].append(
+                f"Keeping {retention} days needs {result['retained_bytes'] / 1e9:.1f} GB but only {free / 1e9:.1f} GB are free"
+            )
+    elif result["days_until_full"] < 30:
+        result["warnings"].append(
+            f"Without retention the disk is full in {result['days_until_full']:.1f} days"
+        )
+    return result
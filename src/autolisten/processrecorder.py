@@ -0,0 +1,398 @@
+import datetime
+import multiprocessing
+import os
+import pathlib
+import queue
+import signal
+import sys
+import threading
+import time
+
+import numpy as np
+
+import src.autolisten.tools as tools
+from src.autolisten.devices import REGISTRY
+from src.autolisten.features import FeatureExtractor
+from src.autolisten.ring import RingReader, SharedRing, capture
+from src.autolisten.segment import SegmentFile
+from src.autolisten.shipper import Shipper, cleanup_shipped
+from src.autolisten.tap import TapServer
+from src.autolisten.timing import SampleClock
+from src.autolisten.tools import (
+    FS,
+    MINUTE,
+    HOUR,
+    FORMATS,
+    SHUTDOWN_TIMEOUT,
+    MAX_QUALITY,
+    MAX_COMPLEXITY,
+)
+
+# This module records with a capture process and separate encoder and analysis processes.
+
+# Seconds between two checks for a new day directory and old recordings to delete.
+RETENTION_INTERVAL = 60
+
+
+def encode(
+    name: str,
+    location: pathlib.Path,
+    filelen: float,
+    file_format: str,
+    encoder: dict,
+    results,
+    background: bool,
+):
+    """Body of the encoder process. Cuts the blocks of the ring `name` into files of exactly `filelen` seconds.
+    Frames lost by the device or by falling behind the capture are filled with silence.
+    Puts the name and frame count of every finished file on `results`."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    tools.setup_logs(background)
+    ring = SharedRing(name=name)
+    reader = RingReader(ring)
+    clock = SampleClock()
+    length = int(filelen * FS)
+    position = 0
+    segment = None
+
+    def finish(segment: SegmentFile):
+        segment.close(clock.segment(segment.start, segment.frames))
+        results.put((str(segment.filename), segment.frames))
+
+    try:
+        while True:
+            item = reader.read()
+            if item is None:
+                break
+            block, time_info, overflow, received, skipped = item
+            if skipped:
+                sys.stderr.write(
+                    f"WARNING: The encoder fell {skipped / FS:.1f} seconds behind the capture.\n"
+                )
+            dropped = clock.update(position, len(block), time_info, overflow, received)
+            pieces = [block]
+            if dropped:
+                # Silence keeps one second of file equal to one second of time.
+                pieces.insert(0, np.zeros((dropped, ring.channels), dtype=np.int32))
+            for piece in pieces:
+                while len(piece):
+                    if segment is None:
+                        # Named after the capture time of its first frame. The encoder may be catching
+                        # up on a backlog, so the time it gets here can be seconds later.
+                        filename = tools.segment_filename(
+                            clock.locate(position)["wall_time"],
+                            filelen,
+                            location,
+                            FORMATS[file_format][0],
+                        )
+                        filename.parent.mkdir(parents=True, exist_ok=True)
+                        segment = SegmentFile(
+                            filename,
+                            ring.channels,
+                            file_format,
+                            [],
+                            encoder,
+                        )
+                        segment.start = position
+                        segment.open()
+                    take = min(len(piece), length - segment.frames)
+                    segment.write([piece[:take]])
+                    segment.frames += take
+                    position += take
+                    piece = piece[take:]
+                    if segment.frames >= length:
+                        finish(segment)
+                        segment = None
+        if segment is not None:
+            finish(segment)
+    finally:
+        ring.close()
+
+
+def analyse(name: str, location: pathlib.Path, background: bool):
+    """Body of the analysis process. Appends the features of the blocks of the ring `name` to the feature
+    store of the day directory they were captured in."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    tools.setup_logs(background)
+    ring = SharedRing(name=name)
+    reader = RingReader(ring)
+    extractor = None
+    day = None
+    try:
+        while True:
+            item = reader.read()
+            if item is None:
+                break
+            block, time_info, _, received, skipped = item
+            if extractor is None or skipped or day != tools.format_date_now():
+                # Feature rows are timed by counting frames, so they restart after a gap or at midnight.
+                if extractor is not None:
+                    extractor.close()
+                day = tools.format_date_now()
+                tools.create_directory(location)
+                extractor = FeatureExtractor(
+                    location / day,
+                    ring.channels,
+                    received - time_info.currentTime + time_info.inputBufferAdcTime,
+                )
+            # The extractor holds on to blocks until it has a full batch, while the ring reuses its slots.
+            extractor.process(block.copy())
+        if extractor is not None:
+            extractor.close()
+    finally:
+        ring.close()
+
+
+class ProcessRecorder:
+    """
+    ### Recorder split across processes.
+    A capture process copies every block from the input stream into a ring buffer in shared memory and
+    does nothing else. An encoder process cuts the ring into files of exactly `filelen` seconds, and an
+    analysis process computes the features. A slow encode or a garbage collection pause in either of
+    them cannot delay the capture, and each process runs on its own core.
+    """
+
+    def __init__(
+        self,
+        location: str,
+        timeout: int,
+        deletion: int = -1,
+        filelen: int = 1800,
+        verbose=False,
+        channels: int = 2,
+        background=False,
+        long_recording: bool = False,
+        sound_device: int = -1,
+        delay: int = 0,
+        closest: int = 0,
+        features: bool = False,
+        file_format: str = "OGG",
+        shutdown_timeout: int = SHUTDOWN_TIMEOUT,
+        shipper: Shipper = None,
+        quality: float = None,
+        complexity: int = None,
+        tap: TapServer = None,
+    ):
+        """Takes the same arguments as `Recorder`. The `tap` is fed by a thread of this process reading the ring."""
+        assert os.path.exists(location), "You have not specified a valid path."
+        assert timeout > 0, "The timeout must be greater than zero. "
+        assert filelen > 0 or delay > 0, "The file length must be greater than 0"
+        assert channels > 0, "The channels must be greater than zero"
+        assert file_format in FORMATS, "The file format is not supported."
+        assert (
+            quality is None or 0 <= quality <= MAX_QUALITY
+        ), f"The quality must be between 0 and {MAX_QUALITY}"
+        assert (
+            complexity is None or 0 <= complexity <= MAX_COMPLEXITY
+        ), f"The complexity must be between 0 and {MAX_COMPLEXITY}"
+        if deletion != -1:
+            assert isinstance(deletion, int), "Deletion must be an integer"
+            assert deletion > 0, "Deletion must be greater than 0"
+
+        tools.setup_logs(background)
+        self.location = pathlib.Path(location)
+        self.timeout = timeout
+        self.deletion = deletion
+        self.filelen = filelen
+        self.verbose = verbose
+        self.channels = channels
+        self.background = background
+        self.device = None if sound_device == -1 else sound_device
+        self.delay = closest if closest else delay
+        self.features = features
+        self.file_format = file_format
+        self.encoder = tools.encoder_options(file_format, quality, complexity)
+        self.shutdown_timeout = shutdown_timeout
+        self.shipper = shipper
+        self.tap = tap
+
+        if delay:
+            self.filelen = delay
+            long_recording = True
+        if long_recording:
+            self.filelen *= MINUTE
+            self.timeout *= HOUR
+
+        self.files = 0
+        self.saved_frames = 0
+        self.stopped = threading.Event()
+
+    def record(self):
+        """Runs the processes until the timeout passes or the recording is stopped."""
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                handlers[signum] = signal.signal(signum, self.__handle_signal)
+        try:
+            self.__run()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def __handle_signal(self, signum, frame):
+        del frame
+        sys.stdout.write(
+            f"Received {signal.Signals(signum).name}. Finishing the current files...\n"
+        )
+        self.stop()
+
+    def __run(self):
+        device = REGISTRY.check(self.device, self.channels)
+        if self.verbose:
+            sys.stdout.write(f"Recording from {device.name} ({device.hostapi}).\n")
+        if self.delay:
+            wait_time = tools.get_wait_time(self.delay)
+            sys.stdout.write(
+                f"The correct start time has not occured yet. Sleeping for {wait_time} seconds.\n"
+            )
+            if self.stopped.wait(wait_time):
+                return
+
+        # Spawned processes start without the threads and locks of this one.
+        context = multiprocessing.get_context("spawn")
+        ring = SharedRing(self.channels)
+        stop = context.Event()
+        results = context.Queue()
+        consumers = [
+            context.Process(
+                target=encode,
+                args=(
+                    ring.name,
+                    self.location,
+                    self.filelen,
+                    self.file_format,
+                    self.encoder,
+                    results,
+                    self.background,
+                ),
+                name="autolisten-encoder",
+            )
+        ]
+        if self.features:
+            consumers.append(
+                context.Process(
+                    target=analyse,
+                    args=(ring.name, self.location, self.background),
+                    name="autolisten-analysis",
+                )
+            )
+        capturer = context.Process(
+            target=capture,
+            args=(ring.name, device.index, stop),
+            name="autolisten-capture",
+        )
+
+        relay = None
+        if self.tap is not None:
+            relay = threading.Thread(
+                target=self.__relay, args=(ring,), name="autolisten-tap", daemon=True
+            )
+
+        failed = False
+        tools.create_directory(self.location)
+        sys.stdout.write(
+            f"Starting recordings at {self.location}. Will continue for {self.timeout:g} minute{'' if self.timeout == 1 else 's'}.\n"
+        )
+        try:
+            for process in consumers + [capturer]:
+                process.start()
+            if relay is not None:
+                relay.start()
+            # Starting the processes takes a while, so the timeout counts from the first block captured.
+            while ring.written == 0 and capturer.is_alive():
+                if self.stopped.wait(0.01):
+                    break
+            deadline = time.monotonic() + self.timeout * MINUTE
+            curr_date = tools.format_date_now()
+            checked = time.monotonic()
+            while not self.stopped.is_set() and time.monotonic() < deadline:
+                if not capturer.is_alive():
+                    sys.stderr.write(
+                        f"ERROR: The capture process ended with exit code {capturer.exitcode}.\n"
+                    )
+                    failed = True
+                    break
+                crashed = [p for p in consumers if p.exitcode not in (None, 0)]
+                if crashed:
+                    # Nothing would be left to write the capture.
+                    for process in crashed:
+                        sys.stderr.write(
+                            f"ERROR: The {process.name} process ended with exit code {process.exitcode}.\n"
+                        )
+                    failed = True
+                    break
+                self.__collect(results, min(1.0, max(0.0, deadline - time.monotonic())))
+                if time.monotonic() - checked >= RETENTION_INTERVAL:
+                    checked = time.monotonic()
+                    if curr_date != tools.format_date_now():
+                        if self.deletion != -1:
+                            cleanup_shipped(self.deletion, self.location)
+                        curr_date = tools.format_date_now()
+        finally:
+            stop.set()
+            capturer.join()
+            # The capture process closes the ring even when it fails, so the consumers drain it and end.
+            ring.close_writer()
+            ended = time.monotonic() + self.shutdown_timeout
+            for process in consumers:
+                if process.exitcode not in (None, 0):
+                    continue
+                while process.is_alive() and time.monotonic() < ended:
+                    self.__collect(results, 0.1)
+                    process.join(0)
+                if process.is_alive():
+                    sys.stderr.write(
+                        f"ERROR: The {process.name} process could not finish within {self.shutdown_timeout} seconds.\n"
+                    )
+                    process.terminate()
+                    process.join()
+                    failed = True
+                elif process.exitcode != 0 and not failed:
+                    sys.stderr.write(
+                        f"ERROR: The {process.name} process ended with exit code {process.exitcode}.\n"
+                    )
+                    failed = True
+            self.__collect(results, 0)
+            if relay is not None and relay.is_alive():
+                relay.join()
+            ring.close()
+            ring.unlink()
+
+        sys.stdout.write(
+            f"Saved {self.saved_frames / FS:.1f} seconds of audio in {self.files} files. You can now visit your files at {self.location} !\n"
+        )
+        if failed:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            sys.exit(1)
+
+    def __relay(self, ring: SharedRing):
+        """Publishes the blocks of the ring to the tap until the capture ends."""
+        reader = RingReader(ring)
+        while True:
+            item = reader.read()
+            if item is None:
+                return
+            # The ring reuses its slots while listeners may still hold on to a block.
+            self.tap.publish(item[0].copy())
+
+    def __collect(self, results, timeout: float):
+        """Counts the files the encoder finished, waiting at most `timeout` seconds for the first."""
+        while True:
+            try:
+                filename, frames = results.get(timeout=timeout)
+            except queue.Empty:
+                return
+            timeout = 0
+            self.files += 1
+            self.saved_frames += frames
+            if self.verbose:
+                sys.stdout.write(
+                    f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Saved {pathlib.Path(filename).name}\n"
+                )
+            if self.shipper is not None:
+                self.shipper.submit(pathlib.Path(filename))
+
+    def stop(self):
+        """Finalizes the current file and ends the recording."""
+        self.stopped.set()
@@ -0,0 +1,202 @@
+import collections
+import datetime
+import json
+import marshal
+import os
+import pathlib
+import sys
+import threading
+import time
+from typing import Dict
+
+# This module profiles every thread of a running recorder, including the PortAudio callback and the
+# writers, by sampling their stacks. Sampling needs no changes to the threads it watches and costs the
+# recording only the time of the sampler thread itself.
+# Each profile is a directory of collapsed stacks, read by flamegraph.pl and speedscope, and one pstats
+# file per thread, read by `python -m pstats` and snakeviz.
+
+# Seconds profiled when no window is given.
+PROFILE_SECONDS = 60
+# Longest window that can be profiled, in seconds. Samples are kept in memory until it ends.
+MAX_PROFILE_SECONDS = 3600
+# Seconds between two samples of the stacks of every thread.
+SAMPLE_INTERVAL = 0.005
+
+
+def label(code) -> str:
+    """Returns the name of a function in a collapsed stack."""
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+def thread_time(ident: int) -> float:
+    """Returns the CPU seconds used by the thread `ident`, or None where threads have no CPU clock."""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+def safe_name(name: str) -> str:
+    """Returns a thread name usable as a file name."""
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+
+
+def write_collapsed(path: pathlib.Path, stacks: Dict[tuple, float], scale: float):
+    """Writes stacks as `thread;outer;...;inner weight` lines, the weight multiplied by `scale`."""
+    with open(path, "w") as f:
+        for (thread, codes), weight in sorted(
+            stacks.items(), key=lambda item: -item[1]
+        ):
+            count = round(weight * scale)
+            if count > 0:
+                f.write(";".join([thread] + [label(code) for code in codes]))
+                f.write(f" {count}\n")
+
+
+def write_pstats(path: pathlib.Path, stacks: Dict[tuple, float]):
+    """Writes the CPU seconds of sampled stacks in the format of `cProfile`. The calls counted are samples."""
+    stats = {}
+    for codes, seconds in stacks.items():
+        functions = [
+            (code.co_filename, code.co_firstlineno, code.co_name) for code in codes
+        ]
+        for depth, function in enumerate(functions):
+            entry = stats.setdefault(function, [0, 0, 0.0, 0.0, {}])
+            if function not in functions[:depth]:
+                # Recursive functions count once per stack, as cProfile counts them.
+                entry[0] += 1
+                entry[1] += 1
+                entry[3] += seconds
+            if depth == len(functions) - 1:
+                entry[2] += seconds
+            if depth > 0:
+                caller = entry[4].get(functions[depth - 1], (0, 0, 0.0, 0.0))
+                entry[4][functions[depth - 1]] = (
+                    caller[0] + 1,
+                    caller[1] + 1,
+                    caller[2] + (seconds if depth == len(functions) - 1 else 0.0),
+                    caller[3] + seconds,
+                )
+    with open(path, "wb") as f:
+        marshal.dump({function: tuple(entry) for function, entry in stats.items()}, f)
+
+
+class Profiler:
+    """Samples the stacks of all threads for a bounded window and writes the profile to `directory`.
+    Wall clock samples show where threads wait. CPU samples are weighted by the CPU time each thread used
+    since the previous sample, so they show where threads work."""
+
+    def __init__(self, directory: pathlib.Path, interval: float = SAMPLE_INTERVAL):
+        self.directory = pathlib.Path(directory)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.last = None
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds: float = PROFILE_SECONDS) -> bool:
+        """Starts profiling for `seconds`. Returns False when a profile is already running."""
+        assert (
+            0 < seconds <= MAX_PROFILE_SECONDS
+        ), f"The profile must last between 0 and {MAX_PROFILE_SECONDS} seconds"
+        with self.lock:
+            if self.running:
+                return False
+            self.stopped.clear()
+            self.thread = threading.Thread(
+                target=self.__run, args=(seconds,), name="profiler", daemon=True
+            )
+            self.thread.start()
+        return True
+
+    def stop(self) -> pathlib.Path:
+        """Ends the running profile early and returns the directory it was written to."""
+        thread = self.thread
+        if thread is None:
+            return self.last
+        self.stopped.set()
+        thread.join()
+        return self.last
+
+    def toggle(self, seconds: float = None) -> bool:
+        """Starts a profile of `seconds`, or stops the running one. Returns whether a profile is now running."""
+        if self.running:
+            self.stop()
+            return False
+        return self.start(seconds or PROFILE_SECONDS)
+
+    def status(self) -> dict:
+        return {
+            "profiling": self.running,
+            "profile": str(self.last) if self.last is not None else None,
+        }
+
+    def __run(self, seconds: float):
+        me = threading.get_ident()
+        wall = collections.Counter()
+        cpu = collections.defaultdict(collections.Counter)
+        used = collections.Counter()
+        clocks = {}
+        names = {}
+        samples = 0
+        started = time.monotonic()
+        while (
+            not self.stopped.wait(self.interval)
+            and time.monotonic() - started < seconds
+        ):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                codes = tuple(reversed(codes))
+                # Threads started outside Python, such as the PortAudio callback, have no name.
+                name = names.get(ident, f"native-{ident}")
+                wall[(name, codes)] += 1
+                clock = thread_time(ident)
+                if clock is not None:
+                    if ident in clocks and clock > clocks[ident]:
+                        cpu[name][codes] += clock - clocks[ident]
+                        used[name] += clock - clocks[ident]
+                    clocks[ident] = clock
+            samples += 1
+        self.__write(time.monotonic() - started, samples, wall, cpu, used)
+
+    def __write(self, elapsed: float, samples: int, wall, cpu, used):
+        directory = self.directory / (
+            f"profile-{datetime.datetime.now():%Y-%m-%d--%H-%M-%S}"
+        )
+        directory.mkdir(parents=True, exist_ok=True)
+        write_collapsed(directory / "wall.collapsed", wall, 1)
+        write_collapsed(
+            directory / "cpu.collapsed",
+            {
+                (name, codes): seconds
+                for name, stacks in cpu.items()
+                for codes, seconds in stacks.items()
+            },
+            # Microseconds, so short functions are not rounded away.
+            1e6,
+        )
+        for name, stacks in cpu.items():
+            write_pstats(directory / f"{safe_name(name)}.pstats", stacks)
+        summary = {
+            "seconds": round(elapsed, 3),
+            "samples": samples,
+            "interval": self.interval,
+            "cpu_seconds": {name: round(seconds, 6) for name, seconds in used.items()},
+        }
+        with open(directory / "threads.json", "w") as f:
+            json.dump(summary, f, indent=1)
+        self.last = directory
+        sys.stdout.write(f"Wrote a profile of {elapsed:.1f} seconds to {directory}\n")
@@ -0,0 +1,244 @@
+import io
+import os
+import pathlib
+import struct
+
+import numpy as np
+import soundfile as sf
+
+import src.autolisten.tools as tools
+from src.autolisten.seektable import load_seek_table
+
+# This module gives random access into recorded segments.
+
+# Number of frames decoded before the requested position so the decoder has settled.
+PREROLL = 4096
+
+# Maps the WAVE format tag and sample width to the matching NumPy dtype.
+PCM_DTYPES = {
+    (1, 16): "<i2",
+    (1, 32): "<i4",
+    (3, 32): "<f4",
+    (3, 64): "<f8",
+}
+# Maps the libsndfile subtype of raw segments to the matching NumPy dtype.
+RAW_DTYPES = {"PCM_16": "<i2", "PCM_32": "<i4", "FLOAT": "<f4", "DOUBLE": "<f8"}
+
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+RF64_SIZE_MARKER = 0xFFFFFFFF
+
+
+class SegmentError(Exception):
+    """Raised when a segment cannot be opened for random access."""
+
+
+def pcm_layout(filename: pathlib.Path):
+    """Parses the header of a WAV or RF64 segment.
+    Returns the byte offset of the sample data, the frame count, channels, sample rate and dtype.
+    """
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff not in (b"RIFF", b"RF64") or wave != b"WAVE":
+            raise SegmentError(f"{filename} is not a WAV or RF64 file.")
+
+        data_size = None
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise SegmentError(f"{filename} has no data chunk.")
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk)
+            if chunk_id == b"data":
+                break
+            body = f.read(chunk_size + (chunk_size & 1))
+            if chunk_id == b"ds64":
+                data_size = struct.unpack_from("<QQ", body)[1]
+            elif chunk_id == b"fmt ":
+                tag, channels, samplerate, _, _, bits = struct.unpack_from(
+                    "<HHIIHH", body
+                )
+                if tag == WAVE_FORMAT_EXTENSIBLE:
+                    tag = struct.unpack_from("<H", body, 24)[0]
+                fmt = (tag, channels, samplerate, bits)
+
+        if fmt is None:
+            raise SegmentError(f"{filename} has no fmt chunk.")
+        tag, channels, samplerate, bits = fmt
+        if (tag, bits) not in PCM_DTYPES:
+            raise SegmentError(f"{filename} uses {bits} bit samples of format {tag}.")
+
+        offset = f.tell()
+        if chunk_size != RF64_SIZE_MARKER or data_size is None:
+            data_size = chunk_size
+        # Segments still being written may not have their sizes updated yet.
+        data_size = min(data_size, size - offset) if data_size else size - offset
+        frame_size = channels * bits // 8
+        return (
+            offset,
+            data_size // frame_size,
+            channels,
+            samplerate,
+            PCM_DTYPES[(tag, bits)],
+        )
+
+
+class SpliceFile(io.RawIOBase):
+    """Read only view of an Ogg segment made of its header pages followed by the pages from `offset` onward.
+    Decoding this view starts at the page found in the seek table rather than at the start of the segment.
+    """
+
+    def __init__(self, filename: pathlib.Path, header_end: int, offset: int):
+        self.file = open(filename, "rb")
+        self.file.seek(0)
+        self.header = self.file.read(header_end)
+        self.offset = offset
+        self.length = len(self.header) + os.path.getsize(filename) - offset
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.position = max(0, min(offset, self.length))
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        data = self.__read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def __read(self, size: int) -> bytes:
+        data = b""
+        if self.position < len(self.header):
+            data = self.header[self.position : self.position + size]
+        remaining = size - len(data)
+        if remaining > 0:
+            self.file.seek(self.offset + self.position + len(data) - len(self.header))
+            data += self.file.read(remaining)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+class SegmentReader:
+    """Random access reader for a recorded segment.
+    WAV, RF64 and raw segments are exposed as a `numpy.memmap` in `data`, read lazily and without copies.
+    Ogg segments with a seek table jump straight to the page holding the requested frame.
+    Every other segment falls back to the seeking provided by libsndfile.
+    """
+
+    def __init__(self, filename: pathlib.Path):
+        """Opens a segment for random access."""
+        self.filename = pathlib.Path(filename)
+        self.format = tools.get_format(self.filename)
+        self.data = None
+        self.table = None
+
+        if self.format in ("WAV", "RF64"):
+            offset, frames, channels, samplerate, dtype = pcm_layout(self.filename)
+            self.__map(offset, frames, channels, dtype)
+            self.samplerate = samplerate
+        elif self.format == "RAW":
+            info = tools.read_sidecar(self.filename)
+            if not info:
+                raise SegmentError(f"{self.filename} has no sidecar describing it.")
+            dtype = np.dtype(RAW_DTYPES[info["subtype"]])
+            frames = os.path.getsize(self.filename) // (
+                dtype.itemsize * info["channels"]
+            )
+            self.__map(0, frames, info["channels"], dtype)
+            self.samplerate = info["samplerate"]
+        else:
+            info = sf.info(str(self.filename))
+            self.samplerate = info.samplerate
+            self.channels = info.channels
+            self.frames = info.frames
+            table = load_seek_table(self.filename)
+            if self.format == "OGG" and len(table) > 0:
+                self.table = table[table["granule"] > 0]
+
+    def __map(self, offset: int, frames: int, channels: int, dtype):
+        """Maps the sample data of an uncompressed segment."""
+        self.channels = channels
+        self.frames = frames
+        if frames == 0:
+            self.data = np.zeros((0, channels), dtype=dtype)
+        else:
+            self.data = np.memmap(
+                self.filename,
+                dtype=dtype,
+                mode="r",
+                offset=offset,
+                shape=(frames, channels),
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.frames
+
+    def close(self):
+        """Releases the memory map of the segment."""
+        self.data = None
+
+    def read(self, start: int, frames: int, dtype: str = "int32") -> np.ndarray:
+        """Returns `frames` frames beginning at frame `start`.
+        Uncompressed segments return a view into the memory map and ignore `dtype`.
+        """
+        start = max(0, min(start, self.frames))
+        frames = max(0, min(frames, self.frames - start))
+        if self.data is not None:
+            return self.data[start : start + frames]
+        if self.table is not None:
+            return self.__read_indexed(start, frames, dtype)
+        with sf.SoundFile(str(self.filename)) as f:
+            f.seek(start)
+            return f.read(frames, dtype=dtype, always_2d=True)
+
+    def read_seconds(
+        self, start: float, duration: float, dtype: str = "int32"
+    ) -> np.ndarray:
+        """Returns `duration` seconds of audio beginning `start` seconds into the segment."""
+        return self.read(
+            int(start * self.samplerate), int(duration * self.samplerate), dtype
+        )
+
+    def __read_indexed(self, start: int, frames: int, dtype: str) -> np.ndarray:
+        """Decodes an Ogg segment from the page in the seek table closest before `start`."""
+        granules = self.table["granule"]
+        header_end = int(self.table["offset"][0])
+        total = int(granules[-1])
+
+        # Page k starts right after page k - 1, so its audio begins at granules[k - 1].
+        page = int(np.searchsorted(granules, start - PREROLL, side="right"))
+        while page > 0:
+            with sf.SoundFile(
+                SpliceFile(self.filename, header_end, int(self.table["offset"][page]))
+            ) as f:
+                first = total - f.frames
+                if first <= start:
+                    f.seek(start - first)
+                    return f.read(frames, dtype=dtype, always_2d=True)
+            page -= 1
+
+        with sf.SoundFile(str(self.filename)) as f:
+            f.seek(start)
+            return f.read(frames, dtype=dtype, always_2d=True)
@@ -5,11 +5,24 @@ import numpy as np
 import sys
 import queue
 import datetime
-from time import sleep
 import concurrent.futures
 import os
 import pathlib
+import signal
+import threading
+import time
 import src.autolisten.tools as tools
+from src.autolisten.features import FeatureExtractor
+from src.autolisten.manifest import add_entry
+from src.autolisten.sinks import TeeWriter, clashing, open_sound_file
+from src.autolisten.tap import TapServer
+from src.autolisten.profiler import MAX_PROFILE_SECONDS, Profiler
+from src.autolisten.scheduler import WriterScheduler
+from src.autolisten.devices import REGISTRY
+from src.autolisten.fleet import FleetClient, FleetError
+from src.autolisten.shipper import Shipper, cleanup_shipped
+from src.autolisten.timing import SampleClock, report_dropouts
+from src.autolisten.supervisor import DeviceSupervisor, DeviceLost, STALL_TIMEOUT
 
 
 assert np
@@ -22,6 +35,10 @@ from src.autolisten.tools import (
     MINUTE,
     BLOCKSIZE,
     HOUR,
+    FORMATS,
+    SHUTDOWN_TIMEOUT,
+    MAX_QUALITY,
+    MAX_COMPLEXITY,
 )
 
 
@@ -39,79 +56,201 @@ class StatusError(Exception):
 class RecordAudio:
     """Creates an audio instance to record data from the input stream and add it to the queue."""
 
-    def __init__(self, record_time: int, channels: int, device: int):
-        """Creates instance of RecordAudio Class creating an input sound stream and making it playable."""
-        print("DEVICE:", device)
+    def __init__(
+        self,
+        record_time: int,
+        channels: int,
+        device: int,
+        segment_end: threading.Event = None,
+        supervisor: DeviceSupervisor = None,
+        tap: TapServer = None,
+    ):
+        """Creates instance of RecordAudio Class creating an input sound stream and making it playable.
+        Setting `segment_end` ends the recording before its alloted time has passed.
+        The device may be an index or a name. It is resolved through the cached device registry.
+        Streams are opened through the `supervisor`, which reopens them when the device fails.
+        Every block captured is also published to the live `tap`, if any.
+        """
         self.duration = record_time
-        if device == -1:
-            self.device = None
-        else:
-            self.device = device
+        self.channels = channels
+        self.segment_end = segment_end if segment_end is not None else threading.Event()
+        self.supervisor = (
+            supervisor if supervisor is not None else DeviceSupervisor(device)
+        )
+        self.deadline = time.monotonic() + record_time
+        self.created = time.time()
+        self.queue = queue.Queue()
+        self.frames = 0
+        self.gaps = []
+        self.clock = SampleClock()
+        self.tap = tap
+        self.sounds_stream: sd.InputStream = self.__open()
+
+    def __open(self) -> sd.InputStream:
+        """Opens a stream on the supervised device and notes the gap it ends, if any."""
         try:
-            self.sounds_stream: sd.InputStream = sd.InputStream(
-                samplerate=FS,
-                blocksize=BLOCKSIZE,
-                channels=channels,
-                dtype=np.int32,
-                callback=self.__callback,
-                device=self.device,
+            stream, gap = self.supervisor.open(
+                self.__stream, self.deadline, self.segment_end
             )
-
-        except sd.PortAudioError as e:
-            # If we cant open an audio stream, quit the program.
+        except DeviceLost as e:
             sys.stderr.write("Port Audio Error: %s\n" % e)
             raise e
-
-        self.queue = queue.Queue()
+        if gap is not None:
+            # Only the part of the outage after this segment was started belongs to its timeline.
+            padded = round((gap["end"] - max(gap["start"], self.created)) * FS)
+            self.__pad(max(0, padded))
+            gap["offset"] = self.frames
+            gap["padded"] = max(0, padded)
+            self.gaps.append(gap)
+        self.last_block = time.monotonic()
+        self.last_audio = time.time()
+        self.clock.reset()
+        return stream
+
+    def __stream(self, device) -> sd.InputStream:
+        return REGISTRY.open_stream(
+            device,
+            samplerate=FS,
+            blocksize=BLOCKSIZE,
+            channels=self.channels,
+            dtype=np.int32,
+            callback=self.__callback,
+        )
 
     def record(self):
         """Begin recording a stream.
-        Will continue to record until the alloted time has passed and will then stop."""
+        Will continue to record until the alloted time has passed and will then stop.
+        If the device fails the stream is reopened and recording continues until the same deadline.
+        """
         if VERBOSE:
             sys.stdout.write(
                 f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Starting Recording...\n"
             )
-        with self.sounds_stream:
-            sd.sleep(int(self.duration * 1000))
+        while True:
+            try:
+                with self.sounds_stream:
+                    error = self.__wait()
+            except sd.PortAudioError as e:
+                error = e
+            if error is None:
+                return
+            self.supervisor.failed(error, self.last_audio)
+            try:
+                self.sounds_stream = self.__open()
+            except DeviceLost:
+                # The segment keeps the audio recorded before the device was lost.
+                return
+
+    def __pad(self, frames: int):
+        """Queues `frames` frames of silence for audio that was lost, so one second of file stays one second of time.
+        Only the number of frames is queued. The writer builds the silence, so the callback never allocates it.
+        """
+        if frames > 0:
+            self.queue.put(frames)
+            self.frames += frames
+
+    def __wait(self):
+        """Waits for the end of the segment. Returns an error if the stream stops delivering audio first."""
+        while True:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0 or self.segment_end.wait(
+                min(remaining, STALL_TIMEOUT / 2)
+            ):
+                return None
+            if (
+                not self.sounds_stream.active
+                or time.monotonic() - self.last_block > STALL_TIMEOUT
+            ):
+                return StatusError("The input stream stopped delivering audio.")
 
     def __callback(
-        self, indata: np.ndarray, frames: int, time, status: sd.CallbackFlags
+        self, indata: np.ndarray, frames: int, time_info, status: sd.CallbackFlags
     ):
         """Streaming callback function. Returns None and only adds data to the queue"""
 
-        del frames, time
+        self.last_block = time.monotonic()
+        self.last_audio = time.time()
+        dropped = self.clock.update(
+            self.frames, frames, time_info, status.input_overflow
+        )
+        self.__pad(dropped)
+        self.frames += frames
         # Must have an error if status is true
         if status:
             sys.stderr.write("%s\n" % status)
 
             # Need a copy and not a reference so we must copy the array.
-        self.queue.put(indata.copy())
+        block = indata.copy()
+        self.queue.put(block)
+        if self.tap is not None:
+            self.tap.publish(block)
 
 
 class WriterStream:
     """Creates a sound file and writes audio data from an input stream to a file of a specified name.
-    Requires that files use the .ogg extension.
+    Requires that files use the extension of the chosen format in `FORMATS`.
+    Every block written is also handed to each of the optional pipeline `stages`.
     """
 
     def __init__(
-        self, record_time: int, filename: pathlib.Path, channels: int, device: int
+        self,
+        record_time: int,
+        filename: pathlib.Path,
+        channels: int,
+        device: int,
+        stages: list = None,
+        file_format: str = "OGG",
+        seek_table: bool = False,
+        segment_end: threading.Event = None,
+        supervisor: DeviceSupervisor = None,
+        checksum: bool = False,
+        encoder: dict = None,
+        tees: list = None,
+        tap: TapServer = None,
     ):
-        """Creates an instande of the sound file and writes audio data"""
+        """Creates an instande of the sound file and writes audio data.
+        When `seek_table` is set, Ogg segments also get a seek table written as they are encoded.
+        When `checksum` is set, the checksum of the encoded file is computed as it is written and added to the manifest of its directory.
+        `encoder` holds the settings of the encoder returned by `tools.encoder_options`.
+        Each `Sink` of `tees` gets a further file encoded from the same blocks in its own thread, listed in `outputs`.
+        The blocks are also published to the live `tap` as they are captured.
+        The sidecar of the segment holds its frame count, the ADC and wall clock time of its first frame,
+        the frames the device dropped and the gaps left by device failures.
+        """
         assert record_time > 0, "ERROR: Time must be greater than 0"
-        assert str(filename)[-4:] == ".ogg", "Must create file with ogg."
-
-        self.record: RecordAudio = RecordAudio(record_time, channels, device)
+        assert file_format in FORMATS, "Unsupported file format."
+        extension = FORMATS[file_format][0]
+        assert str(filename).endswith(
+            extension
+        ), f"Must create file with {extension[1:]}."
+
+        self.stages = stages if stages is not None else []
+        self.frames = 0
+        self.encode_time = 0.0
+        self.filename = pathlib.Path(filename)
+        self.record: RecordAudio = RecordAudio(
+            record_time, channels, device, segment_end, supervisor, tap
+        )
+        self.sound_file = self.seek_file = self.hash_file = None
+        self.tees = []
         try:
-            self.sound_file: sf.SoundFile = sf.SoundFile(
-                filename,
-                "x",
-                FS,
-                CHANNELS,
-                sf.default_subtype("OGG"),
-                format="OGG",
+            self.sound_file, self.seek_file, self.hash_file = open_sound_file(
+                filename, file_format, FS, channels, encoder, seek_table, checksum
             )
+            for sink in tees or []:
+                self.tees.append(
+                    TeeWriter(sink, self.filename, channels, seek_table, checksum)
+                )
         except Exception as e:
+            # Nothing was recorded yet, so the stream and the files opened so far are only closed.
+            self.record.sounds_stream.close()
+            for file in (self.sound_file, self.seek_file, self.hash_file):
+                if file is not None:
+                    file.close()
+            for tee in self.tees:
+                tee.close()
             raise e from IOError(e)
+        self.outputs = [tee.filename for tee in self.tees]
         self.read_from_queue()
 
     def read_from_queue(self):
@@ -119,13 +258,53 @@ class WriterStream:
         try:
             with self.sound_file as f:
                 self.record.record()
+                started = time.monotonic()
+                blocks = []
                 while not self.record.queue.empty():
-                    f.write(self.record.queue.get())
+                    block = self.record.queue.get()
+                    if isinstance(block, int):
+                        block = np.zeros((block, self.record.channels), dtype=np.int32)
+                    blocks.append(block)
+                # Every tee encodes the same blocks in a thread of its own while this one writes the main file.
+                with ThreadPoolExecutor(max(1, len(self.tees))) as encoders:
+                    tees = [encoders.submit(tee.write, blocks) for tee in self.tees]
+                    for block in blocks:
+                        f.write(block)
+                        self.frames += len(block)
+                        for stage in self.stages:
+                            stage.process(block)
+                    for tee in tees:
+                        tee.result()
                 f.close()
+                self.encode_time = time.monotonic() - started
+            if self.hash_file is not None:
+                self.hash_file.close()
+                add_entry(
+                    self.filename,
+                    self.hash_file.size,
+                    self.hash_file.checksum,
+                    self.hash_file.chunk_size,
+                )
+            info = self.record.clock.segment(0, self.frames)
+            if self.record.gaps:
+                info["gaps"] = self.record.gaps
+            tools.update_sidecar(self.filename, info)
+            report_dropouts(self.filename, info)
+            for tee in self.tees:
+                tee.close(info)
         except IOError as e:
             sys.stderr.write("ERROR: {0}".format(e))
         except Exception as e:
             sys.stderr.write("ERROR: {0}".format(e))
+        finally:
+            if self.seek_file is not None:
+                self.seek_file.close()
+            if self.hash_file is not None:
+                self.hash_file.close()
+            for tee in self.tees:
+                tee.close()
+            for stage in self.stages:
+                stage.close()
 
 
 class DelayedError(Exception):
@@ -152,6 +331,22 @@ class Recorder:
         sound_device: int = -1,
         delay: int = 0,
         closest: int = 0,
+        features: bool = False,
+        file_format: str = "OGG",
+        seek_table: bool = False,
+        shutdown_timeout: int = SHUTDOWN_TIMEOUT,
+        max_writers: int = None,
+        degrade: bool = True,
+        fallback_device: int = None,
+        coordinator: str = None,
+        node: str = None,
+        shipper: Shipper = None,
+        quality: float = None,
+        complexity: int = None,
+        tees: list = None,
+        tap: TapServer = None,
+        schedule=None,
+        profile: float = None,
     ):
         """### Main base start for recorder module.
         - location - specifies the location of the file to save the recordings.
@@ -164,6 +359,23 @@ class Recorder:
         - long_recording - specify whether the program should use timeout and filelength in hours and minutes respectively.
         - sound_device - specify the device the program should use.
         - delay - specify the duration of time in mintues for each file length and to begin recording at the nearest multiple on the hour.
+        - closest - specify the closest multiple of the hour to begin recording at when running in delayed mode.
+        - features - specify whether mel band energies should be computed during capture and stored in each day directory.
+        - file_format - specify the output format of the recordings. One of the keys of `FORMATS`. Default is OGG.
+        - seek_table - specify whether Ogg recordings should be written with a seek table for fast random access.
+        - shutdown_timeout - specify how many seconds to wait for the current files to be finished when stopped.
+        - max_writers - specify the number of threads writing files. Defaults to one per core plus one.
+        - degrade - specify whether files may switch to a cheaper format when writing falls behind. Default is True.
+        - fallback_device - specify the device to record from when `sound_device` keeps failing.
+        - coordinator - specify the `host:port` of a fleet coordinator. Its schedule replaces `filelen` and `delay`.
+        - node - specify the name reported to the coordinator. Defaults to the host name.
+        - shipper - specify a `Shipper` to hand every finished file to. Retention keeps days with files not shipped yet.
+        - quality - specify the Vorbis quality of OGG files from 0 to 10. Lower quality is cheaper to encode. Defaults to the libsndfile default.
+        - complexity - specify the compression level of FLAC files from 0 to 8. Lower levels are cheaper to encode. Defaults to the libsndfile default.
+        - tees - specify a list of `Sink` for further files encoded from the same capture as each recording, such as a low rate preview.
+        - tap - specify a `TapServer` to stream the live capture to. Its listeners cannot slow the recording down.
+        - schedule - specify a `DutyCycle` or `Windows` to record in. Between windows no stream is open and the recorder sleeps. The timeout includes that time.
+        - profile - specify to profile every thread for this many seconds once recording starts. Profiles are written next to auto.log and can also be started with `toggle_profile`.
         """
         assert os.path.exists(location), "You have not specified a valid path."
         assert timeout > 0, "The timeout must be greater than zero. "
@@ -173,6 +385,25 @@ class Recorder:
             ), "The timeout must be greater than the length of the file."
         assert filelen >= 0, "The file length must be greater than 0"
         assert channels > 0, "The channels must be greater than zero"
+        assert file_format in FORMATS, "The file format is not supported."
+        assert (
+            quality is None or 0 <= quality <= MAX_QUALITY
+        ), f"The quality must be between 0 and {MAX_QUALITY}"
+        assert (
+            complexity is None or 0 <= complexity <= MAX_COMPLEXITY
+        ), f"The complexity must be between 0 and {MAX_COMPLEXITY}"
+        assert all(
+            channel < channels for sink in tees or [] for channel in sink.channels or ()
+        ), f"The channels of a tee must be below {channels}"
+        assert not clashing(
+            tees or []
+        ), "Two tees write the same file. Give them different names"
+        assert (
+            schedule is None or coordinator is None
+        ), "A schedule cannot be combined with a fleet coordinator"
+        assert (
+            profile is None or 0 < profile <= MAX_PROFILE_SECONDS
+        ), f"The profile must last between 0 and {MAX_PROFILE_SECONDS} seconds"
         if deletion != -1:
             assert isinstance(deletion, int), "Deletion must be an integer"
             assert deletion > 0, "Deletion must be greater than 0"
@@ -187,13 +418,9 @@ class Recorder:
 
         self.background = background
 
+        tools.setup_logs(self.background)
         if self.background:
-            sys.stdout = open(os.path.join(os.getcwd(), "auto.log"), "a")
-            sys.stderr = open(os.path.join(os.getcwd(), "auto.log"), "a")
             self.verbose = True
-        else:
-            sys.stdout = tools.WriteLog()
-            sys.stderr = tools.ErrorLog()
 
         self.location = pathlib.Path(location)
         self.deletion = deletion
@@ -207,6 +434,29 @@ class Recorder:
         self.files = 0
         self.delay = delay
         self.closest = closest
+        self.features = features
+        self.file_format = file_format
+        self.seek_table = seek_table
+        self.quality = quality
+        self.complexity = complexity
+        self.tees = tees if tees is not None else []
+        self.tap = tap
+        self.schedule = schedule
+        self.profile = profile
+        self.profiler = Profiler(os.getcwd())
+        self.shutdown_timeout = shutdown_timeout
+        self.saved_frames = 0
+        self.scheduler = WriterScheduler(file_format, max_writers, degrade)
+        self.supervisor = DeviceSupervisor(sound_device, fallback_device)
+        self.fleet = FleetClient(coordinator, node) if coordinator else None
+        self.shipper = shipper
+        self.__saved_lock = threading.Lock()
+
+        # Control state shared with the control socket.
+        self.stopped = threading.Event()
+        self.paused = threading.Event()
+        self.wake = threading.Event()
+        self.segment_end = threading.Event()
 
         if self.delay != 0:
 
@@ -239,14 +489,126 @@ class Recorder:
         """
         If the program is running in delayed mode, returns the appropriate delay in seconds.
         """
-        now = datetime.datetime.now()
-        closest_minute = now.minute % self.delay
-        diff_time = self.delay - closest_minute
-        # Return value in seconds
-        return diff_time * MINUTE - now.second
+        return tools.get_wait_time(self.delay)
 
     def record(self):
-        self.__record_loop()
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                handlers[signum] = signal.signal(signum, self.__handle_signal)
+        try:
+            self.__record_loop()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def __handle_signal(self, signum, frame):
+        """Stops the recording when the process is asked to terminate. A second signal exits at once."""
+        del frame
+        if self.stopped.is_set():
+            raise ThreadExit(1)
+        sys.stdout.write(
+            f"Received {signal.Signals(signum).name}. Finishing the current files...\n"
+        )
+        self.stop()
+
+    def add_saved(
+        self,
+        frames: int,
+        encode_time: float = 0.0,
+        filename: pathlib.Path = None,
+        outputs: list = (),
+    ):
+        """Adds the frames of a finished file to the total of audio saved and reports its encode time.
+        In fleet mode the file is also added to the catalog of the coordinator, and it is queued for shipping
+        along with the files of its tees in `outputs`."""
+        with self.__saved_lock:
+            self.saved_frames += frames
+        self.scheduler.record(frames, encode_time, FS)
+        if self.fleet is not None and filename is not None:
+            self.__publish(filename)
+        if self.shipper is not None and filename is not None:
+            self.shipper.submit(filename)
+            for output in outputs:
+                self.shipper.submit(output)
+
+    def __publish(self, filename: pathlib.Path):
+        """Notes the clock offset in the sidecar of a file and adds the file to the catalog of the coordinator."""
+        offset = self.fleet.offset
+        tools.update_sidecar(filename, {"clock_offset": offset})
+        info = tools.read_sidecar(filename)
+        info.pop("anchors", None)
+        if "start_time" in info:
+            info["fleet_time"] = info["start_time"] + offset
+        info["file"] = str(pathlib.Path(filename).relative_to(self.location))
+        try:
+            self.fleet.publish(info)
+        except FleetError as e:
+            sys.stderr.write(f"WARNING: {e}\n")
+
+    def __report(self):
+        """Refreshes the clock offset and sends the health of the recorder to the coordinator."""
+        try:
+            self.fleet.sync()
+            self.fleet.report(self.status())
+        except FleetError as e:
+            sys.stderr.write(f"WARNING: {e}\n")
+
+    def status(self) -> dict:
+        """Returns a summary of the state of the recorder."""
+        if self.stopped.is_set():
+            state = "stopping"
+        elif self.paused.is_set():
+            state = "paused"
+        else:
+            state = "recording"
+        status = {
+            "state": state,
+            "pid": os.getpid(),
+            "location": str(self.location),
+            "files": self.files,
+            "secs_passed": self.secs_passed,
+            "timeout": self.timeout * MINUTE,
+            "filelen": self.filelen,
+            **self.scheduler.status(),
+            **self.supervisor.status(),
+        }
+        if self.fleet is not None:
+            status["node"] = self.fleet.node
+            status["clock_offset"] = self.fleet.offset
+        if self.shipper is not None:
+            status.update(self.shipper.status())
+        if self.tap is not None:
+            status.update(self.tap.status())
+        status.update(self.profiler.status())
+        return status
+
+    def stop(self):
+        """Finalizes the current segment and ends the recording loop."""
+        self.stopped.set()
+        self.segment_end.set()
+        self.wake.set()
+
+    def pause(self):
+        """Finalizes the current segment and stops recording until `resume` is called."""
+        self.paused.set()
+        self.segment_end.set()
+        self.wake.set()
+
+    def resume(self):
+        """Resumes recording after a call to `pause`."""
+        if self.paused.is_set():
+            self.paused.clear()
+            self.wake.set()
+
+    def toggle_profile(self, seconds: float = None):
+        """Starts profiling every thread for `seconds`, or ends the running profile and writes it."""
+        self.profiler.toggle(seconds)
+
+    def set_filelen(self, filelen: int):
+        """Changes the length of time in seconds of every segment started from now on."""
+        assert filelen > 0, "The file length must be greater than 0"
+        self.filelen = filelen
 
     def __record_loop(self):
         """
@@ -260,29 +622,101 @@ class Recorder:
         else:
             timelong = self.timeout
 
-        if self.delay:
+        # Resolving the device up front reports a missing device before any waiting and caches its index.
+        device = REGISTRY.check(self.sound_device, self.channels)
+        if self.verbose:
+            sys.stdout.write(f"Recording from {device.name} ({device.hostapi}).\n")
+
+        if self.fleet is not None:
+            # Segments follow the clock and schedule of the coordinator rather than the clock of this host.
+            offset = self.fleet.sync()
+            self.filelen = self.fleet.period
+            wait_time = self.fleet.until_boundary()
+            sys.stdout.write(
+                f"Joined the fleet at {self.fleet.address[0]}:{self.fleet.address[1]} as {self.fleet.node} with a clock offset of {offset * 1000:.1f} ms. Sleeping for {wait_time:.1f} seconds until the next segment.\n"
+            )
+            self.stopped.wait(wait_time)
+        elif self.delay and self.schedule is None:
             wait_time = self.get_wait_time()
             sys.stdout.write(
                 f"The correct start time has not occured yet. Sleeping for {wait_time} seconds.\n"
             )
-            sleep(wait_time)
+            self.stopped.wait(wait_time)
 
         tools.create_directory(self.location)
         sys.stdout.write(
             f"Starting recordings at {self.location}. Will continue for {int(timelong)} {'hour' if self.long_recording else 'minute'}{'' if timelong  == 1  else 's'}.\n"
         )
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+        if self.profile:
+            self.profiler.start(self.profile)
+
+        scheduler = self.scheduler
+        try:
             # We can count how much time has passed
-            while self.secs_passed < self.timeout * MINUTE:
+            while (
+                self.secs_passed < self.timeout * MINUTE and not self.stopped.is_set()
+            ):
+                if self.paused.is_set():
+                    self.wake.wait()
+                    self.wake.clear()
+                    continue
+
+                if self.schedule is not None:
+                    now = datetime.datetime.now()
+                    window = self.schedule.remaining(now)
+                    if window < 1:
+                        # Nothing is open between windows, so the process sleeps until the next one.
+                        # The timeout may end before the next window starts.
+                        idle = min(
+                            self.schedule.until_next(now),
+                            self.timeout * MINUTE - self.secs_passed,
+                        )
+                        sys.stdout.write(
+                            f"Idle until the next window in {idle:.0f} seconds.\n"
+                        )
+                        sys.stdout.flush()
+                        started = time.monotonic()
+                        self.wake.wait(idle)
+                        self.wake.clear()
+                        self.secs_passed += time.monotonic() - started
+                        continue
+
+                scheduler.wait_for_writer(self.stopped)
+                if self.stopped.is_set():
+                    break
+
+                filelen = self.filelen
+                if self.fleet is not None:
+                    # Ending on the next boundary absorbs any drift of the previous segment.
+                    filelen = self.fleet.until_boundary(min(1, self.fleet.period / 2))
+                    scheduler.submit(self.__report)
+                elif self.schedule is not None:
+                    # The last segment of a window ends with the window.
+                    filelen = max(1, min(filelen, round(window)))
+
+                # Every segment gets its own event so ending it never affects the next one.
+                self.segment_end = threading.Event()
                 try:
-                    future = executor.submit(
+                    future = scheduler.submit_segment(
                         self.run_stream,
-                        self.filelen,
+                        filelen,
                         self.location,
                         self.channels,
-                        executor,
+                        scheduler,
                         self.sound_device,
+                        self.features,
+                        scheduler.file_format,
+                        self.seek_table,
+                        self.segment_end,
+                        self.add_saved,
+                        self.supervisor,
+                        True,
+                        tools.encoder_options(
+                            scheduler.file_format, self.quality, self.complexity
+                        ),
+                        self.tees,
+                        self.tap,
                     )
                 except RuntimeError as e:
                     sys.stderr.write("ERROR: %s\n" % e)
@@ -294,28 +728,56 @@ class Recorder:
                         f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} FILE NO. {self.files+1} out of {int(self.timeout*MINUTE/self.filelen)}\n"
                     )
 
-                sleep(self.filelen)
+                started = time.monotonic()
+                self.wake.wait(filelen)
+                self.wake.clear()
 
                 self.files += 1
-                self.secs_passed += self.filelen
+                self.secs_passed += min(filelen, time.monotonic() - started)
                 if self.curr_date != tools.format_date_now():
                     # create new file
                     tools.create_directory(self.location)
                     if self.deletion != -1:
-
-                        executor.submit(
-                            tools.cleanup_files, self.deletion, self.location
-                        )
+                        scheduler.submit(cleanup_shipped, self.deletion, self.location)
                     self.curr_date = tools.format_date_now()
                 sys.stdout.flush()
                 sys.stderr.flush()
-            executor.shutdown()
+        except ThreadExit:
+            scheduler.shutdown(wait=False)
+            self.profiler.stop()
+            raise
+        try:
+            self.__drain(scheduler)
+        finally:
+            # A profile still running covers the end of the recording too.
+            self.profiler.stop()
 
-        if self.secs_passed >= self.timeout * MINUTE:
+        if self.stopped.is_set():
+            sys.stdout.write(
+                f"Stopped after {self.files} file{'' if self.files == 1 else 's'}. You can now visit your files at {self.location} !\n"
+            )
+        elif self.secs_passed >= self.timeout * MINUTE:
             sys.stdout.write(
                 f"Finished execution. You can now visit your files at {self.location} !\n"
             )
 
+    def __drain(self, scheduler: WriterScheduler):
+        """Waits for the files still being written. When stopped, waits at most `shutdown_timeout` seconds.
+        Raises ThreadExit if files were left unfinished."""
+        timeout = self.shutdown_timeout if self.stopped.is_set() else None
+        _, not_done = concurrent.futures.wait(list(scheduler.pending), timeout=timeout)
+        scheduler.shutdown(wait=not not_done)
+        sys.stdout.write(
+            f"Saved {self.saved_frames / FS:.1f} seconds of audio in {self.files} file{'' if self.files == 1 else 's'}.\n"
+        )
+        if not_done:
+            sys.stderr.write(
+                f"ERROR: {len(not_done)} file{'' if len(not_done) == 1 else 's'} could not be finished within {self.shutdown_timeout} seconds.\n"
+            )
+            sys.stdout.flush()
+            sys.stderr.flush()
+            raise ThreadExit(1)
+
     @staticmethod
     def run_stream(
         time: int,
@@ -323,20 +785,57 @@ class Recorder:
         channels: int,
         executor: ThreadPoolExecutor,
         device: int,
+        features: bool = False,
+        file_format: str = "OGG",
+        seek_table: bool = False,
+        segment_end: threading.Event = None,
+        on_saved=None,
+        supervisor: DeviceSupervisor = None,
+        checksum: bool = False,
+        encoder: dict = None,
+        tees: list = None,
+        tap: TapServer = None,
     ):
 
-        """Thread ran function that creates an instance of the WriterStream and records the audio until done."""
-        dirs = tools.get_filename(time, directory)
+        """Thread ran function that creates an instance of the WriterStream and records the audio until done.
+        `on_saved` is called with the number of frames written, the seconds spent writing them, the filename and the files of the `tees` once the file is finished.
+        A device failure only costs the audio of the outage. The `supervisor` reopens the stream and the session continues.
+        """
+        dirs = tools.get_filename(time, directory, FORMATS[file_format][0])
         if VERBOSE:
             sys.stdout.write(
                 f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Starting new thread..\n"
             )
         try:
-            WriterStream(time, dirs, channels, device)
+            stages = []
+            if features:
+                stages.append(
+                    FeatureExtractor(
+                        dirs.parent, channels, datetime.datetime.now().timestamp()
+                    )
+                )
+            writer = WriterStream(
+                time,
+                dirs,
+                channels,
+                device,
+                stages,
+                file_format,
+                seek_table,
+                segment_end,
+                supervisor,
+                checksum,
+                encoder,
+                tees,
+                tap,
+            )
+            if on_saved is not None:
+                on_saved(
+                    writer.frames, writer.encode_time, writer.filename, writer.outputs
+                )
         except AssertionError as e:
             return (-1, e)
-        except sd.PortAudioError as e:
-            executor.shutdown(wait=False)
+        except DeviceLost as e:
             return (-1, e)
         except Exception as e:
             return (-1, e)
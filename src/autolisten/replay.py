@@ -0,0 +1,152 @@
+import concurrent.futures
+import multiprocessing
+import pathlib
+import time
+from typing import List
+
+import soundfile as sf
+
+import src.autolisten.tools as tools
+from src.autolisten.features import FEATURE_FILE, FEATURE_HEADER, FeatureExtractor
+from src.autolisten.tools import BLOCKSIZE, FS
+
+# This module replays recorded segments through the pipeline stages of the recorder, as fast as they decode.
+# It backfills a new stage over old recordings with the same code that runs during capture.
+
+# Pipeline stages that can be replayed, created like the recorder creates them:
+# with the day directory, the channels and the UNIX time of the first frame of the segment.
+STAGES = {"features": FeatureExtractor}
+# Files each stage writes to a day directory. A day holding any of them has already been processed.
+STAGE_FILES = {"features": (FEATURE_FILE, FEATURE_HEADER)}
+# Capture blocks decoded at once. Stages still receive them one block at a time, as from a device.
+REPLAY_BLOCKS = 64
+
+
+class SegmentSource:
+    """Reads a recorded segment as the blocks of `BLOCKSIZE` frames an input stream would have delivered."""
+
+    def __init__(self, filename: pathlib.Path):
+        self.filename = pathlib.Path(filename)
+        with self.__open() as f:
+            self.channels = f.channels
+            self.samplerate = f.samplerate
+        self.start = tools.segment_start(self.filename)
+
+    def __open(self) -> sf.SoundFile:
+        if tools.get_format(self.filename) == "RAW":
+            # Raw segments are described by their sidecar.
+            info = tools.read_sidecar(self.filename)
+            return sf.SoundFile(
+                str(self.filename),
+                samplerate=info["samplerate"],
+                channels=info["channels"],
+                subtype=info["subtype"],
+                format="RAW",
+            )
+        return sf.SoundFile(str(self.filename))
+
+    def blocks(self):
+        """Yields the int32 blocks of the segment in order."""
+        with self.__open() as f:
+            for chunk in f.blocks(
+                BLOCKSIZE * REPLAY_BLOCKS, dtype="int32", always_2d=True
+            ):
+                # Views of the decoded chunk, so splitting it copies nothing.
+                for offset in range(0, len(chunk), BLOCKSIZE):
+                    yield chunk[offset : offset + BLOCKSIZE]
+
+
+def replay_segment(filename: pathlib.Path, stages: List[str]) -> int:
+    """Feeds a segment through new instances of `stages` and returns the frames replayed."""
+    source = SegmentSource(filename)
+    if source.samplerate != FS:
+        raise ValueError(
+            f"{source.filename.name} is recorded at {source.samplerate} Hz"
+        )
+    pipeline = [
+        STAGES[stage](source.filename.parent, source.channels, source.start)
+        for stage in stages
+    ]
+    frames = 0
+    try:
+        for block in source.blocks():
+            for stage in pipeline:
+                stage.process(block)
+            frames += len(block)
+    finally:
+        for stage in pipeline:
+            stage.close()
+    return frames
+
+
+def replay_day(
+    directory: pathlib.Path, stages: List[str], overwrite: bool = False
+) -> dict:
+    """Replays the segments of a day directory in the order they were recorded.
+    Days already holding the output of a stage are skipped, or cleared first when `overwrite` is set.
+    Returns the files and seconds replayed, and the error of every file that failed."""
+    directory = pathlib.Path(directory)
+    result = {"day": directory.name, "files": 0, "seconds": 0.0, "errors": {}}
+    outputs = [directory / name for stage in stages for name in STAGE_FILES[stage]]
+    if any(path.exists() for path in outputs):
+        if not overwrite:
+            result["skipped"] = True
+            return result
+        for path in outputs:
+            path.unlink(missing_ok=True)
+    segments = sorted(
+        (path for path in directory.iterdir() if tools.is_segment(path)),
+        key=tools.segment_start,
+    )
+    for path in segments:
+        try:
+            frames = replay_segment(path, stages)
+        except Exception as e:
+            result["errors"][path.name] = str(e)
+            continue
+        result["files"] += 1
+        result["seconds"] += frames / FS
+    return result
+
+
+def replay(
+    location: pathlib.Path,
+    stages: List[str],
+    days: List[str] = None,
+    workers: int = None,
+    overwrite: bool = False,
+    on_day=None,
+) -> dict:
+    """Replays every day directory of `location`, or only `days`, with a process per day.
+    Each day runs in a single process, so the segments of a day reach its stores in order.
+    `on_day` is called with the result of every day as it finishes.
+    Returns the totals and the speed, in seconds of audio replayed per second."""
+    for stage in stages:
+        assert stage in STAGES, f"Unknown stage {stage}"
+    directories = sorted(
+        path
+        for path in pathlib.Path(location).iterdir()
+        if path.is_dir() and (days is None or path.name in days)
+    )
+    started = time.monotonic()
+    total = {"days": 0, "skipped": 0, "files": 0, "seconds": 0.0, "errors": 0}
+    # Spawned processes start without the threads and locks of this one.
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, multiprocessing.get_context("spawn")
+    ) as pool:
+        futures = [
+            pool.submit(replay_day, directory, stages, overwrite)
+            for directory in directories
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            total["days"] += 1
+            total["skipped"] += result.get("skipped", False)
+            total["files"] += result["files"]
+            total["seconds"] += result["seconds"]
+            total["errors"] += len(result["errors"])
+            if on_day is not None:
+                on_day(result)
+    total["elapsed"] = time.monotonic() - started
+    total["speed"] = total["seconds"] / total["elapsed"] if total["elapsed"] else 0.0
+    return total
@@ -0,0 +1,178 @@
+import math
+import signal
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from src.autolisten.tools import BLOCKSIZE, FS
+
+# This module passes capture blocks between processes through a ring buffer in shared memory.
+# The capture process only copies each block into the ring. Encoders and analysis run in other processes,
+# so neither their garbage collection nor their share of the GIL can delay the PortAudio callback.
+
+# Seconds of audio the ring holds.
+RING_SECONDS = 10
+# Share of the ring a consumer may fall behind before it skips ahead. The rest is kept free so the
+# capture never writes into a block that is still being read.
+RING_MARGIN = 0.875
+# Seconds a consumer waits when it has read every block, a quarter of a block.
+POLL_INTERVAL = BLOCKSIZE / FS / 4
+
+# Fields of the ring header.
+WRITTEN, CLOSED, CHANNELS, SLOTS = range(4)
+# Fields stored with every block.
+FRAMES, ADC_TIME, CURRENT_TIME, RECEIVED, OVERFLOW = range(5)
+
+
+class SharedRing:
+    """Ring of int32 capture blocks in shared memory, written by one process and read by any number.
+    The header counts the blocks written. A block is copied into its slot before the count is raised, so
+    readers only see complete blocks. Each block carries its PortAudio time info and the wall clock time
+    it was received at.
+    """
+
+    def __init__(self, channels: int = None, slots: int = None, name: str = None):
+        """Creates a ring for `channels` channels holding `slots` blocks, or attaches to the ring `name`."""
+        if name is None:
+            assert channels > 0, "The channels must be greater than zero"
+            slots = slots if slots else math.ceil(RING_SECONDS * FS / BLOCKSIZE)
+            size = 8 * 4 + slots * (8 * 5 + BLOCKSIZE * channels * 4)
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.header = np.ndarray(4, np.int64, self.memory.buf)
+            self.header[:] = (0, 0, channels, slots)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            self.header = np.ndarray(4, np.int64, self.memory.buf)
+        self.channels = int(self.header[CHANNELS])
+        self.slots = int(self.header[SLOTS])
+        self.meta = np.ndarray((self.slots, 5), np.float64, self.memory.buf, 8 * 4)
+        self.data = np.ndarray(
+            (self.slots, BLOCKSIZE, self.channels),
+            np.int32,
+            self.memory.buf,
+            8 * 4 + self.meta.nbytes,
+        )
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    @property
+    def written(self) -> int:
+        """Returns the number of blocks written so far."""
+        return int(self.header[WRITTEN])
+
+    @property
+    def closed(self) -> bool:
+        """Returns whether the capture has ended."""
+        return bool(self.header[CLOSED])
+
+    def put(self, block: np.ndarray, time_info, overflow: bool = False):
+        """Copies a capture block into the next slot. Called from the PortAudio callback."""
+        slot = self.written % self.slots
+        frames = len(block)
+        self.data[slot, :frames] = block
+        self.meta[slot] = (
+            frames,
+            time_info.inputBufferAdcTime,
+            time_info.currentTime,
+            time.time(),
+            overflow,
+        )
+        self.header[WRITTEN] += 1
+
+    def close_writer(self):
+        """Tells the readers that no more blocks will be written."""
+        self.header[CLOSED] = 1
+
+    def close(self):
+        """Detaches from the shared memory. Views returned by `RingReader` must not be used afterwards."""
+        self.meta = None
+        self.data = None
+        self.header = None
+        try:
+            self.memory.close()
+        except BufferError:
+            # A view still held by the caller keeps the memory mapped until the process exits.
+            pass
+
+    def unlink(self):
+        """Frees the shared memory once every process has detached. Called by the creator."""
+        self.memory.unlink()
+
+
+class RingReader:
+    """Reads the blocks of a `SharedRing` in order, without copying them."""
+
+    def __init__(self, ring: SharedRing):
+        self.ring = ring
+        # A reader starts at the oldest block still in the ring.
+        self.position = max(0, ring.written - int(ring.slots * RING_MARGIN))
+        self.lost = 0
+
+    def read(self):
+        """Waits for the next block. Returns a view of its frames, its time info, whether the stream
+        reported an overflow, the wall clock time it was received and the frames skipped because the
+        reader fell behind. Returns None once the capture has ended and every block was read.
+        The view is only valid until the capture wraps around to its slot.
+        """
+        while True:
+            written = self.ring.written
+            if self.position < written:
+                break
+            if self.ring.closed:
+                return None
+            time.sleep(POLL_INTERVAL)
+
+        skipped = 0
+        behind = written - self.position
+        if behind > int(self.ring.slots * RING_MARGIN):
+            skip = behind - int(self.ring.slots * RING_MARGIN)
+            skipped = skip * BLOCKSIZE
+            self.lost += skipped
+            self.position += skip
+
+        slot = self.position % self.ring.slots
+        self.position += 1
+        meta = self.ring.meta[slot]
+        return (
+            self.ring.data[slot, : int(meta[FRAMES])],
+            TimeInfo(meta[ADC_TIME], meta[CURRENT_TIME]),
+            bool(meta[OVERFLOW]),
+            float(meta[RECEIVED]),
+            skipped,
+        )
+
+
+class TimeInfo:
+    """Time info of a block read from the ring, shaped like the one PortAudio hands to callbacks."""
+
+    def __init__(self, adc: float, current: float):
+        self.inputBufferAdcTime = float(adc)
+        self.currentTime = float(current)
+
+
+def capture(name: str, device, stop):
+    """Body of the capture process. Streams from `device` into the ring `name` until `stop` is set.
+    Nothing but the copy into the ring runs while the stream is open."""
+    # Ctrl+C reaches every process of the group. The recorder stops the capture through `stop` instead.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import sounddevice as sd
+
+    ring = SharedRing(name=name)
+    try:
+        with sd.InputStream(
+            samplerate=FS,
+            blocksize=BLOCKSIZE,
+            channels=ring.channels,
+            dtype=np.int32,
+            callback=lambda indata, frames, time_info, status: ring.put(
+                indata, time_info, status.input_overflow
+            ),
+            device=device,
+        ):
+            stop.wait()
+    finally:
+        ring.close_writer()
+        ring.close()
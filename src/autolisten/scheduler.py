@@ -0,0 +1,136 @@
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+
+# This module schedules the threads writing segments and keeps them from falling behind.
+
+# Formats tried in order when writers fall behind, from the most to the least expensive to encode.
+DEGRADE_ORDER = ("OGG", "FLAC", "WAV")
+# Number of consecutive segments with idle writers before a more expensive format is tried again.
+RECOVER_AFTER = 3
+# Weight of the newest segment in the moving average of the encode realtime factor.
+SMOOTHING = 0.3
+# Share of the encoding capacity of the writers that may be used before they count as falling behind.
+HEADROOM = 0.8
+
+
+def default_workers() -> int:
+    """Returns the number of writer threads to use: one encoding per core plus the one recording."""
+    return (os.cpu_count() or 1) + 1
+
+
+class WriterScheduler:
+    """Thread pool running one writer per segment.
+    Tracks the segments in flight and their encode realtime factor. When writers fall behind, later
+    segments switch to a cheaper format. When every writer is busy, new segments wait for a free one.
+    """
+
+    def __init__(
+        self, file_format: str = "OGG", max_workers: int = None, degrade: bool = True
+    ):
+        """Creates a scheduler for segments requested in `file_format`."""
+        self.max_workers = max_workers if max_workers else default_workers()
+        assert self.max_workers > 1, "At least two writers are needed"
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.requested = file_format
+        if degrade and file_format in DEGRADE_ORDER:
+            self.ladder = DEGRADE_ORDER[DEGRADE_ORDER.index(file_format) :]
+        else:
+            self.ladder = (file_format,)
+        self.level = 0
+        self.idle_segments = 0
+        self.realtime_factor = None
+        self.waited = 0.0
+        self.blocked = False
+        self.pending = set()
+        self.condition = threading.Condition()
+
+    @property
+    def file_format(self) -> str:
+        """Returns the format the next segment will be written in."""
+        return self.ladder[self.level]
+
+    def submit(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        """Runs a task that is not a segment, such as a cleanup, on the pool."""
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def submit_segment(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        """Runs a segment writer on the pool and tracks it until it is finished."""
+        with self.condition:
+            future = self.executor.submit(fn, *args, **kwargs)
+            self.pending.add(future)
+        future.add_done_callback(self.__finished)
+        return future
+
+    def __finished(self, future: concurrent.futures.Future):
+        with self.condition:
+            self.pending.discard(future)
+            self.condition.notify_all()
+
+    def wait_for_writer(self, stopped: threading.Event) -> float:
+        """Blocks until a writer is free to start the next segment or `stopped` is set.
+        Returns the number of seconds spent waiting, during which no audio is recorded.
+        """
+        started = time.monotonic()
+        with self.condition:
+            while len(self.pending) >= self.max_workers and not stopped.is_set():
+                self.condition.wait(0.5)
+        waited = time.monotonic() - started
+        if waited > 0.5:
+            self.waited += waited
+            self.blocked = True
+            sys.stderr.write(
+                f"WARNING: All {self.max_workers} writers were busy. No audio was recorded for {waited:.1f} seconds.\n"
+            )
+        return waited
+
+    def record(self, frames: int, encode_time: float, samplerate: int):
+        """Updates the encode realtime factor with a finished segment and adapts the format."""
+        if frames <= 0:
+            return
+        factor = encode_time / (frames / samplerate)
+        with self.condition:
+            if self.realtime_factor is None:
+                self.realtime_factor = factor
+            else:
+                self.realtime_factor += SMOOTHING * (factor - self.realtime_factor)
+            self.__adapt()
+
+    def __adapt(self):
+        """Moves down the ladder when writers fall behind and back up once they keep up again."""
+        # One writer is always busy recording, the others are available for encoding.
+        capacity = (self.max_workers - 1) * HEADROOM
+        if self.blocked or self.realtime_factor > capacity:
+            self.blocked = False
+            self.idle_segments = 0
+            if self.level + 1 < len(self.ladder):
+                self.level += 1
+                self.realtime_factor = None
+                sys.stderr.write(
+                    f"WARNING: Writers are falling behind. Switching to {self.file_format}.\n"
+                )
+        elif self.level > 0 and self.realtime_factor < capacity / 2:
+            self.idle_segments += 1
+            if self.idle_segments >= RECOVER_AFTER:
+                self.idle_segments = 0
+                self.level -= 1
+                self.realtime_factor = None
+                sys.stdout.write(
+                    f"Writers caught up. Switching to {self.file_format}.\n"
+                )
+
+    def status(self) -> dict:
+        """Returns a summary of the writers."""
+        return {
+            "writers": len(self.pending),
+            "max_writers": self.max_workers,
+            "format": self.file_format,
+            "realtime_factor": round(self.realtime_factor or 0.0, 3),
+            "waited": round(self.waited, 1),
+        }
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,98 @@
+import pathlib
+import struct
+
+import numpy as np
+
+# This module builds the seek table of compressed segments while they are being encoded.
+
+SEEK_SUFFIX = ".seek"
+# Every entry holds the granule position of a page followed by its byte offset.
+SEEK_DTYPE = np.dtype([("granule", "<i8"), ("offset", "<i8")])
+
+OGG_CAPTURE = b"OggS"
+OGG_HEADER_SIZE = 27
+
+
+def seek_table_path(filename: pathlib.Path) -> pathlib.Path:
+    """Returns the location of the seek table belonging to a segment."""
+    filename = pathlib.Path(filename)
+    return filename.with_name(filename.name + SEEK_SUFFIX)
+
+
+def load_seek_table(filename: pathlib.Path) -> np.ndarray:
+    """Loads the seek table of a segment. Returns an empty table when the segment has none."""
+    path = seek_table_path(filename)
+    if not path.exists():
+        return np.zeros(0, dtype=SEEK_DTYPE)
+    return np.fromfile(path, dtype=SEEK_DTYPE)
+
+
+class SeekTableFile:
+    """File wrapper handed to libsndfile in place of the segment file.
+    Ogg pages are parsed as they pass through `write` and an entry is appended to the seek table for each one.
+    """
+
+    def __init__(self, file, filename: pathlib.Path):
+        """Wraps an open binary file. The seek table is created next to `filename`."""
+        self.file = file
+        self.table = open(seek_table_path(filename), "xb")
+        self.page_start = 0
+        self.remaining = 0
+        self.header = bytearray()
+
+    def write(self, data) -> int:
+        """Writes encoded bytes to the segment and records the start of every page."""
+        view = memoryview(data).cast("B")
+        base = self.file.tell()
+        position = 0
+        while position < len(view):
+            if self.remaining:
+                step = min(self.remaining, len(view) - position)
+                self.remaining -= step
+                position += step
+                continue
+
+            if not self.header:
+                self.page_start = base + position
+            # The page size is only known once the header and its segment table are complete.
+            need = OGG_HEADER_SIZE - len(self.header)
+            if need <= 0:
+                need += self.header[26]
+            step = min(need, len(view) - position)
+            self.header += view[position : position + step]
+            position += step
+            if (
+                len(self.header) >= OGG_HEADER_SIZE
+                and len(self.header) == OGG_HEADER_SIZE + self.header[26]
+            ):
+                self.__add_page()
+
+        self.file.write(data)
+        return len(view)
+
+    def __add_page(self):
+        """Appends the page whose header has been collected to the seek table."""
+        header = bytes(self.header)
+        if header[:4] != OGG_CAPTURE:
+            raise IOError("Encoder output is not an Ogg stream.")
+        granule = struct.unpack_from("<q", header, 6)[0]
+        self.table.write(struct.pack("<qq", granule, self.page_start))
+        self.remaining = sum(header[OGG_HEADER_SIZE:])
+        self.header = bytearray()
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def read(self, size: int = -1) -> bytes:
+        return self.file.read(size)
+
+    def flush(self):
+        self.file.flush()
+        self.table.flush()
+
+    def close(self):
+        self.table.close()
+        self.file.close()
@@ -0,0 +1,72 @@
+import pathlib
+from typing import List
+
+import numpy as np
+import soundfile as sf
+
+import src.autolisten.tools as tools
+from src.autolisten.manifest import HashingFile, add_entry
+from src.autolisten.timing import report_dropouts
+from src.autolisten.tools import FS, FORMATS
+
+# This module writes the files of recorders that cut the capture into segments by sample count.
+
+
+class SegmentFile:
+    """A file holding the frames of a recording from frame `start` on. It is hashed as it is written."""
+
+    def __init__(
+        self,
+        filename: pathlib.Path,
+        channels: int,
+        file_format: str,
+        stages: list,
+        encoder: dict = None,
+    ):
+        self.filename = filename
+        self.channels = channels
+        self.file_format = file_format
+        self.stages = stages
+        self.encoder = encoder if encoder is not None else {}
+        self.start = 0
+        self.frames = 0
+        self.hash_file = None
+        self.sound_file = None
+
+    def open(self):
+        """Creates the file, hashing it as it is written."""
+        self.hash_file = HashingFile(open(self.filename, "x+b"))
+        self.sound_file = sf.SoundFile(
+            self.hash_file,
+            "w",
+            FS,
+            self.channels,
+            FORMATS[self.file_format][1],
+            format=self.file_format,
+            **self.encoder,
+        )
+
+    def write(self, blocks: List[np.ndarray]):
+        """Writes a batch of blocks and hands them to the pipeline stages."""
+        for block in blocks:
+            self.sound_file.write(block)
+            for stage in self.stages:
+                stage.process(block)
+
+    def close(self, timing: dict):
+        """Finishes the file, adds its checksum to the manifest and writes its timestamps to its sidecar."""
+        for stage in self.stages:
+            stage.close()
+        if self.sound_file is not None:
+            self.sound_file.close()
+            self.hash_file.close()
+            add_entry(
+                self.filename,
+                self.hash_file.size,
+                self.hash_file.checksum,
+                self.hash_file.chunk_size,
+            )
+            tools.update_sidecar(self.filename, timing)
+            report_dropouts(self.filename, timing)
+        elif self.hash_file is not None:
+            self.hash_file.close()
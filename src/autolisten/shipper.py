@@ -0,0 +1,433 @@
+import base64
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import queue
+import shutil
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Dict, List
+
+from src.autolisten.tools import FORMATS, cleanup_files, format_date, read_sidecar
+
+# This module copies finished recordings to local or S3 compatible storage in the background.
+
+# Bytes in each part of a multipart transfer. S3 needs at least 5 MiB in every part but the last.
+PART_SIZE = 8 * 1024 * 1024
+# Number of parts transferred at the same time.
+TRANSFERS = 4
+# Name of the file in each day directory recording which of its recordings were shipped.
+SHIP_STATE = ".shipped.json"
+# Seconds waited after a failed transfer before it is tried again. Doubles after every further failure.
+RETRY_START = 5
+# Longest wait in seconds between two attempts at a transfer.
+RETRY_MAX = 300
+# File extensions of recordings, as opposed to sidecars and seek tables.
+EXTENSIONS = tuple(extension for extension, _ in FORMATS.values())
+
+
+class ShipError(Exception):
+    """Raised when a recording could not be shipped or failed verification."""
+
+
+def is_recording(path: pathlib.Path) -> bool:
+    """Returns whether `path` is a recording rather than a sidecar or index."""
+    return path.suffix.lower() in EXTENSIONS
+
+
+def companions(filename: pathlib.Path) -> List[pathlib.Path]:
+    """Returns the sidecar and seek table written next to a recording."""
+    filename = pathlib.Path(filename)
+    return sorted(filename.parent.glob(f"{filename.name}.*"))
+
+
+def read_state(directory: pathlib.Path) -> dict:
+    """Returns the shipping state of a day directory. Empty when nothing was ever queued in it."""
+    try:
+        with open(pathlib.Path(directory) / SHIP_STATE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_state(directory: pathlib.Path, state: dict):
+    path = pathlib.Path(directory) / SHIP_STATE
+    with open(path.with_suffix(".tmp"), "w") as f:
+        json.dump(state, f)
+    os.replace(path.with_suffix(".tmp"), path)
+
+
+def unshipped(directory: pathlib.Path) -> List[str]:
+    """Returns the recordings of a day directory that were queued for shipping but are not verified yet.
+    Retention keeps directories holding such recordings.
+    """
+    directory = pathlib.Path(directory)
+    state = read_state(directory)
+    return [
+        name
+        for name, entry in state.items()
+        if not entry.get("verified") and (directory / name).exists()
+    ]
+
+
+def cleanup_shipped(since: int, location: pathlib.Path) -> bool:
+    """Deletes the day directory `since` days old like `tools.cleanup_files`, unless it holds recordings
+    queued for shipping that are not verified yet. Returns whether it was deleted."""
+    day = format_date(datetime.datetime.now() - datetime.timedelta(days=since))
+    pending = unshipped(pathlib.Path(location) / day)
+    if pending:
+        sys.stderr.write(
+            f"WARNING: Keeping {day} because {len(pending)} recording{'' if len(pending) == 1 else 's'} in it were not shipped yet.\n"
+        )
+        return False
+    return cleanup_files(since, str(location))
+
+
+class RateLimiter:
+    """Token bucket shared by the transfer threads, limiting them to `rate` bytes per second."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, size: int):
+        """Blocks until `size` bytes may be sent."""
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(
+                self.rate, self.allowance + (now - self.last) * self.rate
+            )
+            self.last = now
+            # Going into debt makes later callers wait for earlier ones too.
+            self.allowance -= size
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class LocalBackend:
+    """Stores recordings in a local directory or a mounted network share."""
+
+    def __init__(self, root: pathlib.Path):
+        self.root = pathlib.Path(root)
+        self.uploads = self.root / ".uploads"
+
+    def start(self, key: str) -> str:
+        """Begins a multipart transfer and returns its id."""
+        upload = uuid.uuid4().hex
+        os.makedirs(self.uploads / upload)
+        return upload
+
+    def uploaded(self, key: str, upload: str) -> Dict[int, int]:
+        """Returns the size of each part of a transfer already stored."""
+        parts = self.uploads / upload
+        if not parts.is_dir():
+            raise ShipError(f"The transfer {upload} of {key} no longer exists.")
+        return {
+            int(part.name): part.stat().st_size
+            for part in parts.iterdir()
+            if part.name.isdigit()
+        }
+
+    def put_part(self, key: str, upload: str, number: int, data: bytes, md5: str):
+        path = self.uploads / upload / f"{number:05d}"
+        with open(path.with_suffix(".tmp"), "wb") as f:
+            f.write(data)
+        os.replace(path.with_suffix(".tmp"), path)
+
+    def finish(self, key: str, upload: str, parts: Dict[int, str]):
+        """Joins the parts of a transfer into the stored recording."""
+        target = self.root / key
+        os.makedirs(target.parent, exist_ok=True)
+        partial = target.with_name(target.name + ".partial")
+        with open(partial, "wb") as out:
+            for number in sorted(parts):
+                with open(self.uploads / upload / f"{number:05d}", "rb") as part:
+                    shutil.copyfileobj(part, out)
+        os.replace(partial, target)
+        shutil.rmtree(self.uploads / upload)
+
+    def verify(self, key: str, size: int, sha256: str, parts: Dict[int, str]) -> bool:
+        """Checks the stored recording against the size and SHA-256 of the original."""
+        target = self.root / key
+        if not target.exists() or target.stat().st_size != size:
+            return False
+        digest = hashlib.sha256()
+        with open(target, "rb") as f:
+            for chunk in iter(lambda: f.read(PART_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest() == sha256
+
+    def put(self, key: str, data: bytes):
+        """Stores a small file in one piece."""
+        target = self.root / key
+        os.makedirs(target.parent, exist_ok=True)
+        with open(target.with_name(target.name + ".partial"), "wb") as f:
+            f.write(data)
+        os.replace(target.with_name(target.name + ".partial"), target)
+
+
+class S3Backend:
+    """Stores recordings in an S3 compatible bucket given as `s3://bucket/prefix`. Requires boto3."""
+
+    def __init__(self, url: str, endpoint: str = None):
+        try:
+            import boto3
+        except ImportError as e:
+            raise ShipError("Shipping to S3 requires boto3: pip install boto3") from e
+        bucket, _, prefix = url[len("s3://") :].partition("/")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.client = boto3.client("s3", endpoint_url=endpoint)
+
+    def __key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def start(self, key: str) -> str:
+        return self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=self.__key(key)
+        )["UploadId"]
+
+    def uploaded(self, key: str, upload: str) -> Dict[int, int]:
+        parts = {}
+        paginator = self.client.get_paginator("list_parts")
+        for page in paginator.paginate(
+            Bucket=self.bucket, Key=self.__key(key), UploadId=upload
+        ):
+            for part in page.get("Parts", []):
+                parts[part["PartNumber"]] = part["Size"]
+        return parts
+
+    def put_part(self, key: str, upload: str, number: int, data: bytes, md5: str):
+        self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.__key(key),
+            UploadId=upload,
+            PartNumber=number,
+            Body=data,
+            ContentMD5=base64.b64encode(bytes.fromhex(md5)).decode(),
+        )
+
+    def finish(self, key: str, upload: str, parts: Dict[int, str]):
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.__key(key),
+            UploadId=upload,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": number, "ETag": f'"{md5}"'}
+                    for number, md5 in sorted(parts.items())
+                ]
+            },
+        )
+
+    def verify(self, key: str, size: int, sha256: str, parts: Dict[int, str]) -> bool:
+        """Checks the size and the ETag of a multipart object, the MD5 of the MD5s of its parts."""
+        head = self.client.head_object(Bucket=self.bucket, Key=self.__key(key))
+        digests = b"".join(bytes.fromhex(md5) for _, md5 in sorted(parts.items()))
+        etag = f'"{hashlib.md5(digests).hexdigest()}-{len(parts)}"'
+        return head["ContentLength"] == size and head["ETag"] == etag
+
+    def put(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self.__key(key), Body=data)
+
+
+def open_backend(destination: str, endpoint: str = None):
+    """Returns the backend for an `s3://bucket/prefix` URL or a directory."""
+    if destination.startswith("s3://"):
+        return S3Backend(destination, endpoint)
+    return LocalBackend(pathlib.Path(destination))
+
+
+class Shipper:
+    """Copies finished recordings from `location` to a backend from a background thread.
+    Recordings are sent in parts by a pool of threads and checked once stored. Interrupted transfers resume
+    from the parts already stored. Verified recordings can be deleted locally right away.
+    """
+
+    def __init__(
+        self,
+        location: pathlib.Path,
+        backend,
+        transfers: int = TRANSFERS,
+        bandwidth: float = None,
+        delete: bool = False,
+        part_size: int = PART_SIZE,
+    ):
+        """Ships the recordings of `location`. `bandwidth` limits the transfers in bytes per second."""
+        assert transfers > 0, "At least one transfer is needed"
+        self.location = pathlib.Path(location)
+        self.backend = backend
+        self.transfers = transfers
+        self.limiter = RateLimiter(bandwidth) if bandwidth else None
+        self.delete = delete
+        self.part_size = part_size
+        self.queue = queue.Queue()
+        self.stopped = threading.Event()
+        self.state_lock = threading.Lock()
+        self.thread = None
+        self.shipped = 0
+        self.shipped_bytes = 0
+        self.failed = 0
+
+    def submit(self, filename: pathlib.Path):
+        """Queues a finished recording."""
+        filename = pathlib.Path(filename)
+        self.__update(filename, {})
+        self.queue.put(filename)
+
+    def scan(self) -> int:
+        """Queues the finished recordings under `location` that were not shipped yet. Returns how many."""
+        queued = 0
+        if not self.location.is_dir():
+            return queued
+        for directory in sorted(p for p in self.location.iterdir() if p.is_dir()):
+            state = read_state(directory)
+            for filename in sorted(directory.iterdir()):
+                if not is_recording(filename) or state.get(filename.name, {}).get(
+                    "verified"
+                ):
+                    continue
+                # Recordings get their frame count once they are finished.
+                info = read_sidecar(filename)
+                if "frames" in info or filename.name in state:
+                    self.submit(filename)
+                    queued += 1
+        return queued
+
+    def start(self) -> "Shipper":
+        """Ships queued recordings from a background thread."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, wait: bool = True):
+        """Stops after the current recording. Recordings still queued are picked up by the next `scan`."""
+        self.stopped.set()
+        self.queue.put(None)
+        if wait and self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        """Ships queued recordings until stopped, retrying failed ones with backoff."""
+        delay = RETRY_START
+        while not self.stopped.is_set():
+            filename = self.queue.get()
+            if filename is None:
+                break
+            try:
+                self.ship(filename)
+                delay = RETRY_START
+            except Exception as e:
+                self.failed += 1
+                sys.stderr.write(f"WARNING: Could not ship {filename.name}: {e}\n")
+                self.queue.put(filename)
+                self.stopped.wait(delay)
+                delay = min(delay * 2, RETRY_MAX)
+
+    def key(self, filename: pathlib.Path) -> str:
+        """Returns the name of a file in the backend, its path relative to `location`."""
+        return pathlib.Path(filename).relative_to(self.location).as_posix()
+
+    def __update(self, filename: pathlib.Path, entry: dict):
+        """Merges `entry` into the state of a recording."""
+        with self.state_lock:
+            state = read_state(filename.parent)
+            state[filename.name] = {**state.get(filename.name, {}), **entry}
+            write_state(filename.parent, state)
+            return state[filename.name]
+
+    def ship(self, filename: pathlib.Path):
+        """Ships one recording and its companions. Raises ShipError if the stored copy does not match."""
+        filename = pathlib.Path(filename)
+        entry = self.__update(filename, {})
+        if entry.get("verified") or not filename.exists():
+            return
+        key = self.key(filename)
+        size = os.path.getsize(filename)
+
+        upload = entry.get("upload")
+        stored = {}
+        if upload is not None:
+            try:
+                stored = self.backend.uploaded(key, upload)
+            except Exception:
+                upload = None
+        if upload is None:
+            upload = self.backend.start(key)
+            self.__update(filename, {"upload": upload})
+
+        digest, parts = self.__send(filename, key, upload, stored)
+        self.backend.finish(key, upload, parts)
+        if not self.backend.verify(key, size, digest, parts):
+            self.__update(filename, {"upload": None})
+            raise ShipError(f"The stored copy of {key} does not match.")
+        for companion in companions(filename):
+            self.backend.put(self.key(companion), companion.read_bytes())
+
+        self.__update(filename, {"verified": True, "sha256": digest, "size": size})
+        self.shipped += 1
+        self.shipped_bytes += size
+        if self.delete:
+            for path in [filename] + companions(filename):
+                path.unlink()
+
+    def __send(self, filename: pathlib.Path, key: str, upload: str, stored: dict):
+        """Reads a recording once, hashing every part and sending those not stored yet.
+        Returns the SHA-256 of the recording and the MD5 of each part.
+        """
+        digest = hashlib.sha256()
+        parts = {}
+        in_flight = set()
+        with open(filename, "rb") as f, ThreadPoolExecutor(self.transfers) as pool:
+            number = 1
+            while True:
+                data = f.read(self.part_size)
+                if not data and number > 1:
+                    break
+                digest.update(data)
+                parts[number] = hashlib.md5(data).hexdigest()
+                if stored.get(number) != len(data):
+                    in_flight.add(
+                        pool.submit(
+                            self.__put, key, upload, number, data, parts[number]
+                        )
+                    )
+                # At most two parts per transfer are held in memory.
+                while len(in_flight) >= 2 * self.transfers:
+                    done, in_flight = concurrent.futures.wait(
+                        in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        future.result()
+                if hasattr(os, "posix_fadvise"):
+                    # The recording is read once, so it should not push the recorder out of the page cache.
+                    os.posix_fadvise(f.fileno(), 0, f.tell(), os.POSIX_FADV_DONTNEED)
+                if len(data) < self.part_size:
+                    break
+                number += 1
+            for future in concurrent.futures.as_completed(in_flight):
+                future.result()
+        return digest.hexdigest(), parts
+
+    def __put(self, key: str, upload: str, number: int, data: bytes, md5: str):
+        if self.limiter is not None:
+            self.limiter.acquire(len(data))
+        self.backend.put_part(key, upload, number, data, md5)
+
+    def status(self) -> dict:
+        """Returns a summary of the shipping."""
+        return {
+            "shipped": self.shipped,
+            "shipped_bytes": self.shipped_bytes,
+            "ship_queue": self.queue.qsize(),
+            "ship_failures": self.failed,
+        }
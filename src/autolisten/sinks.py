@@ -0,0 +1,260 @@
+import pathlib
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+import soundfile as sf
+
+import src.autolisten.tools as tools
+from src.autolisten.features import to_float
+from src.autolisten.manifest import HashingFile, add_entry
+from src.autolisten.seektable import SeekTableFile
+from src.autolisten.tools import FS, FORMATS, MAX_COMPLEXITY, MAX_QUALITY
+
+# This module writes the files of a segment. Besides the main file, tee sinks encode the same blocks
+# into further files with their own format, sample rate and channels.
+
+# Taps of the low-pass filter per unit of the factor a sink lowers the sample rate by.
+TAPS_PER_FACTOR = 16
+# Options a sink takes after its format.
+SINK_OPTIONS = ("name", "rate", "channels", "quality", "complexity")
+
+
+class Sink(NamedTuple):
+    """A further file written from the blocks of every segment."""
+
+    file_format: str
+    name: str = ""
+    samplerate: int = FS
+    channels: Tuple[int, ...] = None
+    quality: float = None
+    complexity: int = None
+
+    def filename(self, segment: pathlib.Path) -> pathlib.Path:
+        """Returns the name of the file of this sink for the main file `segment`. A sink without a name is
+        named after its format, so its file never takes the name of the main file or of a segment.
+        """
+        segment = pathlib.Path(segment)
+        name = self.name or self.file_format.lower()
+        return segment.with_name(f"{segment.stem}.{name}{FORMATS[self.file_format][0]}")
+
+
+def parse_sink(text: str) -> Sink:
+    """Parses `FORMAT[:key=value,...]`, with the keys name, rate, channels, quality and complexity.
+    Channels are capture channel numbers joined by `+`, such as `FLAC:channels=0+1`."""
+    file_format, _, options = text.partition(":")
+    file_format = file_format.upper()
+    if file_format not in FORMATS:
+        raise ValueError(f"Unsupported format {file_format}")
+    fields = {}
+    for option in filter(None, options.split(",")):
+        key, _, value = option.partition("=")
+        if key not in SINK_OPTIONS:
+            raise ValueError(f"Unknown sink option {key}")
+        try:
+            if key == "name":
+                fields["name"] = value
+            elif key == "rate":
+                fields["samplerate"] = int(value)
+            elif key == "channels":
+                fields["channels"] = tuple(int(channel) for channel in value.split("+"))
+            elif key == "quality":
+                fields["quality"] = float(value)
+            else:
+                fields["complexity"] = int(value)
+        except ValueError as e:
+            raise ValueError(f"Invalid sink option {option}") from e
+    sink = Sink(file_format, **fields)
+    if not 0 < sink.samplerate <= FS:
+        raise ValueError(f"The sample rate of a sink must be between 1 and {FS}")
+    if FS % sink.samplerate:
+        raise ValueError(f"The sample rate of a sink must divide {FS}")
+    if sink.quality is not None and not 0 <= sink.quality <= MAX_QUALITY:
+        raise ValueError(f"The quality must be between 0 and {MAX_QUALITY}")
+    if sink.complexity is not None and not 0 <= sink.complexity <= MAX_COMPLEXITY:
+        raise ValueError(f"The complexity must be between 0 and {MAX_COMPLEXITY}")
+    return sink
+
+
+def clashing(sinks: List[Sink]) -> List[Sink]:
+    """Returns the sinks that would write the same file as an earlier one."""
+    seen = set()
+    clashes = []
+    for sink in sinks:
+        filename = sink.filename(pathlib.Path("segment"))
+        if filename in seen:
+            clashes.append(sink)
+        seen.add(filename)
+    return clashes
+
+
+def format_sink(sink: Sink) -> str:
+    """Returns the text `parse_sink` parses into `sink`."""
+    options = []
+    if sink.name and sink.name != sink.file_format.lower():
+        options.append(f"name={sink.name}")
+    if sink.samplerate != FS:
+        options.append(f"rate={sink.samplerate}")
+    if sink.channels is not None:
+        options.append("channels=" + "+".join(str(c) for c in sink.channels))
+    if sink.quality is not None:
+        options.append(f"quality={sink.quality}")
+    if sink.complexity is not None:
+        options.append(f"complexity={sink.complexity}")
+    return ":".join([sink.file_format] + ([",".join(options)] if options else []))
+
+
+def open_sound_file(
+    filename: pathlib.Path,
+    file_format: str,
+    samplerate: int,
+    channels: int,
+    encoder: dict = None,
+    seek_table: bool = False,
+    checksum: bool = False,
+):
+    """Creates a segment file. Returns the sound file, the seek table file and the hashing file.
+    The last two are None unless a seek table or a checksum was asked for."""
+    subtype = FORMATS[file_format][1]
+    seek_file = None
+    hash_file = None
+    target, mode = filename, "x"
+    if checksum:
+        hash_file = HashingFile(open(filename, "x+b"))
+        target, mode = hash_file, "w"
+    if seek_table and file_format == "OGG":
+        seek_file = SeekTableFile(
+            target if checksum else open(filename, "xb"), filename
+        )
+        target, mode = seek_file, "w"
+    sound_file = sf.SoundFile(
+        target,
+        mode,
+        samplerate,
+        channels,
+        subtype,
+        format=file_format,
+        **(encoder or {}),
+    )
+    if file_format == "RAW":
+        tools.write_sidecar(
+            filename,
+            {"samplerate": samplerate, "channels": channels, "subtype": subtype},
+        )
+    return sound_file, seek_file, hash_file
+
+
+class Decimator:
+    """Lowers the sample rate by an integer `factor` across consecutive blocks.
+    A windowed sinc filter removes what the lower rate cannot hold, and only the samples kept are computed.
+    """
+
+    def __init__(self, factor: int, channels: int):
+        taps = TAPS_PER_FACTOR * factor + 1
+        t = np.arange(taps) - (taps - 1) / 2
+        # The cutoff sits a little below the new Nyquist frequency to leave room for the transition band.
+        cutoff = 0.9 / factor
+        kernel = cutoff * np.sinc(cutoff * t) * np.hamming(taps)
+        self.kernel = (kernel / kernel.sum()).astype(np.float32)[::-1]
+        self.factor = factor
+        self.history = np.zeros((taps - 1, channels), dtype=np.float32)
+        self.phase = 0
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        """Returns the samples of `block` at the lower rate as float32."""
+        samples = np.concatenate([self.history, to_float(block)])
+        windows = np.lib.stride_tricks.sliding_window_view(
+            samples, len(self.kernel), axis=0
+        )[self.phase :: self.factor]
+        self.phase = (self.phase - len(block)) % self.factor
+        self.history = samples[len(samples) - len(self.history) :]
+        return windows @ self.kernel
+
+
+def scale_timing(timing: dict, factor: int) -> dict:
+    """Converts the timestamps of a segment, described by `SampleClock.segment`, to a rate `factor` times lower."""
+    if factor == 1:
+        return timing
+    timing = dict(timing)
+    timing["samplerate"] = timing["samplerate"] // factor
+    timing["frames"] = -(-timing["frames"] // factor)
+    timing["dropped_frames"] = timing["dropped_frames"] // factor
+    timing["dropouts"] = [
+        {"frame": d["frame"] // factor, "frames": d["frames"] // factor}
+        for d in timing["dropouts"]
+    ]
+    if "anchors" in timing:
+        timing["anchors"] = [
+            {**a, "frame": a["frame"] // factor, "dropped": a["dropped"] // factor}
+            for a in timing["anchors"]
+        ]
+    if "gaps" in timing:
+        timing["gaps"] = [
+            {**g, "offset": g["offset"] // factor, "padded": g["padded"] // factor}
+            for g in timing["gaps"]
+        ]
+    return timing
+
+
+class TeeWriter:
+    """Writes the file of a `Sink` for one segment from the blocks captured for its main file."""
+
+    def __init__(
+        self,
+        sink: Sink,
+        segment: pathlib.Path,
+        channels: int,
+        seek_table: bool = False,
+        checksum: bool = False,
+    ):
+        """Creates the file of `sink` next to the main file `segment`, recorded with `channels` channels."""
+        assert all(
+            0 <= channel < channels for channel in sink.channels or ()
+        ), f"The channels of a sink must be below {channels}"
+        self.sink = sink
+        self.filename = sink.filename(segment)
+        self.channels = list(sink.channels) if sink.channels else None
+        self.factor = FS // sink.samplerate
+        width = len(self.channels) if self.channels else channels
+        self.decimator = Decimator(self.factor, width) if self.factor > 1 else None
+        self.frames = 0
+        self.sound_file, self.seek_file, self.hash_file = open_sound_file(
+            self.filename,
+            sink.file_format,
+            sink.samplerate,
+            width,
+            tools.encoder_options(sink.file_format, sink.quality, sink.complexity),
+            seek_table,
+            checksum,
+        )
+
+    def write(self, blocks: List[np.ndarray]):
+        """Encodes the blocks. They are shared with the other writers of the segment and are not modified."""
+        for block in blocks:
+            if self.channels is not None:
+                block = np.ascontiguousarray(block[:, self.channels])
+            if self.decimator is not None:
+                block = self.decimator.process(block)
+            self.sound_file.write(block)
+            self.frames += len(block)
+
+    def close(self, timing: dict = None):
+        """Finishes the file. With the `timing` of the segment, also adds its checksum to the manifest and
+        writes its timestamps to its sidecar. Without it, as when the segment failed, the file is only closed.
+        """
+        if self.sound_file.closed:
+            return
+        self.sound_file.close()
+        if self.seek_file is not None:
+            self.seek_file.close()
+        if self.hash_file is not None:
+            self.hash_file.close()
+        if timing is None:
+            return
+        if self.hash_file is not None:
+            add_entry(
+                self.filename,
+                self.hash_file.size,
+                self.hash_file.checksum,
+                self.hash_file.chunk_size,
+            )
+        tools.update_sidecar(self.filename, scale_timing(timing, self.factor))
@@ -0,0 +1,115 @@
+import datetime
+import sys
+import threading
+import time
+from typing import Callable, Union
+
+import sounddevice as sd
+
+from src.autolisten.devices import REGISTRY, DeviceError
+
+# This module reopens input streams after the device fails so a recording survives device hiccups.
+
+# Seconds waited after the first failure to open a stream. Doubles after every further failure.
+BACKOFF_START = 0.5
+# Longest wait in seconds between two attempts to open a stream.
+BACKOFF_MAX = 30
+# Number of consecutive failures of the device before the fallback device is tried.
+FALLBACK_AFTER = 2
+# Seconds without a block from an active stream before the device counts as lost.
+STALL_TIMEOUT = 2
+
+
+class DeviceLost(Exception):
+    """Raised when no stream could be opened before the segment had to end."""
+
+
+class DeviceSupervisor:
+    """Opens the input streams of a recording and recovers from device failures.
+    Failed attempts are retried with exponential backoff, switching to the fallback device after repeated
+    failures. The time without audio is reported as a gap by the segment that recovers.
+    Shared by every segment of a recording so an outage spanning several segments is reported once.
+    """
+
+    def __init__(
+        self, device: Union[int, str, None], fallback: Union[int, str, None] = None
+    ):
+        """Supervises streams opened on `device`, falling back to `fallback` when it is given."""
+        self.device = None if device == -1 else device
+        self.fallback = fallback
+        self.current = self.device
+        self.failures = 0
+        self.recoveries = 0
+        self.lost_since = None
+        self.lost_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def failed(self, error: Exception, since: float = None):
+        """Reports that the device failed. `since` is the wall clock time the last audio was received.
+        PortAudio is restarted once no stream is open, so a device plugged back in gets found again.
+        """
+        REGISTRY.invalidate(reinitialize=True)
+        with self.lock:
+            self.failures += 1
+            if self.lost_since is None:
+                self.lost_since = since if since is not None else time.time()
+            if self.fallback is not None and self.failures % FALLBACK_AFTER == 0:
+                self.current = (
+                    self.fallback if self.current == self.device else self.device
+                )
+        sys.stderr.write(f"WARNING: Audio device failed: {error}\n")
+
+    def open(
+        self,
+        factory: Callable[[Union[int, str, None]], sd.InputStream],
+        deadline: float,
+        cancel: threading.Event,
+    ):
+        """Opens a stream by calling `factory` with a device until it succeeds.
+        Gives up with DeviceLost once the monotonic `deadline` passes or `cancel` is set.
+        Returns the stream and the gap it ends as a dict, or None when no audio was lost.
+        """
+        with self.lock:
+            if self.current != self.device and self.failures == 0:
+                # The main device is tried again at the start of every segment.
+                self.current = self.device
+        delay = BACKOFF_START
+        while True:
+            device = self.current
+            try:
+                stream = factory(device)
+                break
+            except (sd.PortAudioError, DeviceError) as e:
+                self.failed(e)
+                error = e
+            wait = min(delay, deadline - time.monotonic())
+            if wait <= 0 or cancel.wait(wait):
+                raise DeviceLost(f"No audio device could be opened: {error}")
+            delay = min(delay * 2, BACKOFF_MAX)
+
+        with self.lock:
+            self.failures = 0
+            if self.lost_since is None:
+                return stream, None
+            now = time.time()
+            gap = {
+                "start": self.lost_since,
+                "end": now,
+                "seconds": round(now - self.lost_since, 3),
+                "device": REGISTRY.resolve(device).name,
+            }
+            self.lost_since = None
+            self.recoveries += 1
+            self.lost_seconds += gap["seconds"]
+        sys.stdout.write(
+            f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Recording resumed on {gap['device']} after {gap['seconds']:.1f} seconds.\n"
+        )
+        return stream, gap
+
+    def status(self) -> dict:
+        """Returns a summary of the outages so far."""
+        return {
+            "device_recoveries": self.recoveries,
+            "device_lost_seconds": round(self.lost_seconds, 1),
+            "device_lost": self.lost_since is not None,
+        }
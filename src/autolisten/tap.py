@@ -0,0 +1,126 @@
+import json
+import queue
+import socket
+import socketserver
+import threading
+
+import numpy as np
+
+from src.autolisten.tools import BLOCKSIZE, FS, TAP_PORT
+
+# This module streams the live capture to listeners over TCP while it is being recorded.
+# Each listener first gets one JSON line describing the stream, then raw little endian int32 frames
+# with the channels interleaved, as in `nc localhost 47801 | tail -n +2 | play -t s32 -r 44100 -c 2 -`.
+
+# Blocks queued for a listener before the oldest are dropped. Bounds the latency to about 93 ms.
+TAP_QUEUE = 4
+# Seconds a listener thread waits for a block before checking whether the tap was closed.
+TAP_POLL = 0.5
+
+
+class TapHandler(socketserver.BaseRequestHandler):
+    """Sends the blocks queued for one listener until it disconnects or the tap is closed."""
+
+    def handle(self):
+        listener = Listener()
+        self.server.add(listener)
+        try:
+            header = {
+                "samplerate": FS,
+                "channels": self.server.channels,
+                "dtype": "<i4",
+                "blocksize": BLOCKSIZE,
+            }
+            self.request.sendall((json.dumps(header) + "\n").encode())
+            while not self.server.closed.is_set():
+                try:
+                    block = listener.queue.get(timeout=TAP_POLL)
+                except queue.Empty:
+                    continue
+                self.request.sendall(block.astype("<i4", copy=False).tobytes())
+        except OSError:
+            # The listener went away. Nothing else depends on it.
+            pass
+        finally:
+            self.server.remove(listener)
+
+
+class Listener:
+    """Bounded queue of the blocks waiting to be sent to one listener."""
+
+    def __init__(self):
+        self.queue = queue.Queue(TAP_QUEUE)
+        self.dropped = 0
+
+    def put(self, block: np.ndarray):
+        """Queues a block without ever waiting. A full queue loses its oldest block instead."""
+        while True:
+            try:
+                self.queue.put_nowait(block)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+
+class TapServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Live tap of a recorder. `publish` hands every captured block to all connected listeners.
+    It never blocks, so a slow or stalled listener only loses blocks of its own and cannot delay the capture.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("localhost", TAP_PORT), channels: int = 2):
+        """Listens on `address` for a capture of `channels` channels."""
+        assert channels > 0, "The channels must be greater than zero"
+        self.channels = channels
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        super().__init__(address, TapHandler)
+
+    def add(self, listener: Listener):
+        with self.lock:
+            self.listeners = self.listeners + [listener]
+
+    def remove(self, listener: Listener):
+        with self.lock:
+            self.listeners = [
+                other for other in self.listeners if other is not listener
+            ]
+
+    def publish(self, block: np.ndarray):
+        """Queues a block for every listener. Called from the capture callback with a block nothing modifies later."""
+        # The list is replaced rather than changed, so it can be read without the lock.
+        for listener in self.listeners:
+            listener.put(block)
+
+    def status(self) -> dict:
+        """Returns the number of listeners and the blocks they lost by falling behind."""
+        listeners = self.listeners
+        return {
+            "listeners": len(listeners),
+            "dropped_blocks": sum(listener.dropped for listener in listeners),
+        }
+
+    def start(self) -> "TapServer":
+        """Serves the tap from a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def server_close(self):
+        self.closed.set()
+        super().server_close()
+
+
+def listen(address, frames: int):
+    """Connects to the tap at `address` and returns its header and the next `frames` frames it sends."""
+    with socket.create_connection(address) as sock:
+        stream = sock.makefile("rb")
+        header = json.loads(stream.readline())
+        data = stream.read(frames * header["channels"] * 4)
+    return header, np.frombuffer(data, header["dtype"]).reshape(-1, header["channels"])
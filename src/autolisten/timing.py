@@ -0,0 +1,119 @@
+import pathlib
+import sys
+import time
+from typing import List
+
+from src.autolisten.tools import FS, BLOCKSIZE
+
+# This module maps the frames of a recording to the ADC clock of the device and to the wall clock.
+
+# Frames a block may arrive late by its ADC time before the frames in between count as dropped, unless the stream
+# reported an overflow.
+LATE_TOLERANCE = BLOCKSIZE // 2
+# Longest dropout in seconds that is filled with silence. Longer jumps of the ADC clock start a new anchor instead.
+MAX_DROPOUT = 10
+
+
+class SampleClock:
+    """Timestamps the frames of a recording from the PortAudio time info of each block.
+    An anchor is set at the first block of every stream and after every dropout. Each anchor holds the position
+    of a frame in the recording, the `inputBufferAdcTime` of that frame and the matching wall clock time.
+    Frames in between are timed by counting samples from the anchor before them.
+    """
+
+    def __init__(self, samplerate: int = FS):
+        self.samplerate = samplerate
+        self.anchors: List[dict] = []
+        self.dropped = 0
+        self.expected = None
+
+    def reset(self):
+        """Starts a new anchor at the next block, for example because the stream was reopened."""
+        self.expected = None
+
+    def update(
+        self,
+        position: int,
+        frames: int,
+        time_info,
+        overflow=False,
+        received: float = None,
+    ) -> int:
+        """Notes a block of `frames` frames that follows frame `position` of the recording.
+        Returns the number of frames the device dropped right before the block. The caller fills them with
+        silence, so the block itself begins at frame `position` plus the frames dropped.
+        `received` is the wall clock time the callback got the block, which defaults to now.
+        """
+        # Some host APIs do not report ADC times, in which case the time of the callback is the closest estimate.
+        # Callbacks jitter with the scheduler, so without an ADC time only an overflow counts as a dropout.
+        measured = bool(time_info.inputBufferAdcTime)
+        adc = time_info.inputBufferAdcTime or time_info.currentTime
+        dropped = 0
+        if self.expected is not None:
+            late = round((adc - self.expected) * self.samplerate)
+            if late > MAX_DROPOUT * self.samplerate:
+                self.expected = None
+            elif late > 0 and (overflow or (measured and late > LATE_TOLERANCE)):
+                dropped = late
+                self.dropped += dropped
+        if self.expected is None or dropped:
+            self.anchors.append(
+                {
+                    "frame": position + dropped,
+                    "adc_time": adc,
+                    "wall_time": (time.time() if received is None else received)
+                    - time_info.currentTime
+                    + adc,
+                    "dropped": dropped,
+                }
+            )
+        self.expected = adc + frames / self.samplerate
+        return dropped
+
+    def locate(self, position: int) -> dict:
+        """Returns the ADC and wall clock time of frame `position`."""
+        before = [a for a in self.anchors if a["frame"] <= position]
+        anchor = before[-1] if before else self.anchors[0]
+        offset = (position - anchor["frame"]) / self.samplerate
+        return {
+            "adc_time": anchor["adc_time"] + offset,
+            "wall_time": anchor["wall_time"] + offset,
+        }
+
+    def segment(self, start: int, frames: int) -> dict:
+        """Returns the timestamps of the `frames` frames beginning at frame `start`, relative to that frame."""
+        if not self.anchors:
+            return {
+                "samplerate": self.samplerate,
+                "frames": frames,
+                "dropped_frames": 0,
+                "dropouts": [],
+            }
+        inside = [a for a in self.anchors if start <= a["frame"] < start + frames]
+        anchors = inside
+        if not inside or inside[0]["frame"] != start:
+            anchors = [{"frame": start, **self.locate(start), "dropped": 0}] + inside
+        return {
+            "samplerate": self.samplerate,
+            "frames": frames,
+            "adc_time": anchors[0]["adc_time"],
+            "start_time": anchors[0]["wall_time"],
+            "dropped_frames": sum(a["dropped"] for a in inside),
+            "dropouts": [
+                {
+                    "frame": max(0, a["frame"] - start - a["dropped"]),
+                    "frames": a["dropped"],
+                }
+                for a in inside
+                if a["dropped"]
+            ],
+            "anchors": [{**a, "frame": a["frame"] - start} for a in anchors],
+        }
+
+
+def report_dropouts(filename: pathlib.Path, timing: dict):
+    """Warns about every dropout of a segment described by `SampleClock.segment`."""
+    for dropout in timing["dropouts"]:
+        sys.stderr.write(
+            f"WARNING: {pathlib.Path(filename).name} lost frames {dropout['frame']} to {dropout['frame'] + dropout['frames']}. They were filled with silence.\n"
+        )
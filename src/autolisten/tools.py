@@ -2,6 +2,8 @@ import shutil
 import os
 import pathlib
 import datetime
+import json
+import re
 import sys
 
 # specifies the number of audio channels to use: Default is 2
@@ -19,12 +21,55 @@ VERBOSE = False
 # Octal signature for full read write execute permissions
 FULL_READ_WRITE_PERMISSIONS = 0o777
 
+# Maps every supported output format to its file extension and sample encoding.
+FORMATS = {
+    "OGG": (".ogg", "VORBIS"),
+    "FLAC": (".flac", "PCM_24"),
+    "WAV": (".wav", "PCM_32"),
+    "RF64": (".rf64", "PCM_32"),
+    "RAW": (".raw", "PCM_32"),
+}
+# Seconds a stopped recording waits for its current files to be finished.
+SHUTDOWN_TIMEOUT = 30
+# Commands understood by the control socket of a background recording.
+CONTROL_COMMANDS = ("status", "stop", "pause", "resume", "length", "profile")
+# Suffix appended to a segment name for its JSON description.
+SIDECAR_SUFFIX = ".json"
+# Port a fleet coordinator listens on when none is given.
+FLEET_PORT = 47800
+# Port the live tap of a recording listens on when none is given.
+TAP_PORT = 47801
+# Port the archive server listens on when none is given.
+ARCHIVE_PORT = 47802
+# Name of the file in each day directory listing the checksum of every segment, one JSON entry per line.
+MANIFEST_FILE = "manifest.jsonl"
+# Suffix of the single file an old day directory is packed into, appended to the name of the day.
+PACK_SUFFIX = ".pack"
+# Name of a segment: its start date and time followed by its planned end time, and a counter when an
+# earlier segment started in the same second.
+SEGMENT_NAME = re.compile(
+    r"(\d{4}-\d{2}-\d{2}--\d{2}-\d{2}-\d{2})--\d{2}-\d{2}-\d{2}(?:_\d+)?"
+)
+# Highest Vorbis quality, on the scale of oggenc. Higher quality is larger and slower to encode.
+MAX_QUALITY = 10
+# Highest FLAC compression level. Higher levels are smaller and slower to encode.
+MAX_COMPLEXITY = 8
+
 
 def days_to_minutes(days: int):
     """Converts days to minutes."""
     return days * 1440
 
 
+def get_wait_time(delay: int) -> int:
+    """Returns the number of seconds until the next multiple of `delay` minutes within the hour."""
+    now = datetime.datetime.now()
+    closest_minute = now.minute % delay
+    diff_time = delay - closest_minute
+    # Return value in seconds
+    return diff_time * MINUTE - now.second
+
+
 def create_directory(location: pathlib.Path) -> bool:
     """Creates a directory in a given location. Returns true on success and false on failure"""
 
@@ -36,6 +81,8 @@ def create_directory(location: pathlib.Path) -> bool:
     try:
         os.mkdir(path, mode=FULL_READ_WRITE_PERMISSIONS)
         os.chmod(path, FULL_READ_WRITE_PERMISSIONS)
+        # Segments add their checksums to the manifest once they are written.
+        open(os.path.join(path, MANIFEST_FILE), "a").close()
     except FileExistsError:
         return False
     else:
@@ -55,6 +102,13 @@ def cleanup_files(since: int, location: str) -> bool:
         print(
             f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Deleting file at location {file}"
         )
+    try:
+        # Packed days are a single file.
+        os.unlink(str(file) + PACK_SUFFIX)
+    except FileNotFoundError:
+        pass
+    else:
+        return True
     try:
         shutil.rmtree(str(file))
     except FileNotFoundError:
@@ -72,16 +126,114 @@ def format_date(date: datetime = datetime.datetime):
     return date.strftime("%Y-%m-%d")
 
 
-def get_filename(record_time: int, directory: str) -> pathlib.Path:
+def get_filename(
+    record_time: int, directory: str, extension: str = ".ogg"
+) -> pathlib.Path:
     """Get the name of the file to record to based on the current date and a directory."""
 
     assert record_time > 0, "ERROR: Recording time must be greater than 0"
 
     return pathlib.Path(
-        f"{directory}/{format_date_now()}/{datetime.datetime.now().strftime('%Y-%m-%d--%H-%M-%S')}--{(datetime.datetime.now() + datetime.timedelta(seconds=record_time)).strftime('%H-%M-%S')}.ogg"
+        f"{directory}/{format_date_now()}/{datetime.datetime.now().strftime('%Y-%m-%d--%H-%M-%S')}--{(datetime.datetime.now() + datetime.timedelta(seconds=record_time)).strftime('%H-%M-%S')}{extension}"
     )
 
 
+def segment_filename(
+    start: float, record_time: float, directory: str, extension: str = ".ogg"
+) -> pathlib.Path:
+    """Returns the name of a segment whose first frame was captured at the UNIX time `start`, in the day
+    directory of that time. A name already taken gets a counter, so no two segments share a file.
+    """
+    began = datetime.datetime.fromtimestamp(start)
+    ended = began + datetime.timedelta(seconds=record_time)
+    name = f"{began:%Y-%m-%d--%H-%M-%S}--{ended:%H-%M-%S}"
+    stem = f"{directory}/{format_date(began)}/{name}"
+    filename = pathlib.Path(stem + extension)
+    counter = 1
+    while filename.exists():
+        counter += 1
+        filename = pathlib.Path(f"{stem}_{counter}{extension}")
+    return filename
+
+
+def get_format(filename: pathlib.Path) -> str:
+    """Returns the output format of a segment based on its extension."""
+    suffix = pathlib.Path(filename).suffix.lower()
+    for file_format, (extension, _) in FORMATS.items():
+        if extension == suffix:
+            return file_format
+    raise ValueError(f"Unsupported segment extension {suffix}")
+
+
+def is_segment(filename: pathlib.Path) -> bool:
+    """Returns whether a file is a recorded segment, rather than a tee, sidecar or other file."""
+    filename = pathlib.Path(filename)
+    extensions = {extension for extension, _ in FORMATS.values()}
+    return filename.suffix in extensions and bool(SEGMENT_NAME.fullmatch(filename.stem))
+
+
+def segment_start(filename: pathlib.Path) -> float:
+    """Returns the wall clock time of the first frame of a segment, from its sidecar or else from its name."""
+    info = read_sidecar(filename)
+    if "start_time" in info:
+        return info["start_time"]
+    started = SEGMENT_NAME.fullmatch(pathlib.Path(filename).stem).group(1)
+    return datetime.datetime.strptime(started, "%Y-%m-%d--%H-%M-%S").timestamp()
+
+
+def encoder_options(
+    file_format: str, quality: float = None, complexity: int = None
+) -> dict:
+    """Returns the libsndfile settings of the encoder of `file_format`.
+    `quality` applies to OGG from 0 to `MAX_QUALITY` and `complexity` to FLAC from 0 to `MAX_COMPLEXITY`.
+    Settings the format does not take are left out, so they survive a switch to a cheaper format.
+    """
+    # libsndfile takes a compression level from 0, the best quality, to 1, the smallest file.
+    if file_format == "OGG" and quality is not None:
+        return {"compression_level": 1 - quality / MAX_QUALITY}
+    if file_format == "FLAC" and complexity is not None:
+        return {"compression_level": complexity / MAX_COMPLEXITY}
+    return {}
+
+
+def sidecar_path(filename: pathlib.Path) -> pathlib.Path:
+    """Returns the location of the JSON description of a segment."""
+    filename = pathlib.Path(filename)
+    return filename.with_name(filename.name + SIDECAR_SUFFIX)
+
+
+def write_sidecar(filename: pathlib.Path, info: dict):
+    """Writes the JSON description of a segment next to it."""
+    with open(sidecar_path(filename), "w") as f:
+        json.dump(info, f)
+
+
+def read_sidecar(filename: pathlib.Path) -> dict:
+    """Reads the JSON description of a segment. Returns an empty dict when it has none."""
+    try:
+        with open(sidecar_path(filename)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def update_sidecar(filename: pathlib.Path, info: dict):
+    """Adds the keys of `info` to the JSON description of a segment, creating it if needed."""
+    sidecar = read_sidecar(filename)
+    sidecar.update(info)
+    write_sidecar(filename, sidecar)
+
+
+def setup_logs(background: bool):
+    """Sends stdout and stderr to auto.log. In the foreground they are also still written to the console."""
+    if background:
+        sys.stdout = open(os.path.join(os.getcwd(), "auto.log"), "a")
+        sys.stderr = open(os.path.join(os.getcwd(), "auto.log"), "a")
+    else:
+        sys.stdout = WriteLog()
+        sys.stderr = ErrorLog()
+
+
 class Log(object):
     """Base Class for both logging and writing to the console and the log file."""
 
@@ -6,6 +6,19 @@ import pathlib
 import time
 import sys
 import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import http.client
+import io
+import base64
+import hashlib
+import json
+import pstats
+from unittest import mock
+from types import SimpleNamespace
+import numpy as np
 from concurrent.futures.thread import ThreadPoolExecutor
 
 
@@ -14,6 +27,32 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
 import src.autolisten.recorder as recorder
 import src.autolisten.tools as tools
 import src.autolisten.delete as delete
+import src.autolisten.features as features
+import src.autolisten.reader as reader
+import src.autolisten.seektable as seektable
+import src.autolisten.daemon as daemon
+import src.autolisten.scheduler as scheduler
+import src.autolisten.asyncrecorder as asyncrecorder
+import src.autolisten.devices as devices
+import src.autolisten.supervisor as supervisor
+import src.autolisten.timing as timing
+import src.autolisten.fleet as fleet
+import src.autolisten.shipper as shipper
+import src.autolisten.manifest as manifest
+import src.autolisten.calibrate as calibrate
+import src.autolisten.ring as ring
+import src.autolisten.processrecorder as processrecorder
+import src.autolisten.sinks as sinks
+import src.autolisten.tap as tap
+import src.autolisten.archive as archive
+import src.autolisten.replay as replay
+import src.autolisten.merge as merge
+import src.autolisten.pack as pack
+import src.autolisten.duty as duty
+import src.autolisten.planner as planner
+import src.autolisten.profiler as profiler
+import src.autolisten.main as main
+import soundfile as sf
 
 
 class TestRecorder(unittest.TestCase):
@@ -86,6 +125,17 @@ class TestTools(unittest.TestCase):
 
 def cleanup_files():
     os.remove(pathlib.Path(os.getcwd() + "/" + "test.ogg"))
+    os.remove(pathlib.Path(os.getcwd() + "/" + "test.ogg" + tools.SIDECAR_SUFFIX))
+
+
+def recordings():
+    """Lists the recordings of today, leaving out their sidecars and the manifest."""
+    path = pathlib.Path(os.getcwd() + "/" + tools.format_date_now())
+    return sorted(
+        f
+        for f in path.iterdir()
+        if not f.name.endswith(tools.SIDECAR_SUFFIX) and f.name != tools.MANIFEST_FILE
+    )
 
 
 def cleanup_dir():
@@ -125,7 +175,7 @@ class TestCommandLine(unittest.TestCase):
     def test_long(self):
         recorder.Recorder(os.getcwd(), 1, -1, 1).record()
         self.assertEqual(
-            len(os.listdir(pathlib.Path(os.getcwd() + "/" + tools.format_date_now()))),
+            len(recordings()),
             60,
         )
         self.addCleanup(cleanup_dir)
@@ -135,7 +185,7 @@ class TestCommandLine(unittest.TestCase):
         rec = recorder.Recorder(os.getcwd(), 1 / 60, -1, 1 / 60, long_recording=True)
         rec.record()
         self.assertEqual(
-            len(os.listdir(pathlib.Path(os.getcwd() + "/" + tools.format_date_now()))),
+            len(recordings()),
             rec.files,
         )
         self.addCleanup(cleanup_dir)
@@ -144,16 +194,48 @@ class TestCommandLine(unittest.TestCase):
         rec = recorder.Recorder(os.getcwd(), 0.5, -1, 1, background=True)
         rec.record()
         self.assertEqual(
-            len(os.listdir(pathlib.Path(os.getcwd() + "/" + tools.format_date_now()))),
+            len(recordings()),
             rec.files,
         )
         self.addCleanup(cleanup_dir)
 
+    def test_respawn(self):
+        argv = [
+            "autolisten",
+            "run",
+            os.getcwd(),
+            "5",
+            "-vb",
+            "-d=-1",
+            "-te",
+            "FLAC:channels=0+1,quality=5",
+            "-sc",
+            "06:00-08:30,22:00-00:00",
+        ]
+        with mock.patch.object(sys, "argv", argv), mock.patch.object(
+            daemon, "spawn", return_value=SimpleNamespace(pid=1)
+        ) as spawn:
+            main.main()
+        child = spawn.call_args[0][0]
+        # The child runs in the foreground with every other option unchanged.
+        self.assertEqual(
+            child,
+            [
+                "run",
+                os.getcwd(),
+                "5",
+                "--verbose",
+                "--tee=FLAC:channels=0+1,quality=5.0",
+                "--schedule=06:00-08:30,22:00-00:00",
+                "--daemon",
+            ],
+        )
+
     def test_sounddevice(self):
         rec = recorder.Recorder(os.getcwd(), 0.5, -1, 1, sound_device=1)
         rec.record()
         self.assertEqual(
-            len(os.listdir(pathlib.Path(os.getcwd() + "/" + tools.format_date_now()))),
+            len(recordings()),
             rec.files,
         )
         self.addCleanup(cleanup_dir)
@@ -172,6 +254,1401 @@ class TestCommandLine(unittest.TestCase):
         self.addCleanup(cleanup_dir)
 
 
+class TestFeatures(unittest.TestCase):
+    def test_filterbank(self):
+        bank = features.mel_filterbank()
+        self.assertEqual(bank.shape, (features.MEL_BANDS, features.FFT_SIZE // 2 + 1))
+        self.assertTrue((bank >= 0).all())
+
+    def test_extractor(self):
+        path = pathlib.Path(os.getcwd() + "/test-features")
+        os.mkdir(path, mode=tools.FULL_READ_WRITE_PERMISSIONS)
+        self.addCleanup(shutil.rmtree, path)
+
+        extractor = features.FeatureExtractor(path, 2, 1000.0)
+        block = np.zeros((recorder.BLOCKSIZE, 2), dtype=np.int32)
+        for _ in range(100):
+            extractor.process(block)
+        extractor.close()
+
+        store = features.load_features(path)
+        self.assertEqual(len(store), 99)
+        self.assertEqual(store["bands"].shape[1:], (2, features.MEL_BANDS))
+        self.assertEqual(store["time"][0], 1000.0)
+        with self.assertRaises(features.FeatureError):
+            features.FeatureExtractor(path, 4, 1000.0)
+
+
+class TestReader(unittest.TestCase):
+    def setUp(self):
+        self.path = pathlib.Path(os.getcwd() + "/test-reader")
+        os.mkdir(self.path, mode=tools.FULL_READ_WRITE_PERMISSIONS)
+        self.addCleanup(shutil.rmtree, self.path)
+        self.audio = (np.random.randn(recorder.FS * 5, 2) * 2**28).astype(np.int32)
+
+    def test_memmap(self):
+        for file_format in ("WAV", "RF64"):
+            name = self.path / ("test" + tools.FORMATS[file_format][0])
+            sf.write(name, self.audio, recorder.FS, "PCM_32", format=file_format)
+            with reader.SegmentReader(name) as segment:
+                self.assertIsInstance(segment.data, np.memmap)
+                self.assertEqual(len(segment), len(self.audio))
+                self.assertTrue(
+                    np.array_equal(segment.read(1000, 500), self.audio[1000:1500])
+                )
+
+    def test_seek_table(self):
+        name = self.path / "test.ogg"
+        seek_file = seektable.SeekTableFile(open(name, "xb"), name)
+        with sf.SoundFile(seek_file, "w", recorder.FS, 2, "VORBIS", format="OGG") as f:
+            for i in range(0, len(self.audio), recorder.BLOCKSIZE):
+                f.write(self.audio[i : i + recorder.BLOCKSIZE])
+        seek_file.close()
+
+        table = seektable.load_seek_table(name)
+        self.assertEqual(table["granule"][-1], len(self.audio))
+        decoded, _ = sf.read(name, dtype="int32")
+        with reader.SegmentReader(name) as segment:
+            self.assertIsNotNone(segment.table)
+            self.assertTrue(
+                np.array_equal(segment.read(150000, 1000), decoded[150000:151000])
+            )
+
+
+class TestControl(unittest.TestCase):
+    def test_commands(self):
+        rec = recorder.Recorder(os.getcwd(), 1, -1, 10)
+        server = daemon.ControlServer(rec, os.getcwd() + "/test.sock").start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        path = pathlib.Path(os.getcwd() + "/test.sock")
+
+        self.assertEqual(daemon.send_command(path, "status")["state"], "recording")
+        self.assertEqual(daemon.send_command(path, "length", 5)["filelen"], 5)
+        self.assertEqual(daemon.send_command(path, "pause")["state"], "paused")
+        self.assertEqual(daemon.send_command(path, "resume")["state"], "recording")
+        self.assertEqual(daemon.send_command(path, "stop")["state"], "stopping")
+        with self.assertRaises(daemon.ControlError):
+            daemon.send_command(path, "length", -1)
+
+    def test_stop(self):
+        rec = recorder.Recorder(os.getcwd(), 1, -1, 30)
+        threading.Timer(2, rec.stop).start()
+        start = time.monotonic()
+        rec.record()
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(rec.files, 1)
+        self.addCleanup(cleanup_dir)
+
+    def test_signal(self):
+        rec = recorder.Recorder(os.getcwd(), 1, -1, 30)
+        threading.Timer(2, os.kill, (os.getpid(), signal.SIGTERM)).start()
+        rec.record()
+        self.assertEqual(rec.files, 1)
+        self.assertGreater(rec.saved_frames, recorder.FS)
+        self.assertEqual(len(rec.scheduler.pending), 0)
+        self.addCleanup(cleanup_dir)
+
+
+class TestScheduler(unittest.TestCase):
+    def test_degrade(self):
+        writers = scheduler.WriterScheduler("OGG", 2)
+        self.addCleanup(writers.shutdown)
+        self.assertEqual(writers.file_format, "OGG")
+        writers.record(recorder.FS, 2.0, recorder.FS)
+        self.assertEqual(writers.file_format, "FLAC")
+        writers.record(recorder.FS, 2.0, recorder.FS)
+        self.assertEqual(writers.file_format, "WAV")
+        for _ in range(scheduler.RECOVER_AFTER):
+            writers.record(recorder.FS, 0.01, recorder.FS)
+        self.assertEqual(writers.file_format, "FLAC")
+
+    def test_back_pressure(self):
+        writers = scheduler.WriterScheduler("WAV", 2)
+        self.addCleanup(writers.shutdown)
+        release = threading.Event()
+        for _ in range(2):
+            writers.submit_segment(release.wait)
+        threading.Timer(1, release.set).start()
+        self.assertGreater(writers.wait_for_writer(threading.Event()), 0.5)
+        self.assertEqual(writers.file_format, "WAV")
+
+
+class TestAsyncRecorder(unittest.TestCase):
+    def test_record(self):
+        rec = asyncrecorder.AsyncRecorder(os.getcwd(), 0.05, -1, 1)
+        rec.record()
+        files = recordings()
+        self.assertEqual(len(files), rec.files)
+        self.assertEqual(sf.info(str(files[0])).frames, recorder.FS)
+        self.assertEqual(rec.saved_frames, rec.captured_frames)
+        self.addCleanup(cleanup_dir)
+
+    def test_failed_write(self):
+        rec = asyncrecorder.AsyncRecorder(os.getcwd(), 0.05, -1, 1)
+        with mock.patch.object(
+            asyncrecorder.AsyncSegment, "open", side_effect=OSError("disk full")
+        ):
+            rec.record()
+        self.assertGreater(rec.captured_frames, 0)
+        self.assertEqual(rec.saved_frames, 0)
+        self.addCleanup(cleanup_dir)
+
+    def test_profile(self):
+        rec = asyncrecorder.AsyncRecorder(os.getcwd(), 0.05, -1, 1)
+        with self.assertRaises(daemon.ControlError):
+            daemon.dispatch(rec, {"command": "profile", "value": 5})
+
+
+class TestDevices(unittest.TestCase):
+    def setUp(self):
+        self.registry = devices.DeviceRegistry()
+        self.default = self.registry.resolve()
+
+    def test_cached(self):
+        with mock.patch.object(
+            devices.sd, "query_devices", wraps=devices.sd.query_devices
+        ) as query:
+            self.registry.resolve(self.default.index)
+            self.registry.resolve(self.default.name)
+            query.assert_not_called()
+            self.registry.invalidate()
+            self.assertEqual(self.registry.resolve(self.default.name), self.default)
+            self.assertEqual(query.call_count, 1)
+
+    def test_resolve_name(self):
+        name = self.default.name
+        self.assertEqual(self.registry.resolve(name.upper()).index, self.default.index)
+        self.assertEqual(self.registry.resolve(name[1:-1]).index, self.default.index)
+        # A name that is only similar is suggested rather than recorded from.
+        typo = name[:-1] + ("x" if name[-1] != "x" else "y")
+        with self.assertRaises(devices.DeviceError) as error:
+            self.registry.resolve(typo)
+        self.assertIn(f"Did you mean '{name}'?", str(error.exception))
+        self.assertNotIn(typo, self.registry.resolved)
+        with self.assertRaises(devices.DeviceError):
+            self.registry.resolve("no such device 0123456789")
+
+    def test_check(self):
+        info = self.registry.check(None, 1)
+        self.assertIn(recorder.FS, self.registry.supported_rates(info.index, 1))
+        with self.assertRaises(devices.DeviceError):
+            self.registry.check(None, info.max_input_channels + 1)
+
+    def test_hotplug(self):
+        stream = self.registry.open_stream(
+            None,
+            samplerate=recorder.FS,
+            channels=1,
+            dtype="int32",
+            callback=lambda *args: None,
+        )
+        with mock.patch.object(
+            devices, "hotplug_signature", return_value="a new card"
+        ), mock.patch.object(devices, "HOTPLUG_INTERVAL", 0), mock.patch.object(
+            devices.sd, "_initialize"
+        ) as initialize:
+            self.registry.query()
+            # PortAudio is not restarted under an open stream.
+            initialize.assert_not_called()
+            stream.close()
+            self.registry.query()
+            initialize.assert_called_once()
+            self.registry.query()
+            initialize.assert_called_once()
+
+
+class TestRecovery(unittest.TestCase):
+    def setUp(self):
+        self.path = pathlib.Path(os.getcwd() + "/test-recovery")
+        os.mkdir(self.path, mode=tools.FULL_READ_WRITE_PERMISSIONS)
+        self.addCleanup(shutil.rmtree, self.path)
+        self.streams = 0
+
+    def flaky(self, failures: int, stall_after: float = None):
+        """Returns a stream factory whose first `failures` calls fail and whose first stream stalls."""
+        stream = recorder.sd.InputStream
+
+        def open_stream(*args, **kwargs):
+            self.streams += 1
+            if self.streams <= failures:
+                raise recorder.sd.PortAudioError("Device unavailable")
+            if stall_after is not None and self.streams == failures + 1:
+                callback = kwargs["callback"]
+                stalls = time.monotonic() + stall_after
+
+                def stalling(*args):
+                    if time.monotonic() < stalls:
+                        callback(*args)
+
+                kwargs["callback"] = stalling
+            return stream(*args, **kwargs)
+
+        return open_stream
+
+    def test_reopen(self):
+        filename = self.path / "test.wav"
+        with mock.patch.object(recorder.sd, "InputStream", self.flaky(2)):
+            writer = recorder.WriterStream(
+                3, filename, recorder.CHANNELS, -1, file_format="WAV"
+            )
+        gaps = tools.read_sidecar(filename)["gaps"]
+        self.assertEqual(len(gaps), 1)
+        # The segment begins with silence for the time the device was missing.
+        self.assertEqual(gaps[0]["offset"], gaps[0]["padded"])
+        self.assertGreater(gaps[0]["seconds"], supervisor.BACKOFF_START)
+        self.assertGreater(writer.frames, 0)
+
+    def test_stall(self):
+        filename = self.path / "test.wav"
+        with mock.patch.object(recorder.sd, "InputStream", self.flaky(0, 1)):
+            writer = recorder.WriterStream(
+                6, filename, recorder.CHANNELS, -1, file_format="WAV"
+            )
+        self.assertEqual(self.streams, 2)
+        gaps = tools.read_sidecar(filename)["gaps"]
+        self.assertEqual(len(gaps), 1)
+        self.assertGreater(gaps[0]["offset"], 0)
+        self.assertGreaterEqual(gaps[0]["seconds"], supervisor.STALL_TIMEOUT)
+        self.assertGreater(writer.frames, gaps[0]["offset"])
+
+    def test_lost(self):
+        with mock.patch.object(recorder.sd, "InputStream", self.flaky(100)):
+            code, error = recorder.Recorder.run_stream(
+                1, self.path, recorder.CHANNELS, None, -1
+            )
+        self.assertEqual(code, -1)
+        self.assertIsInstance(error, supervisor.DeviceLost)
+
+    def test_replug(self):
+        filename = self.path / "test.wav"
+        # A built-in microphone with a similar name must not stand in for the unplugged one.
+        builtin = {
+            "name": "Built-in Microphone",
+            "index": 0,
+            "hostapi": 0,
+            "max_input_channels": 2,
+            "max_output_channels": 0,
+            "default_samplerate": 44100.0,
+        }
+        usb = dict(builtin, name="USB Microphone", index=1)
+        # PortAudio only lists the microphone once it is restarted after the microphone was plugged in.
+        listed = [builtin]
+        opened = []
+        stream = recorder.sd.InputStream
+
+        def query_devices(device=None, kind=None):
+            if kind == "input":
+                return dict(builtin)
+            if device is None:
+                return [dict(d) for d in listed]
+            return dict(listed[device])
+
+        def initialize():
+            listed[:] = [builtin, usb]
+
+        def open_stream(*args, device=None, **kwargs):
+            opened.append(device)
+            return stream(*args, **kwargs)
+
+        registry = devices.DeviceRegistry()
+        with mock.patch.object(recorder, "REGISTRY", registry), mock.patch.object(
+            supervisor, "REGISTRY", registry
+        ), mock.patch.multiple(
+            recorder.sd,
+            query_devices=query_devices,
+            _initialize=initialize,
+            InputStream=open_stream,
+        ):
+            watcher = supervisor.DeviceSupervisor("USB Microphone")
+            recorder.WriterStream(
+                2,
+                filename,
+                recorder.CHANNELS,
+                -1,
+                file_format="WAV",
+                supervisor=watcher,
+            )
+        self.assertEqual(opened, [usb["index"]])
+        self.assertEqual(tools.read_sidecar(filename)["gaps"][0]["device"], usb["name"])
+
+
+class TestTiming(unittest.TestCase):
+    def test_dropped(self):
+        clock = timing.SampleClock(1000)
+        block = recorder.BLOCKSIZE
+        position = 0
+        for adc in (10.0, 10.0 + block / 1000, 10.0 + 4 * block / 1000):
+            time_info = SimpleNamespace(inputBufferAdcTime=adc, currentTime=adc + 0.01)
+            position += clock.update(position, block, time_info) + block
+
+        info = clock.segment(0, position)
+        self.assertEqual(position, 5 * block)
+        self.assertEqual(info["dropped_frames"], 2 * block)
+        self.assertEqual(info["dropouts"], [{"frame": 2 * block, "frames": 2 * block}])
+        self.assertEqual(info["adc_time"], 10.0)
+        self.assertEqual([a["frame"] for a in info["anchors"]], [0, 4 * block])
+        self.assertAlmostEqual(
+            clock.locate(4 * block + 10)["adc_time"], 10.0 + (4 * block + 10) / 1000
+        )
+        later = clock.segment(block, position - block)
+        self.assertAlmostEqual(later["adc_time"], 10.0 + block / 1000)
+        self.assertEqual(later["anchors"][1]["frame"], 3 * block)
+
+    def test_jitter(self):
+        clock = timing.SampleClock(1000)
+        block = recorder.BLOCKSIZE
+        # Without ADC times a late callback is scheduler jitter, not lost audio.
+        for current in (10.0, 10.0 + 4 * block / 1000):
+            time_info = SimpleNamespace(inputBufferAdcTime=0, currentTime=current)
+            self.assertEqual(clock.update(0, block, time_info), 0)
+        time_info = SimpleNamespace(
+            inputBufferAdcTime=0, currentTime=10.0 + 7 * block / 1000
+        )
+        self.assertEqual(clock.update(0, block, time_info, True), 2 * block)
+
+    def test_padding(self):
+        path = pathlib.Path(os.getcwd() + "/test-padding")
+        os.mkdir(path, mode=tools.FULL_READ_WRITE_PERMISSIONS)
+        self.addCleanup(shutil.rmtree, path)
+        stream = recorder.sd.InputStream
+
+        def dropping(*args, **kwargs):
+            callback = kwargs["callback"]
+            blocks = []
+
+            def skip(indata, *args):
+                blocks.append(len(indata))
+                # The 5th to 9th blocks never reach the recorder.
+                if not 5 <= len(blocks) < 10:
+                    callback(indata, *args)
+
+            kwargs["callback"] = skip
+            return stream(*args, **kwargs)
+
+        with mock.patch.object(recorder.sd, "InputStream", dropping):
+            writer = recorder.WriterStream(
+                2, path / "test.wav", recorder.CHANNELS, -1, file_format="WAV"
+            )
+        info = tools.read_sidecar(path / "test.wav")
+        self.assertEqual(info["dropped_frames"], 5 * recorder.BLOCKSIZE)
+        self.assertEqual(info["dropouts"][0]["frame"], 4 * recorder.BLOCKSIZE)
+        self.assertEqual(info["frames"], writer.frames)
+        with reader.SegmentReader(path / "test.wav") as segment:
+            self.assertEqual(len(segment), info["frames"])
+            silence = segment.read(4 * recorder.BLOCKSIZE, 5 * recorder.BLOCKSIZE)
+            self.assertFalse(silence.any())
+
+    def test_sidecar(self):
+        path = pathlib.Path(os.getcwd() + "/test-timing")
+        os.mkdir(path, mode=tools.FULL_READ_WRITE_PERMISSIONS)
+        self.addCleanup(shutil.rmtree, path)
+        before = time.time()
+        writer = recorder.WriterStream(1, path / "test.ogg", recorder.CHANNELS, -1)
+        info = tools.read_sidecar(path / "test.ogg")
+        self.assertEqual(info["frames"], writer.frames)
+        self.assertEqual(info["frames"], sf.info(str(path / "test.ogg")).frames)
+        self.assertEqual(info["dropped_frames"], 0)
+        self.assertLess(abs(info["start_time"] - before), 1)
+
+
+class TestFleet(unittest.TestCase):
+    def setUp(self):
+        self.coordinator = fleet.Coordinator(("localhost", 0), period=2).start()
+        self.addCleanup(self.coordinator.server_close)
+        self.addCleanup(self.coordinator.shutdown)
+        self.address = f"localhost:{self.coordinator.server_address[1]}"
+
+    def test_sync(self):
+        client = fleet.FleetClient(self.address, "node-a")
+        self.addCleanup(client.close)
+        self.assertLess(abs(client.sync()), 0.05)
+        self.assertEqual(client.period, 2)
+        self.assertLessEqual(client.until_boundary(), 2)
+        self.assertGreaterEqual(client.until_boundary(1), 1)
+        with self.assertRaises(fleet.FleetError):
+            client.request("unknown")
+
+    def test_recorder(self):
+        rec = recorder.Recorder(
+            os.getcwd(), 0.1, -1, 1, coordinator=self.address, node="node-a"
+        )
+        rec.record()
+        self.addCleanup(cleanup_dir)
+        self.assertEqual(rec.filelen, 2)
+        self.assertIn("node-a", self.coordinator.dispatch({"command": "nodes"}))
+        catalog = self.coordinator.dispatch({"command": "catalog"})
+        self.assertEqual(len(catalog), rec.files)
+        for segment in catalog:
+            # Segments start on the boundaries of the schedule.
+            self.assertLess(
+                abs(round(segment["fleet_time"] / 2) * 2 - segment["fleet_time"]), 0.2
+            )
+
+
+class FakeS3:
+    """Stands in for the boto3 S3 client, keeping multipart uploads and objects in memory."""
+
+    def __init__(self):
+        self.uploads = {}
+        self.objects = {}
+        self.uploaded_parts = 0
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload = f"upload-{len(self.uploads)}"
+        self.uploads[upload] = {}
+        return {"UploadId": upload}
+
+    def get_paginator(self, operation):
+        assert operation == "list_parts"
+        return SimpleNamespace(paginate=self.__pages)
+
+    def __pages(self, Bucket, Key, UploadId):
+        parts = sorted(self.uploads[UploadId].items())
+        # One part per page, so every page is read.
+        for number, data in parts:
+            yield {"Parts": [{"PartNumber": number, "Size": len(data)}]}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5):
+        assert ContentMD5 == base64.b64encode(hashlib.md5(Body).digest()).decode()
+        self.uploads[UploadId][PartNumber] = Body
+        self.uploaded_parts += 1
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        assert numbers == sorted(parts)
+        digests = b"".join(hashlib.md5(parts[number]).digest() for number in numbers)
+        self.objects[f"{Bucket}/{Key}"] = {
+            "Body": b"".join(parts[number] for number in numbers),
+            "ETag": f'"{hashlib.md5(digests).hexdigest()}-{len(numbers)}"',
+        }
+
+    def head_object(self, Bucket, Key):
+        stored = self.objects[f"{Bucket}/{Key}"]
+        return {"ContentLength": len(stored["Body"]), "ETag": stored["ETag"]}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[f"{Bucket}/{Key}"] = {"Body": Body, "ETag": None}
+
+
+class TestShipper(unittest.TestCase):
+    def setUp(self):
+        root = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, root)
+        self.location = root / "recordings"
+        self.day = self.location / tools.format_date_now()
+        self.day.mkdir(parents=True)
+        self.backend = shipper.LocalBackend(root / "shipped")
+
+    def recording(self, name: str, size: int) -> pathlib.Path:
+        filename = self.day / name
+        filename.write_bytes(os.urandom(size))
+        tools.write_sidecar(filename, {"frames": size})
+        return filename
+
+    def test_ship(self):
+        filename = self.recording("a.wav", 2500)
+        self.recording("b.wav", 10)
+        ship = shipper.Shipper(self.location, self.backend, part_size=1000)
+        self.assertEqual(ship.scan(), 2)
+        ship.queue.put(None)
+        ship.run()
+        stored = self.backend.root / ship.key(filename)
+        self.assertEqual(stored.read_bytes(), filename.read_bytes())
+        self.assertTrue(tools.sidecar_path(stored).exists())
+        self.assertEqual(ship.status()["shipped"], 2)
+        self.assertEqual(shipper.unshipped(self.day), [])
+        # Verified recordings are not queued again.
+        self.assertEqual(ship.scan(), 0)
+
+    def test_resume(self):
+        filename = self.recording("a.wav", 2500)
+        ship = shipper.Shipper(self.location, self.backend, part_size=1000)
+        with mock.patch.object(
+            self.backend, "finish", side_effect=OSError("connection lost")
+        ):
+            with self.assertRaises(OSError):
+                ship.ship(filename)
+        self.assertEqual(shipper.unshipped(self.day), ["a.wav"])
+        with mock.patch.object(
+            self.backend, "put_part", wraps=self.backend.put_part
+        ) as put_part:
+            ship.ship(filename)
+        # The three parts were stored before the connection was lost.
+        put_part.assert_not_called()
+        stored = self.backend.root / ship.key(filename)
+        self.assertEqual(stored.read_bytes(), filename.read_bytes())
+
+    def test_delete(self):
+        filename = self.recording("a.wav", 100)
+        ship = shipper.Shipper(self.location, self.backend, delete=True)
+        ship.submit(filename)
+        with mock.patch.object(self.backend, "verify", return_value=False):
+            with self.assertRaises(shipper.ShipError):
+                ship.ship(filename)
+        self.assertTrue(filename.exists())
+        ship.ship(filename)
+        self.assertFalse(filename.exists())
+        self.assertFalse(tools.sidecar_path(filename).exists())
+
+    def test_retention(self):
+        self.recording("a.wav", 100)
+        shipper.Shipper(self.location, self.backend).scan()
+        self.assertFalse(shipper.cleanup_shipped(0, self.location))
+        self.assertTrue(self.day.exists())
+        delete.delete_folders(self.location, -1)
+        self.assertTrue(self.day.exists())
+
+    def test_s3(self):
+        filename = self.recording("a.wav", 2500)
+        client = FakeS3()
+        boto3 = SimpleNamespace(client=lambda service, endpoint_url=None: client)
+        with mock.patch.dict(sys.modules, {"boto3": boto3}):
+            backend = shipper.open_backend("s3://bucket/prefix")
+        ship = shipper.Shipper(self.location, backend, part_size=1000)
+        with mock.patch.object(
+            client, "complete_multipart_upload", side_effect=OSError("connection lost")
+        ):
+            with self.assertRaises(OSError):
+                ship.ship(filename)
+        self.assertEqual(client.uploaded_parts, 3)
+        # The parts stored before the connection was lost are not sent again.
+        ship.ship(filename)
+        self.assertEqual(client.uploaded_parts, 3)
+        stored = client.objects[f"bucket/prefix/{ship.key(filename)}"]
+        self.assertEqual(stored["Body"], filename.read_bytes())
+        self.assertIn(f"bucket/prefix/{ship.key(filename)}.json", client.objects)
+        self.assertEqual(shipper.unshipped(self.day), [])
+
+    def test_s3_etag(self):
+        filename = self.recording("a.wav", 2500)
+        client = FakeS3()
+        boto3 = SimpleNamespace(client=lambda service, endpoint_url=None: client)
+        with mock.patch.dict(sys.modules, {"boto3": boto3}):
+            backend = shipper.S3Backend("s3://bucket")
+        ship = shipper.Shipper(self.location, backend, part_size=1000)
+        head = client.head_object
+        with mock.patch.object(
+            client,
+            "head_object",
+            lambda **kwargs: {**head(**kwargs), "ETag": '"corrupted-3"'},
+        ):
+            with self.assertRaises(shipper.ShipError):
+                ship.ship(filename)
+        self.assertEqual(shipper.unshipped(self.day), ["a.wav"])
+        # A copy that does not match is uploaded again from the start.
+        ship.ship(filename)
+        self.assertEqual(client.uploaded_parts, 6)
+        self.assertEqual(
+            client.objects[f"bucket/{ship.key(filename)}"]["Body"],
+            filename.read_bytes(),
+        )
+
+    def test_rate_limit(self):
+        limiter = shipper.RateLimiter(10000)
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.acquire(10000)
+        # The first second is allowed right away.
+        self.assertGreaterEqual(time.monotonic() - start, 1.9)
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.location = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.location)
+        self.directory = self.location / tools.format_date_now()
+        self.directory.mkdir()
+
+    def write(self, name: str, file_format: str, chunk_size: int = 4096):
+        """Encodes a short segment through a HashingFile and adds it to the manifest."""
+        filename = self.directory / name
+        hashed = manifest.HashingFile(open(filename, "x+b"), chunk_size)
+        with sf.SoundFile(
+            hashed, "w", tools.FS, 2, tools.FORMATS[file_format][1], format=file_format
+        ) as f:
+            for _ in range(20):
+                f.write(np.random.uniform(-0.5, 0.5, (tools.BLOCKSIZE, 2)))
+        hashed.close()
+        manifest.add_entry(filename, hashed.size, hashed.checksum, chunk_size)
+        return filename, hashed
+
+    def test_hashing(self):
+        for file_format, (extension, _) in tools.FORMATS.items():
+            filename, hashed = self.write("segment" + extension, file_format)
+            self.assertEqual(hashed.size, os.path.getsize(filename))
+            self.assertEqual(hashed.checksum, manifest.file_checksum(filename, 4096))
+            # Header patches land in the first chunk, so nothing is read back.
+            self.assertEqual(hashed.reread, 0)
+
+    def test_rewrite(self):
+        filename = self.directory / "segment.raw"
+        hashed = manifest.HashingFile(open(filename, "x+b"), 100)
+        hashed.write(os.urandom(450))
+        hashed.seek(220)
+        hashed.write(b"rewritten")
+        hashed.seek(0, os.SEEK_END)
+        hashed.write(os.urandom(30))
+        hashed.close()
+        self.assertEqual(hashed.reread, 1)
+        self.assertEqual(hashed.checksum, manifest.file_checksum(filename, 100))
+
+    def test_verify(self):
+        intact, _ = self.write("intact.wav", "WAV")
+        corrupt, _ = self.write("corrupt.wav", "WAV")
+        truncated, _ = self.write("truncated.wav", "WAV")
+        shipped, _ = self.write("shipped.wav", "WAV")
+        with open(corrupt, "r+b") as f:
+            f.seek(5000)
+            f.write(b"\xff" * 4)
+        os.truncate(truncated, 1000)
+        shipped.unlink()
+        shipper.write_state(self.directory, {"shipped.wav": {"verified": True}})
+        (self.directory / "unlisted.wav").write_bytes(b"")
+
+        result = manifest.verify_tree(self.location, workers=2)
+        self.assertEqual(result["checked"], 3)
+        self.assertEqual(set(result["problems"]), {str(corrupt), str(truncated)})
+        self.assertIn("size", result["problems"][str(truncated)])
+        self.assertEqual(result["unlisted"], [str(self.directory / "unlisted.wav")])
+
+    def test_field(self):
+        filename, hashed = self.write("segment.wav", "WAV")
+        entry = manifest.read_manifest(self.directory)["segment.wav"]
+        self.assertEqual(entry[manifest.CHECKSUM_FIELD], hashed.checksum)
+        self.assertNotIn("sha256", entry)
+        # Entries written before the field was named are still verified.
+        entry["sha256"] = entry.pop(manifest.CHECKSUM_FIELD)
+        self.assertIsNone(manifest.verify_file(filename, entry))
+
+    def test_recorder(self):
+        rec = recorder.Recorder(os.getcwd(), 0.05, -1, 1)
+        rec.record()
+        self.addCleanup(cleanup_dir)
+        day = pathlib.Path(os.getcwd()) / tools.format_date_now()
+        entries = manifest.read_manifest(day)
+        self.assertEqual(sorted(entries), [f.name for f in recordings()])
+        result = manifest.verify_tree(day)
+        self.assertEqual(result["problems"], {})
+        self.assertEqual(result["checked"], len(entries))
+
+
+class TestEncoder(unittest.TestCase):
+    def test_options(self):
+        self.assertEqual(tools.encoder_options("OGG", 10), {"compression_level": 0})
+        self.assertEqual(
+            tools.encoder_options("FLAC", 10, 4), {"compression_level": 0.5}
+        )
+        # Settings of other formats are dropped when the writers switch to a cheaper format.
+        self.assertEqual(tools.encoder_options("WAV", 10, 4), {})
+        with self.assertRaises(AssertionError):
+            recorder.Recorder(os.getcwd(), 1, -1, 1, quality=11)
+
+    def test_quality(self):
+        sizes = []
+        for quality in (0, 10):
+            name = f"quality{quality}.ogg"
+            self.addCleanup(os.remove, name)
+            self.addCleanup(os.remove, name + tools.SIDECAR_SUFFIX)
+            recorder.WriterStream(
+                1,
+                name,
+                recorder.CHANNELS,
+                -1,
+                encoder=tools.encoder_options("OGG", quality),
+            )
+            sizes.append(os.path.getsize(name))
+        self.assertLess(sizes[0], sizes[1])
+
+    def test_calibrate(self):
+        results = calibrate.calibrate(["OGG", "WAV"], seconds=0.5)
+        self.assertEqual(len(results), len(calibrate.CALIBRATION_SETTINGS["OGG"]) + 1)
+        for result in results:
+            self.assertGreater(result["realtime_factor"], 0)
+        # Raising the quality costs space.
+        self.assertLess(results[0]["bytes_per_second"], results[-2]["bytes_per_second"])
+
+
+class TestRing(unittest.TestCase):
+    def setUp(self):
+        self.ring = ring.SharedRing(2, slots=8)
+        self.addCleanup(self.ring.unlink)
+        self.addCleanup(self.ring.close)
+
+    def put(self, count: int):
+        for _ in range(count):
+            n = self.ring.written
+            block = np.full((tools.BLOCKSIZE, 2), n, dtype=np.int32)
+            self.ring.put(block, SimpleNamespace(inputBufferAdcTime=n, currentTime=n))
+
+    def test_read(self):
+        attached = ring.SharedRing(name=self.ring.name)
+        self.addCleanup(attached.close)
+        reader = ring.RingReader(attached)
+        self.put(3)
+        for n in range(3):
+            block, time_info, overflow, _, skipped = reader.read()
+            self.assertTrue((block == n).all())
+            self.assertEqual(time_info.inputBufferAdcTime, n)
+            self.assertFalse(overflow)
+            self.assertEqual(skipped, 0)
+        self.ring.close_writer()
+        self.assertIsNone(reader.read())
+
+    def test_overrun(self):
+        reader = ring.RingReader(self.ring)
+        self.put(20)
+        block, _, _, _, skipped = reader.read()
+        # The reader keeps clear of the slots the capture is about to reuse.
+        behind = int(8 * ring.RING_MARGIN)
+        self.assertEqual(skipped, (20 - behind) * tools.BLOCKSIZE)
+        self.assertTrue((block == 20 - behind).all())
+
+    def test_recorder(self):
+        rec = processrecorder.ProcessRecorder(
+            os.getcwd(), 0.05, -1, 1, features=True, file_format="WAV"
+        )
+        rec.record()
+        self.addCleanup(cleanup_dir)
+        files = [f for f in recordings() if f.suffix == ".wav"]
+        self.assertEqual(len(files), rec.files)
+        self.assertGreaterEqual(rec.files, 3)
+        for f in files[:-1]:
+            self.assertEqual(sf.info(str(f)).frames, tools.FS)
+        day = pathlib.Path(os.getcwd()) / tools.format_date_now()
+        self.assertEqual(manifest.verify_tree(day)["problems"], {})
+        self.assertGreater(len(features.load_features(day)), 0)
+
+    def test_encoder_fails(self):
+        location = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, location)
+        # A file in place of the day directory keeps the encoder from writing anything.
+        (location / tools.format_date_now()).touch()
+        rec = processrecorder.ProcessRecorder(location, 1, -1, 1, file_format="WAV")
+        started = time.monotonic()
+        with self.assertRaises(SystemExit) as raised:
+            rec.record()
+        self.assertEqual(raised.exception.code, 1)
+        self.assertEqual(rec.files, 0)
+        self.assertLess(time.monotonic() - started, 30)
+
+    def test_segment_filename(self):
+        location = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, location)
+        start = datetime(2024, 5, 1, 12, 0, 0, 500000).timestamp()
+        first = tools.segment_filename(start, 1, location, ".wav")
+        self.assertEqual(first.name, "2024-05-01--12-00-00--12-00-01.wav")
+        first.parent.mkdir()
+        first.touch()
+        second = tools.segment_filename(start + 0.2, 1, location, ".wav")
+        self.assertEqual(second.name, "2024-05-01--12-00-00--12-00-01_2.wav")
+        self.assertTrue(tools.is_segment(second))
+        self.assertEqual(tools.segment_start(second), start - 0.5)
+
+
+class TestTee(unittest.TestCase):
+    def setUp(self):
+        self.location = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.location)
+        self.directory = self.location / tools.format_date_now()
+        tools.create_directory(self.location)
+
+    def test_parse(self):
+        sink = sinks.parse_sink("ogg:name=preview,rate=22050,channels=0,quality=2")
+        self.assertEqual(sink, sinks.Sink("OGG", "preview", 22050, (0,), 2.0))
+        self.assertEqual(
+            sink.filename(pathlib.Path("day/a.flac")), pathlib.Path("day/a.preview.ogg")
+        )
+        for text in (
+            "MP4",
+            "OGG:rate=48000",
+            "OGG:rate=0",
+            "OGG:rate=-44100",
+            "OGG:rate=",
+            "FLAC:speed=1",
+            "OGG:quality=11",
+            "OGG:quality=",
+        ):
+            with self.assertRaises(ValueError):
+                sinks.parse_sink(text)
+
+    def test_names(self):
+        segment = pathlib.Path(f"day/{tools.format_date_now()}--00-00-00--00-30-00.ogg")
+        # A tee without a name never takes the name of the main file or of a segment.
+        tee = sinks.parse_sink("OGG:rate=22050")
+        self.assertNotEqual(tee.filename(segment), segment)
+        self.assertFalse(tools.is_segment(sinks.parse_sink("FLAC").filename(segment)))
+        self.assertEqual(
+            sinks.clashing([tee, sinks.parse_sink("OGG:name=ogg,channels=0")]),
+            [sinks.Sink("OGG", "ogg", channels=(0,))],
+        )
+        with self.assertRaises(AssertionError):
+            recorder.Recorder(os.getcwd(), 1, -1, 10, tees=[tee, tee])
+
+    def test_decimator(self):
+        t = np.arange(10 * tools.BLOCKSIZE)
+        low = np.sin(2 * np.pi * 440 * t / tools.FS)
+        high = np.sin(2 * np.pi * 18000 * t / tools.FS)
+        block = (np.stack([low, high], axis=1) * 2**30).astype(np.int32)
+        whole = sinks.Decimator(2, 2).process(block)
+        decimator = sinks.Decimator(2, 2)
+        pieces = [
+            decimator.process(block[i : i + 1001]) for i in range(0, len(block), 1001)
+        ]
+        # Splitting the input into blocks of odd length changes nothing.
+        np.testing.assert_allclose(np.concatenate(pieces), whole, atol=1e-6)
+        self.assertEqual(len(whole), len(block) // 2)
+        settled = whole[len(whole) // 2 :]
+        self.assertGreater(np.abs(settled[:, 0]).max(), 0.4)
+        # A tone above the new Nyquist frequency is removed rather than folded down.
+        self.assertLess(np.abs(settled[:, 1]).max(), 0.01)
+
+    def test_writer(self):
+        filename = self.directory / "test.flac"
+        preview = sinks.Sink("OGG", "preview", tools.FS // 2, (1,))
+        writer = recorder.WriterStream(
+            1,
+            filename,
+            recorder.CHANNELS,
+            -1,
+            file_format="FLAC",
+            checksum=True,
+            tees=[preview, sinks.Sink("WAV", "copy")],
+        )
+        self.assertEqual(
+            writer.outputs,
+            [self.directory / "test.preview.ogg", self.directory / "test.copy.wav"],
+        )
+        info = sf.info(str(writer.outputs[0]))
+        self.assertEqual((info.samplerate, info.channels), (tools.FS // 2, 1))
+        self.assertEqual(info.frames, writer.frames // 2)
+        self.assertEqual(
+            tools.read_sidecar(writer.outputs[0])["frames"], writer.frames // 2
+        )
+        original, _ = sf.read(str(filename), dtype="int32")
+        copy, _ = sf.read(str(writer.outputs[1]), dtype="int32")
+        # FLAC keeps 24 of the 32 captured bits.
+        np.testing.assert_array_equal(copy >> 8, original >> 8)
+        self.assertFalse(manifest.verify_tree(self.location)["problems"])
+        self.assertEqual(len(manifest.read_manifest(self.directory)), 3)
+
+    def test_failed_tee(self):
+        filename = self.directory / "test.flac"
+        sinks.Sink("WAV").filename(filename).write_bytes(b"")
+        opened = []
+        open_sound_file = sinks.open_sound_file
+
+        def tracking(*args):
+            files = open_sound_file(*args)
+            opened.append(files[0])
+            return files
+
+        with mock.patch.object(
+            recorder, "open_sound_file", tracking
+        ), mock.patch.object(sinks, "open_sound_file", tracking):
+            with self.assertRaises(OSError):
+                recorder.WriterStream(
+                    1,
+                    filename,
+                    recorder.CHANNELS,
+                    -1,
+                    file_format="FLAC",
+                    tees=[sinks.Sink("OGG", "preview"), sinks.Sink("WAV")],
+                )
+        # The main file and the tee opened before the failure are closed.
+        self.assertEqual(len(opened), 2)
+        self.assertTrue(all(f.closed for f in opened))
+
+
+class TestTap(unittest.TestCase):
+    def setUp(self):
+        self.tap = tap.TapServer(("localhost", 0), 2).start()
+        self.addCleanup(self.tap.server_close)
+        self.addCleanup(self.tap.shutdown)
+
+    def listen(self, frames: int):
+        """Reads `frames` frames from the tap in a thread once it is connected."""
+        received = {}
+        listener = threading.Thread(
+            target=lambda: received.update(
+                zip(("header", "frames"), tap.listen(self.tap.server_address, frames))
+            )
+        )
+        listener.start()
+        while self.tap.status()["listeners"] == 0:
+            time.sleep(0.01)
+        return listener, received
+
+    def test_publish(self):
+        listener, received = self.listen(3 * tools.BLOCKSIZE)
+        blocks = [np.full((tools.BLOCKSIZE, 2), n, dtype=np.int32) for n in range(3)]
+        for block in blocks:
+            self.tap.publish(block)
+        listener.join(5)
+        self.assertEqual(received["header"]["channels"], 2)
+        np.testing.assert_array_equal(received["frames"], np.concatenate(blocks))
+
+    def test_slow_listener(self):
+        listener = tap.Listener()
+        self.tap.add(listener)
+        self.addCleanup(self.tap.remove, listener)
+        started = time.monotonic()
+        for n in range(100):
+            self.tap.publish(np.full((tools.BLOCKSIZE, 2), n, dtype=np.int32))
+        # A listener that reads nothing costs the capture nothing and keeps only the newest blocks.
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(listener.dropped, 100 - tap.TAP_QUEUE)
+        self.assertEqual(listener.queue.get_nowait()[0, 0], 100 - tap.TAP_QUEUE)
+        self.assertEqual(self.tap.status()["dropped_blocks"], 100 - tap.TAP_QUEUE)
+
+    def test_recorder(self):
+        location = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, location)
+        listener, received = self.listen(8 * tools.BLOCKSIZE)
+        writer = recorder.WriterStream(
+            1, location / "test.wav", 2, -1, file_format="WAV", tap=self.tap
+        )
+        listener.join(5)
+        recorded, _ = sf.read(str(writer.filename), dtype="int32")
+        live = received["frames"]
+        self.assertEqual(len(live), 8 * tools.BLOCKSIZE)
+        # The listener hears the same frames as the file, in order.
+        start = int(np.flatnonzero((recorded == live[0]).all(axis=1))[0])
+        np.testing.assert_array_equal(recorded[start : start + len(live)], live)
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.location = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.location)
+        self.start = datetime.now().replace(hour=12, minute=0, second=0).timestamp()
+        # Two segments of three seconds, one after the other, holding a frame counter.
+        self.audio = np.repeat(np.arange(6 * tools.FS, dtype=np.int32)[:, None], 2, 1)
+        self.files = [
+            self.segment(self.start, self.audio[: 3 * tools.FS]),
+            self.segment(self.start + 3, self.audio[3 * tools.FS :]),
+        ]
+        self.server = archive.ArchiveServer(self.location, ("localhost", 0)).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def segment(self, start: float, audio: np.ndarray) -> pathlib.Path:
+        """Writes a WAV segment named and timed like a recording starting at `start`."""
+        began = datetime.fromtimestamp(start)
+        directory = self.location / tools.format_date(began)
+        directory.mkdir(exist_ok=True)
+        name = (
+            f"{began:%Y-%m-%d--%H-%M-%S}--{began + timedelta(seconds=3):%H-%M-%S}.wav"
+        )
+        sf.write(str(directory / name), audio, tools.FS, "PCM_32")
+        tools.write_sidecar(directory / name, {"start_time": start})
+        return directory / name
+
+    def get(self, path: str, headers: dict = None):
+        connection = http.client.HTTPConnection(*self.server.server_address)
+        self.addCleanup(connection.close)
+        connection.request("GET", path, headers=headers or {})
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_range(self):
+        path = "/" + str(self.files[0].relative_to(self.location))
+        data = self.files[0].read_bytes()
+        response, body = self.get(path, {"Range": "bytes=100-199"})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(body, data[100:200])
+        self.assertEqual(
+            response.getheader("Content-Range"), f"bytes 100-199/{len(data)}"
+        )
+        response, body = self.get(path, {"Range": "bytes=-10"})
+        self.assertEqual(body, data[-10:])
+        response, _ = self.get(path, {"Range": f"bytes={len(data)}-"})
+        self.assertEqual(response.status, 416)
+        response, body = self.get(path)
+        self.assertEqual((response.status, body), (200, data))
+        response, body = self.get("/")
+        self.assertIn(self.files[0].parent.name, body.decode())
+
+    def test_clip(self):
+        response, body = self.get(f"/clip?start={self.start + 2}&duration=2")
+        self.assertEqual(response.status, 200)
+        clip, samplerate = sf.read(io.BytesIO(body), dtype="int32")
+        self.assertEqual(samplerate, tools.FS)
+        # The clip is stitched across the boundary between the two segments.
+        np.testing.assert_array_equal(clip, self.audio[2 * tools.FS : 4 * tools.FS])
+        misses = self.server.cache.status()["misses"]
+        self.get(f"/clip?start={self.start + 2.5}&duration=1")
+        self.assertEqual(self.server.cache.status()["misses"], misses)
+        # Time no segment covers is silent.
+        _, body = self.get(f"/clip?start={self.start + 5}&duration=2")
+        clip, _ = sf.read(io.BytesIO(body), dtype="int32")
+        np.testing.assert_array_equal(clip[: tools.FS], self.audio[5 * tools.FS :])
+        self.assertFalse(clip[tools.FS :].any())
+        response, _ = self.get(f"/clip?start={self.start - 100}&duration=2")
+        self.assertEqual(response.status, 404)
+        response, _ = self.get("/clip?duration=2")
+        self.assertEqual(response.status, 400)
+
+    def test_cache(self):
+        cache = archive.BlockCache(max_bytes=1)
+        for filename in self.files:
+            with reader.SegmentReader(filename) as segment:
+                cache.read(segment, 100, 10)
+        np.testing.assert_array_equal(
+            cache.read(segment, 100, 10), self.audio[3 * tools.FS + 100 :][:10]
+        )
+        # The least recently used block is evicted once the cache is full.
+        self.assertEqual(cache.status()["blocks"], 1)
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.location = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.location)
+        tools.create_directory(self.location)
+        self.directory = self.location / tools.format_date_now()
+
+    def test_backfill(self):
+        filename = tools.get_filename(1, self.location, ".wav")
+        live = features.FeatureExtractor(self.directory, 2, time.time())
+        recorder.WriterStream(1, filename, 2, -1, [live], "WAV")
+        recorded = np.array(features.load_features(self.directory))
+        self.assertGreater(len(recorded), 0)
+
+        total = replay.replay(self.location, ["features"], workers=1)
+        self.assertEqual((total["files"], total["skipped"]), (0, 1))
+        total = replay.replay(self.location, ["features"], overwrite=True)
+        self.assertEqual((total["files"], total["errors"]), (1, 0))
+        self.assertGreater(total["speed"], 0)
+        # Replaying the file computes what the live pipeline computed from the capture.
+        replayed = features.load_features(self.directory)
+        np.testing.assert_allclose(replayed["bands"], recorded["bands"], atol=1e-4)
+        self.assertLess(abs(replayed["time"][0] - recorded["time"][0]), 0.5)
+
+    def test_source(self):
+        audio = np.arange(3 * tools.BLOCKSIZE + 10, dtype=np.int32)[:, None] << 8
+        filename = self.directory / "2024-05-01--12-00-00--12-00-01.raw"
+        sf.write(str(filename), audio, tools.FS, "PCM_32", format="RAW")
+        tools.write_sidecar(
+            filename, {"samplerate": tools.FS, "channels": 1, "subtype": "PCM_32"}
+        )
+        source = replay.SegmentSource(filename)
+        blocks = list(source.blocks())
+        self.assertEqual([len(block) for block in blocks], [tools.BLOCKSIZE] * 3 + [10])
+        np.testing.assert_array_equal(np.concatenate(blocks), audio)
+        self.assertEqual(source.start, datetime(2024, 5, 1, 12, 0, 0).timestamp())
+
+
+class TestMerge(unittest.TestCase):
+    def setUp(self):
+        self.location = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.location)
+        self.start = datetime.now().replace(hour=12, minute=59, second=58).timestamp()
+        self.directory = self.location / tools.format_date(
+            datetime.fromtimestamp(self.start)
+        )
+        self.directory.mkdir()
+
+    def segment(self, start: float, audio: np.ndarray, file_format: str = "WAV"):
+        """Writes a segment named and timed like a recording starting `start` seconds after `self.start`."""
+        began = datetime.fromtimestamp(self.start + start)
+        ended = began + timedelta(seconds=len(audio) / tools.FS)
+        filename = self.directory / (
+            f"{began:%Y-%m-%d--%H-%M-%S}--{ended:%H-%M-%S}{tools.FORMATS[file_format][0]}"
+        )
+        sf.write(str(filename), audio, tools.FS, tools.FORMATS[file_format][1])
+        tools.write_sidecar(
+            filename,
+            {"start_time": self.start + start, "dropouts": [{"frame": 5, "frames": 2}]},
+        )
+        return filename
+
+    def test_wav(self):
+        audio = np.random.randint(-(2**31), 2**31, (5 * tools.FS, 2), dtype=np.int32)
+        for second in range(3):
+            self.segment(second, audio[second * tools.FS : (second + 1) * tools.FS])
+        # A gap of a minute starts a new file.
+        self.segment(63, audio[3 * tools.FS :])
+        result = merge.merge(self.location)
+        self.assertEqual((result["files"], result["segments"]), (2, 4))
+        self.assertEqual(len(result["gaps"]), 1)
+        self.assertAlmostEqual(result["gaps"][0][2], 60)
+        merged = sorted((self.directory / merge.MERGE_DIRECTORY).glob("*.wav"))
+        self.assertTrue(tools.is_segment(merged[0]))
+        data, _ = sf.read(str(merged[0]), dtype="int32")
+        np.testing.assert_array_equal(data, audio[: 3 * tools.FS])
+        info = tools.read_sidecar(merged[0])
+        self.assertEqual(info["frames"], 3 * tools.FS)
+        self.assertEqual(
+            [dropout["frame"] for dropout in info["dropouts"]],
+            [5, tools.FS + 5, 2 * tools.FS + 5],
+        )
+        self.assertFalse(manifest.verify_tree(self.location)["problems"])
+        # Runs merged before are left alone.
+        self.assertEqual(merge.merge(self.location)["files"], 0)
+
+    def test_ogg(self):
+        audio = np.random.uniform(-0.5, 0.5, (4 * tools.FS, 2))
+        files = [
+            self.segment(
+                second * 2, audio[second * 2 * tools.FS :][: 2 * tools.FS], "OGG"
+            )
+            for second in range(2)
+        ]
+        runs, _ = merge.plan(self.directory, "hour")
+        # The segments start on either side of one o'clock.
+        self.assertEqual([len(run) for run in runs], [1, 1])
+        result = merge.merge(self.location, output=self.location / "archive")
+        self.assertEqual(result["files"], 1)
+        (merged,) = (self.location / "archive" / self.directory.name).glob("*.ogg")
+        # The segments are encoded again into a single stream that decodes to the end.
+        self.assertEqual(len(sf.read(str(merged))[0]), 4 * tools.FS)
+        self.assertEqual(tools.read_sidecar(merged)["frames"], 4 * tools.FS)
+        result = merge.merge(
+            self.location, output=self.location / "chained", chain=True
+        )
+        (merged,) = (self.location / "chained" / self.directory.name).glob("*.ogg")
+        # Chained segments are not encoded again.
+        self.assertEqual(
+            merged.read_bytes(), b"".join(path.read_bytes() for path in files)
+        )
+        self.assertTrue(tools.read_sidecar(merged)["chained"])
+        result = merge.merge(self.location, file_format="FLAC")
+        (merged,) = (self.directory / merge.MERGE_DIRECTORY).glob("*.flac")
+        self.assertEqual(sf.info(str(merged)).frames, 4 * tools.FS)
+
+
+class TestPack(unittest.TestCase):
+    def setUp(self):
+        self.location = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.location)
+        self.day = tools.format_date(datetime.now() - timedelta(days=40))
+        self.directory = self.location / self.day
+        (self.directory / "merged").mkdir(parents=True)
+        self.audio = np.random.randint(-(2**31), 2**31, (tools.FS, 2), dtype=np.int32)
+        self.wav = self.directory / "2024-05-01--12-00-00--12-00-01.wav"
+        sf.write(str(self.wav), self.audio, tools.FS, "PCM_32")
+        self.raw = self.directory / "merged" / "2024-05-01--12-00-00--12-00-01.raw"
+        self.raw.write_bytes(self.audio.tobytes())
+        tools.write_sidecar(
+            self.raw, {"samplerate": tools.FS, "channels": 2, "subtype": "PCM_32"}
+        )
+        # Recent days stay as they are.
+        (self.location / tools.format_date_now()).mkdir()
+
+    def test_pack(self):
+        self.assertEqual(
+            pack.pack_old(self.location, 30), [self.location / (self.day + ".pack")]
+        )
+        self.assertFalse(self.directory.exists())
+        self.assertTrue((self.location / tools.format_date_now()).is_dir())
+        packed = pack.PackFile(self.location / (self.day + ".pack"))
+        self.assertIn("merged/" + self.raw.name, packed)
+        for name in packed.names():
+            self.assertEqual(packed.index[name]["offset"] % pack.PACK_ALIGN, 0)
+        # Segments are read in place, with seeking.
+        for name in (self.wav.name, "merged/" + self.raw.name):
+            with packed.sound_file(name) as f:
+                f.seek(1000)
+                np.testing.assert_array_equal(
+                    f.read(100, dtype="int32"), self.audio[1000:1100]
+                )
+        target = packed.extract(self.wav.name, self.location / "out")
+        self.assertEqual(
+            sf.read(str(target), dtype="int32")[0].tolist(), self.audio.tolist()
+        )
+        self.assertEqual(
+            pack.unpack_day(self.location / (self.day + ".pack")), self.directory
+        )
+        self.assertEqual(self.raw.read_bytes(), self.audio.tobytes())
+        self.assertFalse((self.location / (self.day + ".pack")).exists())
+
+    def test_retention(self):
+        pack.pack_old(self.location, 30)
+        delete.delete_folders(self.location, 50)
+        self.assertTrue((self.location / (self.day + ".pack")).exists())
+        delete.delete_folders(self.location, 30)
+        self.assertFalse((self.location / (self.day + ".pack")).exists())
+        self.assertTrue((self.location / tools.format_date_now()).is_dir())
+
+    def test_unshipped(self):
+        shipper.write_state(self.directory, {self.wav.name: {"verified": False}})
+        self.assertEqual(pack.pack_old(self.location, 30), [])
+        self.assertTrue(self.wav.exists())
+
+
+class TestDuty(unittest.TestCase):
+    def test_cycle(self):
+        cycle = duty.parse_schedule("5/30")
+        self.assertEqual(cycle, duty.DutyCycle(5, 30))
+        now = datetime(2024, 5, 1, 12, 32, 30)
+        self.assertEqual(cycle.remaining(now), 150)
+        self.assertEqual(cycle.until_next(now), 1650)
+        self.assertEqual(cycle.remaining(now.replace(minute=40)), 0)
+        for text in ("30/5", "5/7", "5 every 30"):
+            with self.assertRaises(ValueError):
+                duty.parse_schedule(text)
+
+    def test_windows(self):
+        windows = duty.parse_schedule("06:00-08:00,23:00-01:00")
+        self.assertEqual(windows.remaining(datetime(2024, 5, 1, 7, 0)), 3600)
+        self.assertEqual(windows.remaining(datetime(2024, 5, 1, 0, 30)), 1800)
+        self.assertEqual(windows.remaining(datetime(2024, 5, 1, 12, 0)), 0)
+        self.assertEqual(windows.until_next(datetime(2024, 5, 1, 12, 0)), 11 * 3600)
+        self.assertEqual(windows.until_next(datetime(2024, 5, 1, 23, 30)), 6.5 * 3600)
+        with self.assertRaises(ValueError):
+            duty.parse_schedule("25:00-26:00")
+
+    def test_record(self):
+        # Windows of 2 seconds every 4, faster than any real schedule.
+        started = time.monotonic()
+
+        def phase(now):
+            return (time.monotonic() - started) % 4
+
+        schedule = SimpleNamespace(
+            remaining=lambda now: max(0, 2 - phase(now)),
+            until_next=lambda now: 4 - phase(now),
+        )
+        rec = recorder.Recorder(os.getcwd(), 1, -1, 30, schedule=schedule)
+        threading.Timer(7, rec.stop).start()
+        rec.record()
+        self.addCleanup(cleanup_dir)
+        self.assertEqual(rec.files, 2)
+        self.assertGreater(rec.saved_frames, 3 * tools.FS)
+        self.assertLess(rec.saved_frames, 5 * tools.FS)
+        self.assertGreater(rec.secs_passed, 6)
+
+    def test_timeout_between_windows(self):
+        # The next window is an hour away, long after the timeout of 3 seconds.
+        schedule = SimpleNamespace(remaining=lambda now: 0, until_next=lambda now: 3600)
+        rec = recorder.Recorder(os.getcwd(), 0.05, -1, 1, schedule=schedule)
+        started = time.monotonic()
+        rec.record()
+        self.addCleanup(cleanup_dir)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual(rec.files, 0)
+
+
+class TestPlanner(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+
+    def test_plan(self):
+        result = planner.plan(
+            self.location,
+            file_format="FLAC",
+            filelen=60,
+            seconds=0.5,
+            disk_bytes=2**20,
+        )
+        self.assertGreater(result["realtime_factor"], 0)
+        self.assertGreater(result["disk_bytes_per_second"], 0)
+        self.assertAlmostEqual(
+            result["bytes_per_day"], result["bytes_per_second"] * planner.DAY_SECONDS
+        )
+        self.assertGreater(result["peak_memory"], 0)
+        self.assertEqual(result["problems"], [])
+        # The disk test leaves nothing behind.
+        self.assertEqual(os.listdir(self.location), [])
+
+    def test_problems(self):
+        slow = {"realtime_factor": 3.0, "bytes_per_second": 1e9}
+        with mock.patch.object(
+            planner, "measure", return_value=slow
+        ), mock.patch.object(planner, "available_memory", return_value=2**30):
+            result = planner.plan(
+                self.location, retention=7, max_writers=2, disk_bytes=2**20
+            )
+        # The encoder, the disk bandwidth, the memory and the retention all fall short.
+        self.assertEqual(len(result["problems"]), 4)
+        # Both writers hold a full file of 1800 seconds.
+        self.assertEqual(result["writers_in_flight"], 2)
+        self.assertGreater(result["peak_memory"], 2 * 1800 * tools.FS * 2 * 4)
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_profile(self):
+        done = threading.Event()
+
+        def busy():
+            while not done.is_set():
+                sum(range(10000))
+
+        worker = threading.Thread(target=busy, name="busy")
+        worker.start()
+        self.addCleanup(worker.join)
+        self.addCleanup(done.set)
+        profile = profiler.Profiler(self.directory, 0.001)
+        self.assertTrue(profile.start(0.5))
+        self.assertFalse(profile.start(0.5))
+        profile.thread.join()
+        directory = profile.last
+        summary = json.loads((directory / "threads.json").read_text())
+        self.assertGreater(summary["samples"], 10)
+        self.assertGreater(summary["cpu_seconds"]["busy"], 0)
+        lines = (directory / "cpu.collapsed").read_text().splitlines()
+        self.assertTrue(
+            any(line.startswith("busy;") and "busy (" in line for line in lines)
+        )
+        self.assertTrue((directory / "wall.collapsed").read_text())
+        stats = pstats.Stats(str(directory / "busy.pstats"))
+        self.assertIn("busy", {function[2] for function in stats.stats})
+
+    def test_control(self):
+        rec = recorder.Recorder(os.getcwd(), 1, -1, 10)
+        rec.profiler.directory = self.directory
+        self.assertTrue(
+            daemon.dispatch(rec, {"command": "profile", "value": 60})["profiling"]
+        )
+        status = daemon.dispatch(rec, {"command": "profile"})
+        self.assertFalse(status["profiling"])
+        self.assertTrue(pathlib.Path(status["profile"]).is_dir())
+
+    def test_window(self):
+        for seconds in (0, -1, profiler.MAX_PROFILE_SECONDS + 1):
+            with self.assertRaises(AssertionError):
+                recorder.Recorder(os.getcwd(), 1, -1, 10, profile=seconds)
+
+
+class TestStartup(unittest.TestCase):
+    # Budget in seconds for importing everything a light command needs.
+    BUDGET = 0.5
+
+    def import_times(self, *args):
+        """Runs autolisten under `python -X importtime` and returns the self time of each module imported."""
+        root = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-m", "src.autolisten.main", *args],
+            cwd=root,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        times = {}
+        for line in result.stderr.splitlines():
+            if line.startswith("import time:") and "self [us]" not in line:
+                own, _, name = line[len("import time:") :].split("|")
+                times[name.strip()] = int(own)
+        return times
+
+    def test_light_commands(self):
+        for args in (["--help"], ["delete", "--help"], ["control", "--help"]):
+            times = self.import_times(*args)
+            for heavy in ("numpy", "sounddevice", "soundfile"):
+                self.assertNotIn(heavy, times, f"{heavy} imported by {args}")
+            self.assertLess(sum(times.values()) / 1e6, self.BUDGET)
+
+
 class TestDelayTimer(unittest.TestCase):
     def test_zero_time(self):
         rec = recorder.Recorder(os.getcwd(), 1, -1, 1, delay=5, closest=0)